@@ -1,33 +1,190 @@
-from math import cos, sin, acos, radians
+from math import cos, sin, atan2, sqrt, radians, pi
+import numpy as np
 
 class Point(object):
     def __init__(self,x,y):
         self.x = x
-        self.y = y       
+        self.y = y
+
+def _as_arrays(lon, lat):
+    """ lon and lat as float arrays of at least one dimension and the same shape, the in place ufuncs of the
+        projections don't work on numpy scalars, and whether both were scalars """
+    lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    return np.array(lon, ndmin=1), np.array(lat, ndmin=1), lon.ndim == 0
 
 class AzimuthalEquidistantProjection(object):
-    """ 
+    """
         http://mathworld.wolfram.com/AzimuthalEquidistantProjection.html
         http://www.radicalcartography.net/?projectionref
+
+        coordinates are in units of radius (1 = unit sphere), the antipode of the center has no
+        direction and is projected to (0, -pi * radius)
     """
-    def __init__(self, center):
+    def __init__(self, center, radius=1.0):
         self.center = center
+        self.radius = radius
         self.t1 = radians(center.y) ## latitude center of projection
         self.l0 = radians(center.x) ## longitude center of projection
         self.cost1 = cos(self.t1)
         self.sint1 = sin(self.t1)
-        
+
     def project(self, point):
         t = radians(point.y)
         l = radians(point.x)
         costcosll0 = cos(t) * cos(l-self.l0)
         sint = sin(t)
-        
-        c = acos ((self.sint1) * (sint) + (self.cost1) * costcosll0)
-        k = c / sin(c)
-        x = k * cos(t) * sin(l-self.l0)
-        y = k * (self.cost1 * sint - self.sint1 * costcosll0)
-        return Point(x, y)
+
+        ## sin(c) is the length of the (x, y) direction, atan2 avoids acos rounding and c / sin(c) = 0 / 0 at the center
+        dx = cos(t) * sin(l-self.l0)
+        dy = self.cost1 * sint - self.sint1 * costcosll0
+        sinc = sqrt(dx * dx + dy * dy)
+        c = atan2(sinc, self.sint1 * sint + self.cost1 * costcosll0)
+        if sinc < 1e-12 and c > 1:
+            return Point(0.0, -pi * self.radius)  # antipode
+        k = c / sinc * self.radius if sinc > 0 else self.radius
+        return Point(k * dx, k * dy)
+
+    def unproject(self, point):
+        lon, lat = self.unproject_many(point.x, point.y)
+        return Point(float(lon), float(lat))
+
+    def project_many(self, lon, lat, out=None):
+        """ (x, y) arrays for arrays of lon and lat in degrees, out is an optional (x, y) pair of arrays,
+            floats for scalar lon and lat """
+        lon, lat, scalar = _as_arrays(lon, lat)
+        if scalar:
+            out = None
+        t = np.radians(lon)
+        dl = np.subtract(t, self.l0, out=t)
+        t = np.radians(lat)
+        cost = np.cos(t)
+        sint = np.sin(t, out=t)
+        x_out, y_out = out if out is not None else (None, None)
+        costcosll0 = cost * np.cos(dl)
+        dx = np.multiply(cost, np.sin(dl, out=dl), out=x_out)
+        dy = np.multiply(sint, self.cost1, out=y_out)
+        dy -= self.sint1 * costcosll0
+        cosc = np.multiply(sint, self.sint1, out=sint)
+        costcosll0 *= self.cost1
+        cosc += costcosll0
+        sinc = np.hypot(dx, dy, out=cost)
+        ## k = c / sin(c) is 1 at the center, the antipode has no direction and gets (0, -1)
+        antipode = (sinc < 1e-12) & (cosc < 0)
+        c = np.arctan2(sinc, cosc, out=cosc)
+        k = np.divide(c, sinc, out=c, where=sinc > 0)
+        k[sinc == 0] = 1
+        dx[antipode] = 0
+        dy[antipode] = -1
+        k[antipode] = pi
+        k *= self.radius
+        dx *= k
+        dy *= k
+        if scalar:
+            return float(dx[0]), float(dy[0])
+        return dx, dy
+
+    def unproject_many(self, x, y, out=None):
+        """ (lon, lat) arrays in degrees for arrays of projected x and y, points further than pi * radius
+            from the center are nan, out is an optional (lon, lat) pair of arrays """
+        x = np.asarray(x, dtype=np.float64) / self.radius
+        y = np.asarray(y, dtype=np.float64) / self.radius
+        c = np.hypot(x, y)
+        sinc, cosc = np.sin(c), np.cos(c)
+        ## sin(c) / c, 1 at the center
+        sinc_c = np.divide(sinc, c, out=np.ones_like(c), where=c > 0)
+        lon_out, lat_out = out if out is not None else (None, None)
+        lat = np.clip(cosc * self.sint1 + y * sinc_c * self.cost1, -1, 1)
+        lat = np.arcsin(lat)
+        lon = np.arctan2(x * sinc, c * self.cost1 * cosc - y * self.sint1 * sinc)
+        ## back to [-180, 180)
+        lon = np.mod(lon + (self.l0 + pi), 2 * pi) - pi
+        outside = c > pi * (1 + 1e-12)
+        lon, lat = np.where(outside, np.nan, lon), np.where(outside, np.nan, lat)
+        return np.degrees(lon, out=lon_out), np.degrees(lat, out=lat_out)
+
+
+def _unit_vector(point):
+    t, l = radians(point.y), radians(point.x)
+    return np.array([cos(t) * cos(l), cos(t) * sin(l), sin(t)])
+
+
+class TwoPointEquidistantProjection(object):
+    """ distances to both control points are preserved (Snyder, Map Projections - A Working Manual, p. 200)
+        the origin is halfway between the control points, point1 is at (-d0 / 2, 0) and point2 at (d0 / 2, 0)
+        with d0 the great circle distance between them, y is positive left of the direction point1 -> point2 """
+    def __init__(self, point1, point2, radius=1.0):
+        self.point1, self.point2, self.radius = point1, point2, radius
+        self.a, self.b = _unit_vector(point1), _unit_vector(point2)
+        self.normal = np.cross(self.a, self.b)
+        self.sind0 = np.linalg.norm(self.normal)
+        self.cosd0 = float(np.dot(self.a, self.b))
+        self.d0 = atan2(self.sind0, self.cosd0)
+        if self.sind0 < 1e-12:
+            raise ValueError('the control points are identical or antipodal')
+
+    def project(self, point):
+        x, y = self.project_many(point.x, point.y)
+        return Point(float(x), float(y))
+
+    def unproject(self, point):
+        lon, lat = self.unproject_many(point.x, point.y)
+        return Point(float(lon), float(lat))
+
+    def project_many(self, lon, lat, out=None):
+        """ (x, y) arrays for arrays of lon and lat in degrees, out is an optional (x, y) pair of arrays,
+            floats for scalar lon and lat """
+        lon, lat, scalar = _as_arrays(lon, lat)
+        if scalar:
+            out = None
+        t = np.radians(lat)
+        l = np.radians(lon)
+        cost = np.cos(t)
+        p = (cost * np.cos(l), np.multiply(cost, np.sin(l, out=l), out=l), np.sin(t, out=t))
+        x_out, y_out = out if out is not None else (None, None)
+        z1, z2 = self._distances(p, self.a), self._distances(p, self.b)
+        d0 = self.d0
+        z1 *= z1
+        z2 *= z2
+        x = np.subtract(z1, z2, out=x_out)
+        x /= 2 * d0
+        ## y = sqrt(z1^2 - (x + d0 / 2)^2) with the sign of the side of the great circle through both points
+        side = self.normal[0] * p[0] + self.normal[1] * p[1] + self.normal[2] * p[2]
+        z2 = np.add(x, d0 / 2, out=z2)
+        z2 *= z2
+        y = np.subtract(z1, z2, out=y_out)
+        np.maximum(y, 0, out=y)
+        np.sqrt(y, out=y)
+        y *= np.where(side < 0, -self.radius, self.radius)
+        x *= self.radius
+        if scalar:
+            return float(x[0]), float(y[0])
+        return x, y
+
+    def _distances(self, p, v):
+        cos_d = p[0] * v[0] + p[1] * v[1] + p[2] * v[2]
+        sin_d = np.cross(np.stack(p, axis=-1), v)
+        return np.arctan2(np.linalg.norm(sin_d, axis=-1), cos_d)
+
+    def unproject_many(self, x, y, out=None):
+        """ (lon, lat) arrays in degrees for arrays of projected x and y, out is an optional (lon, lat) pair of arrays
+            positions that can't be reached with the distances to both control points are nan """
+        x = np.asarray(x, dtype=np.float64) / self.radius
+        y = np.asarray(y, dtype=np.float64) / self.radius
+        half = self.d0 / 2
+        cos_z1, cos_z2 = np.cos(np.hypot(x + half, y)), np.cos(np.hypot(x - half, y))
+        ## p = u * a + v * b + w * (a x b) with p . a = cos(z1) and p . b = cos(z2)
+        det = 1 - self.cosd0 ** 2
+        u = (cos_z1 - self.cosd0 * cos_z2) / det
+        v = (cos_z2 - self.cosd0 * cos_z1) / det
+        in_plane = u * u + v * v + 2 * u * v * self.cosd0
+        w = np.sqrt(np.maximum(1 - in_plane, 0)) / self.sind0
+        w *= np.where(y < 0, -1, 1)
+        px, py, pz = (u * self.a[i] + v * self.b[i] + w * self.normal[i] for i in range(3))
+        lon_out, lat_out = out if out is not None else (None, None)
+        lat = np.arctan2(pz, np.hypot(px, py))
+        lon = np.arctan2(py, px)
+        return np.degrees(lon, out=lon_out), np.degrees(lat, out=lat_out)
+
 
 import unittest
 class Test_AzimuthalEquidistantProjection(unittest.TestCase):
@@ -43,11 +200,58 @@ class Test_AzimuthalEquidistantProjection(unittest.TestCase):
         r = p.project(Point(3.0,4.0))
         self.assertAlmostEqual(0.03482861, r.x)
         self.assertAlmostEqual(0.03493487, r.y)
-        
+
         p = AzimuthalEquidistantProjection(Point(-10.0001, 80.0001))
         r = p.project(Point(7.935, 63.302))
         self.assertAlmostEqual(0.1405128, r.x)
         self.assertAlmostEqual(-0.2699765, r.y)
 
+    def test_project_many(self):
+        center = Point(-10.0001, 80.0001)
+        p = AzimuthalEquidistantProjection(center)
+        lon, lat = np.array([7.935, 3.0, -10.0001, 169.9999, 170.0]), np.array([63.302, 4.0, 80.0001, -80.0001, -10.0])
+        out = np.empty(5), np.empty(5)
+        x, y = p.project_many(lon, lat, out=out)
+        self.assertIs(out[0], x)
+        for i in range(5):
+            r = p.project(Point(lon[i], lat[i]))
+            self.assertAlmostEqual(r.x, x[i])
+            self.assertAlmostEqual(r.y, y[i])
+        self.assertEqual((0.0, 0.0), (x[2], y[2]))  # center
+        self.assertAlmostEqual(-pi, y[3])  # antipode
+        lon2, lat2 = p.unproject_many(x, y)
+        self.assertTrue(np.allclose(np.c_[lon, lat][[0, 1, 2, 4]], np.c_[lon2, lat2][[0, 1, 2, 4]]))
+        self.assertAlmostEqual(-80.0001, lat2[3])
+        self.assertTrue(np.isnan(p.unproject_many(4.0, 0.0)[0]))
+        x0, y0 = p.project_many(lon[0], lat[0])
+        self.assertTrue(isinstance(x0, float))
+        self.assertAlmostEqual(x[0], x0)
+        self.assertAlmostEqual(y[0], y0)
+        self.assertAlmostEqual(y[1], p.project_many(3.0, [4.0])[1][0])
+
+    def test_two_point(self):
+        from numpy_greatcircle import gc_distance
+        a, b = Point(-10.0, 40.0), Point(20.0, 50.0)
+        p = TwoPointEquidistantProjection(a, b, radius=6371.0)
+        lon, lat = np.array([-10.0, 20.0, 5.0, 0.0, 100.0]), np.array([40.0, 50.0, 70.0, 30.0, -20.0])
+        x, y = p.project_many(lon, lat)
+        d0 = gc_distance(a.x, a.y, b.x, b.y, radius=6371.0)
+        self.assertAlmostEqual(-d0 / 2, x[0], places=6)
+        self.assertAlmostEqual(d0 / 2, x[1], places=6)
+        ## distances to both control points are preserved
+        self.assertTrue(np.allclose(np.hypot(x + d0 / 2, y), gc_distance(lon, lat, a.x, a.y, radius=6371.0)))
+        self.assertTrue(np.allclose(np.hypot(x - d0 / 2, y), gc_distance(lon, lat, b.x, b.y, radius=6371.0)))
+        self.assertTrue(y[2] > 0 and y[3] < 0)  # north is left of a -> b
+        lon2, lat2 = p.unproject_many(x, y)
+        self.assertTrue(np.allclose(np.c_[lon, lat], np.c_[lon2, lat2], atol=1e-6))
+        for i in range(len(lon)):
+            r = p.project(Point(lon[i], lat[i]))
+            self.assertAlmostEqual(x[i], r.x, places=6)
+            self.assertAlmostEqual(y[i], r.y, places=6)
+            self.assertEqual((r.x, r.y), p.project_many(lon[i], lat[i]))
+            back = p.unproject(r)
+            self.assertAlmostEqual(lon[i], back.x, places=6)
+            self.assertAlmostEqual(lat[i], back.y, places=6)
+
 if __name__ == '__main__':
     unittest.main()
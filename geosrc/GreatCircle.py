@@ -5,6 +5,9 @@ http://williams.best.vwh.net/ftp/avsig/avform.txt
 
 from math import radians, degrees, cos, sin, sqrt, atan2, asin, fabs, pi
 
+## the scalar functions below are thin wrappers around the array versions in numpy_greatcircle
+import numpy_greatcircle as ngc
+
 class Point(object):
     def __init__(self,x,y):
         self.x = x
@@ -12,74 +15,32 @@ class Point(object):
 
 def distance_haversine(A, B, radius=6371000):
     """ note that the default distance is in meters """
-    dLat = radians(B.y-A.y)
-    dLon = radians(B.x-A.x)
-    lat1 = radians(A.y)
-    lat2 = radians(B.y)
-    a = sin(dLat/2) * sin(dLat/2) + sin(dLon/2) * sin(dLon/2) * cos(lat1) * cos(lat2)
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    return c * radius
+    return float(ngc.gc_distance(A.x, A.y, B.x, B.y, radius=radius))
 
 def bearing(A, B):
-    dLon = radians(B.x-A.x)
-    lat1 = radians(A.y)
-    lat2 = radians(B.y)
-    y = sin(dLon) * cos(lat2)
-    x = cos(lat1)* sin(lat2) - sin(lat1) * cos(lat2)* cos(dLon)
-    return atan2(y, x)
+    return float(ngc.gc_bearing(A.x, A.y, B.x, B.y))
 
 def bearing_degrees(A,B):
     return degrees(bearing(A,B))
 
 def midpoint(A,B):
-    ## little shortcut
-    if A.x == B.x: return Point(A.x, (A.y+B.y)/2)
-    if A.y == B.y: return Point((A.x+B.x)/2, A.y)
-    
-    lon1, lat1 = radians(A.x), radians(A.y)
-    lon2, lat2 = radians(B.x), radians(B.y)
-    dLon = lon2-lon1
-
-    Bx = cos(lat2) * cos(dLon)
-    By = cos(lat2) * sin(dLon)
-    lat3 = atan2(sin(lat1)+sin(lat2), sqrt((cos(lat1)+Bx)*(cos(lat1)+Bx) + By*By))
-    lon3 = lon1 + atan2(By, cos(lat1) + Bx)
-    return Point(degrees(lon3),degrees(lat3))
+    lon, lat = ngc.gc_midpoint(A.x, A.y, B.x, B.y)
+    return Point(float(lon), float(lat))
 
 def crosstrack_error(p,A,B, radius=6371000):
     """ distance (in meters) from a point to the closest point along a track
         http://williams.best.vwh.net/avform.htm#XTE """
-    dAp = distance_haversine(A, p, radius=1)
-    brngAp = bearing(A,p)
-    brngAB = bearing(A,B)
-    dXt = asin(sin(dAp)*sin(brngAp-brngAB))
-    return fabs(dXt) * radius
+    return float(ngc.gc_crosstrack(p.x, p.y, A.x, A.y, B.x, B.y, radius=radius))
 
 def point_line_distance(p, A,B, radius=6371000, tolerance=0.1): # tolerance and radius in meters
-    """ recursive function that halves the search space until result is within tolerance
-        disadvantages:
-        1) the rounding errors in midpoint do add up
-        2) not very fast """
-    def rec_point_line_distance(p,A,B,dA,dB):
-        C = midpoint(A,B)
-        dC = distance_haversine(p,C)
-        if fabs(dC-dA) < tolerance or fabs(dC-dB) < tolerance:
-            return dC
-        elif dA < dB:
-            return point_line_distance(p,A,C,dA, dC)
-        else:
-            return point_line_distance(p,C,B,dC, dB)
-    dA = distance_haversine(p,A)
-    dB = distance_haversine(p,B)
-    return rec_point_line_distance(p,A,B,dA,dB)
+    """ exact distance from a point to the segment A-B: the cross track distance when the
+        closest point of the great circle lies between A and B, else the distance to the
+        nearest end point (tolerance is no longer used) """
+    return float(ngc.point_polyline_distance(p.x, p.y, [((A.x, B.x), (A.y, B.y))], radius=radius))
 
 def destination_point(p, distanceR, bearing):
-    x,y = radians(p.x),radians(p.y)
-    y2 = asin(sin(y)*cos(distanceR) + cos(y)*sin(distanceR)*cos(bearing))
-    x2 = x + atan2(sin(bearing)*sin(distanceR)*cos(y), 
-                   cos(distanceR)-sin(y)*sin(y2))
-    x2 = (x2+3*pi) % (2*pi) - pi;  ## normalise to -180..+180
-    return Point(degrees(x2),degrees(y2))
+    lon, lat = ngc.gc_destination(p.x, p.y, distanceR, bearing)
+    return Point(float(lon), float(lat))
 
 def get_centroid(points):
     """ 
@@ -136,7 +97,9 @@ class Test_gc(unittest.TestCase):
 
         p,A,B = Point(2.0, 1.2), Point(1.0, 1.0), Point(3.0, 1.0)
         d = point_line_distance(p,A,B)
-        self.assertAlmostEqual(d, distance_haversine(p,Point(2.0,1.0)), places=0)
+        ## the great circle through A and B bulges north of the 1.0 parallel
+        self.assertAlmostEqual(d, crosstrack_error(p,A,B), places=0)
+        self.assertLess(d, distance_haversine(p,Point(2.0,1.0)))
 
         p,A,B = Point(0.0, 90.0), Point(-179.0, -21.0), Point(179.5, -22.0)
         d = point_line_distance(p,A,B)
@@ -144,7 +107,8 @@ class Test_gc(unittest.TestCase):
 
         p,A,B = Point(0.0, 89.0), Point(-179.0, -22.0), Point(179.5, -22.0)
         d = point_line_distance(p,A,B)
-        self.assertAlmostEqual(d, distance_haversine(p,Point(0, -22)), places=0)
+        ## the segment crosses the date line, the closest point of its great circle is near lon 0
+        self.assertAlmostEqual(d, min(distance_haversine(p,A), distance_haversine(p,B)), places=0)
         
     def test_get_centroid(self):
         ## check crosses the north pole
@@ -0,0 +1,181 @@
+""" streaming ESRI ASCII grid (.asc) to .sbg (and optionally .sbm/.sbv) converter,
+python counterpart of AsciiProvider in AsciiToBin.fsx
+
+The header is parsed key by key instead of guessing it from the line length and the values
+are parsed in large byte chunks with numpy, so memory use is bounded by the chunk size
+and not by the size of the grid.
+"""
+import os
+import glob
+from multiprocessing import Pool
+
+import numpy as np
+
+from binreader import NODATA
+from sparsegrid import SparseWriter, BITMAP_EXTENSION, VALUES_EXTENSION
+
+HEADER_KEYS = ('ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter', 'yllcenter', 'cellsize', 'nodata_value')
+
+
+def read_header(f):
+    """ parse the header of an opened (binary mode) .asc file, leaves f at the first value """
+    header = {}
+    while True:
+        position = f.tell()
+        line = f.readline()
+        parts = line.split()
+        if not parts or parts[0].decode('ascii', 'replace').lower() not in HEADER_KEYS:
+            f.seek(position)
+            break
+        key, value = parts[0].decode('ascii').lower(), parts[1].decode('ascii')
+        header[key] = int(value) if key in ('ncols', 'nrows') else float(value)
+    if 'ncols' not in header or 'nrows' not in header:
+        raise ValueError('ncols and nrows are required in an ESRI ASCII grid header')
+    header.setdefault('nodata_value', -9999.0)
+    return header
+
+
+def _parse(text, name):
+    """ float64 values of whitespace separated numbers, a token that isn't a number raises ValueError """
+    tokens = text.split()
+    try:
+        return np.array(tokens, dtype=np.float64)
+    except ValueError:
+        for token in tokens:
+            try:
+                float(token)
+            except ValueError:
+                raise ValueError('%s: %r is not a number' % (name, token.decode('ascii', 'replace')))
+        raise
+
+
+def iter_rows(f, header, chunk_size=1 << 25, scale=1):
+    """ yields blocks of rows as int32 arrays (value*scale rounded, nodata as NODATA) """
+    ncols, nodata = header['ncols'], header['nodata_value']
+    rest = b''
+    pending = np.empty(0, dtype=np.float64)
+    while True:
+        chunk = f.read(chunk_size)
+        text = rest + chunk
+        if chunk:
+            # don't split a number in two, keep everything after the last whitespace for the next chunk
+            cut = max(text.rfind(b' '), text.rfind(b'\n'), text.rfind(b'\r'), text.rfind(b'\t'))
+            text, rest = (text[:cut], text[cut:]) if cut >= 0 else (b'', text)
+        values = _parse(text, getattr(f, 'name', 'input'))
+        values = np.concatenate((pending, values)) if len(pending) else values
+        nfull = (len(values) // ncols) * ncols
+        if nfull:
+            rows = values[:nfull].reshape(-1, ncols)
+            result = np.rint(rows * scale if scale != 1 else rows).astype(np.int32)
+            result[rows == nodata] = NODATA
+            yield result
+        pending = values[nfull:]
+        if not chunk:
+            break
+    if len(pending):
+        raise ValueError('trailing values do not form a complete row')
+
+
+def convert(asc_filename, out_filename=None, sparse=False, chunk_size=1 << 25, scale=1, overwrite=False):
+    """ convert one .asc file to .sbg (or .sbm/.sbv when sparse), returns the output filename
+        the output is written to .tmp files that are only renamed when the conversion is complete,
+        so an existing output is always a finished conversion and can be skipped on a rerun """
+    base = os.path.splitext(out_filename or asc_filename)[0]
+    out_filename = base + (VALUES_EXTENSION if sparse else '.sbg')
+    if os.path.exists(out_filename) and not overwrite:
+        return out_filename
+    if sparse:
+        tmp_base = base + '.tmp'
+        ## the bitmap is renamed before the values, the existence check above is on the values
+        renames = [(tmp_base + BITMAP_EXTENSION, base + BITMAP_EXTENSION), (tmp_base + VALUES_EXTENSION, out_filename)]
+    else:
+        renames = [(out_filename + '.tmp', out_filename)]
+    try:
+        with open(asc_filename, 'rb') as f:
+            header = read_header(f)
+            nrows = 0
+            if sparse:
+                with SparseWriter(renames[1][0], header['ncols']) as writer:
+                    for rows in iter_rows(f, header, chunk_size, scale):
+                        writer.write_rows(rows)
+                        nrows += rows.shape[0]
+            else:
+                with open(renames[0][0], 'wb') as out:
+                    for rows in iter_rows(f, header, chunk_size, scale):
+                        out.write(rows.astype('<i4').tobytes())
+                        nrows += rows.shape[0]
+        if nrows != header['nrows']:
+            raise ValueError('%s has %d rows instead of %d' % (asc_filename, nrows, header['nrows']))
+        for tmp, final in renames:
+            os.replace(tmp, final)
+    except BaseException:
+        for tmp, _ in renames:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+    return out_filename
+
+
+def _convert(args):
+    asc_filename, outdir, kwargs = args
+    out_filename = os.path.join(outdir, os.path.basename(asc_filename)) if outdir else None
+    return convert(asc_filename, out_filename, **kwargs)
+
+
+def convert_many(asc_filenames, outdir=None, processes=None, **kwargs):
+    """ convert many layers in parallel, one layer per process """
+    jobs = [(path, outdir, kwargs) for path in asc_filenames]
+    pool = Pool(processes)
+    try:
+        return pool.map(_convert, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+import unittest
+import tempfile
+import shutil
+class Test_asciitobin(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.asc = os.path.join(self.dir, 'layer.asc')
+        with open(self.asc, 'w') as f:
+            f.write('ncols 3\nnrows 2\nxllcorner -180\nyllcorner -90\ncellsize 120\nNODATA_value -9999\n')
+            f.write('1 -9999 3\n 40 5\n-6\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_convert(self):
+        for chunk_size in [1, 4, 1 << 20]:
+            sbg = convert(self.asc, chunk_size=chunk_size, overwrite=True)
+            self.assertEqual([1, NODATA, 3, 40, 5, -6], np.fromfile(sbg, dtype='<i4').tolist())
+
+    def test_convert_sparse(self):
+        from sparsegrid import read_values_sparse, close_sparse
+        sbv = convert(self.asc, sparse=True)
+        self.assertEqual([1, 3, 40, 5, -6], np.fromfile(sbv, dtype='<i4').tolist())
+        self.assertEqual([3, None], read_values_sparse(sbv, [2, 1], masked=True).tolist())
+        close_sparse()
+        self.assertEqual(['layer.asc', 'layer.sbm', 'layer.sbv'], sorted(os.listdir(self.dir)))
+
+    def test_failed_conversion_leaves_no_output(self):
+        with open(self.asc, 'a') as f:
+            f.write('7 8 9\n')  # one row too many
+        for sparse in (False, True):
+            self.assertRaises(ValueError, convert, self.asc, sparse=sparse)
+            self.assertEqual(['layer.asc'], os.listdir(self.dir))
+        with open(self.asc, 'w') as f:
+            f.write('ncols 3\nnrows 2\nNODATA_value -9999\n1 2 3\n4 5x 6\n')
+        with self.assertRaises(ValueError) as error:
+            convert(self.asc, chunk_size=4)
+        self.assertTrue("'5x'" in str(error.exception))
+        self.assertEqual(['layer.asc'], os.listdir(self.dir))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        print(convert_many(glob.glob(os.path.join(sys.argv[1], '*.asc')), *sys.argv[2:3]))
+    else:
+        unittest.main()
@@ -1,7 +1,21 @@
 import os
+import mmap
 import struct
 import glob
+import json
 import time
+from collections import OrderedDict
+
+import numpy as np
+
+NODATA = -2147483648  # Int32.MinValue, written by the F# writers for missing cells
+
+SBG_DIR = r'D:\temp\sbg_10m'
+
+## .sbg: band sequential, one headerless int32 file per layer, cheap when only a few layers are needed
+## .mbg: pixel interleaved, all layers of a cell are stored next to each other after a small header,
+##       cheap when all layers are needed for each cell (one read per cell instead of one per layer)
+MBG_MAGIC = b'MBG1'
 
 
 def read_values(filename, indices):
@@ -9,15 +23,237 @@ def read_values(filename, indices):
     values = []
     with open(filename, 'rb') as f:
         for index in indices:
-            f.seek(index*4L, os.SEEK_SET)
+            f.seek(index*4, os.SEEK_SET)
             b = f.read(4)
             v = struct.unpack("@i", b)[0]
-            if v == -2147483648:
+            if v == NODATA:
                 v = None
             values.append(v)
     return values
 
 
+class LayerPool(object):
+    """ long lived registry of memory mapped .sbg layers so that repeated lookups don't pay
+        open/close and a cold page cache on every call, the least recently used layers are
+        unmapped when there are more than max_handles layers or more than max_bytes mapped """
+    def __init__(self, max_handles=256, max_bytes=None):
+        self.max_handles, self.max_bytes = max_handles, max_bytes
+        self.layers = OrderedDict()  # filename -> flat int32 array on top of an mmap
+        self.mapped_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, filename):
+        grid = self.layers.get(filename)
+        if grid is not None:
+            self.hits += 1
+            self.layers.move_to_end(filename)
+            return grid
+        self.misses += 1
+        with open(filename, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        grid = np.frombuffer(m, dtype='<i4')
+        self.layers[filename] = grid
+        self.mapped_bytes += grid.nbytes
+        self._evict()
+        return grid
+
+    def _evict(self):
+        while len(self.layers) > 1 and (len(self.layers) > self.max_handles or
+                                        (self.max_bytes is not None and self.mapped_bytes > self.max_bytes)):
+            _, grid = self.layers.popitem(last=False)
+            # the mapping itself is released when the last array using it is garbage collected
+            self.mapped_bytes -= grid.nbytes
+            self.evictions += 1
+
+    def warm(self, filenames):
+        """ map the layers and ask the os to read them ahead into the page cache """
+        for filename in filenames:
+            grid = self.get(filename)
+            m = grid.base
+            if hasattr(m, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+                m.madvise(mmap.MADV_WILLNEED)
+            elif hasattr(os, 'posix_fadvise'):
+                fd = os.open(filename, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+
+    def stats(self):
+        return {'handles': len(self.layers), 'mapped_bytes': self.mapped_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        self.layers.clear()
+        self.mapped_bytes = 0
+
+
+_pool = LayerPool()  # every .sbg is mapped only once
+_merged = {}  # filename -> (header, memory mapped grid) for .mbg files
+
+
+def open_grid(filename):
+    """ memory map a .sbg file as a flat little endian int32 array """
+    return _pool.get(filename)
+
+
+def close_grids():
+    _pool.clear()
+    _merged.clear()
+
+
+def nodata_to_nan(values, masked=False, nodata=NODATA):
+    """ int32 values with the NODATA sentinel to float64 with NaN (or an int32 masked array) """
+    if masked:
+        return np.ma.masked_equal(values, nodata, copy=False)
+    result = values.astype(np.float64)
+    result[values == nodata] = np.nan
+    return result
+
+
+def read_values_mmap(filename, indices, masked=False):
+    """ vectorized read_values: indices can be unsorted and contain duplicates,
+        values are returned in the order of the indices """
+    indices = np.asarray(indices, dtype=np.int64)
+    values = open_grid(filename)[indices]  # one fancy indexing call, no python loop
+    return nodata_to_nan(values, masked)
+
+
+def read_layers(filenames, indices, masked=False):
+    """ values of all layers for the given cells as an (n_points x n_layers) array,
+        gathered layer by layer into contiguous rows and returned as a transposed view """
+    indices = np.asarray(indices, dtype=np.int64)
+    values = np.empty((len(filenames), len(indices)), dtype=np.int32)
+    for j, filename in enumerate(filenames):
+        np.take(open_grid(filename), indices, out=values[j])
+    return nodata_to_nan(values, masked).T
+
+
+def filesystem_blocksize(filename, default=4096):
+    try:
+        return os.statvfs(filename).f_bsize
+    except (AttributeError, OSError):  # no statvfs on windows
+        return default
+
+
+def plan_ranges(indices, gap):
+    """ merge sorted unique cell indices into contiguous (starts, ends) ranges (ends inclusive),
+        neighbours less than gap cells apart are read together instead of with an extra request """
+    if len(indices) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    breaks = np.diff(indices) > gap
+    starts = indices[np.r_[True, breaks]]
+    ends = indices[np.r_[breaks, True]]
+    range_ids = np.r_[0, np.cumsum(breaks)]
+    return starts, ends, range_ids
+
+
+def _read_range(f, view, offset):
+    if hasattr(os, 'preadv'):
+        return os.preadv(f.fileno(), [view], offset)
+    f.seek(offset, os.SEEK_SET)
+    return f.readinto(view)
+
+
+def read_values_batched(filename, indices, masked=False, gap=None):
+    """ read_values for cold or network disks: nearby indices are coalesced into ranges that are
+        each fetched with one read and decoded with numpy.frombuffer, by default cells less than
+        one filesystem block apart are merged because reading the gap is cheaper than a new request """
+    if gap is None:
+        gap = filesystem_blocksize(filename) // 4
+    indices = np.asarray(indices, dtype=np.int64)
+    cells, inverse = np.unique(indices, return_inverse=True)
+    starts, ends, range_ids = plan_ranges(cells, gap)
+    lengths = ends - starts + 1
+    if len(cells) and cells[-1] - cells[0] + 1 <= 2 * lengths.sum():
+        # the ranges cover most of the span, one large read is cheaper than many small ones
+        starts, ends, range_ids = cells[:1], cells[-1:], np.zeros(len(cells), dtype=np.int64)
+        lengths = ends - starts + 1
+    buffer_starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    buf = bytearray(int(lengths.sum()) * 4)
+    view = memoryview(buf)
+    with open(filename, 'rb') as f:
+        for start, length, buffer_start in zip(starts.tolist(), lengths.tolist(), buffer_starts.tolist()):
+            n = _read_range(f, view[buffer_start*4:(buffer_start+length)*4], start*4)
+            if n != length*4:
+                raise IndexError('cell index out of range for %s' % filename)
+    values = np.frombuffer(buf, dtype='<i4')
+    positions = buffer_starts[range_ids] + (cells - starts[range_ids])
+    return nodata_to_nan(values[positions][inverse.reshape(-1)], masked)
+
+
+def write_merged(filenames, outfile, ncols, names=None, dtype='<i4', nodata=NODATA, block_rows=64):
+    """ merge .sbg layers into one pixel interleaved .mbg file, block_rows rows at a time
+        so that only one block of every layer is in memory """
+    if names is None:
+        names = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    layers = [np.memmap(f, dtype='<i4', mode='r') for f in filenames]
+    ncells = len(layers[0])
+    for filename, layer in zip(filenames, layers):
+        if len(layer) != ncells:
+            raise ValueError('%s has %d cells instead of %d like %s' % (filename, len(layer), ncells, filenames[0]))
+    if ncells % ncols:
+        raise ValueError('%d cells are not a whole number of rows of %d columns' % (ncells, ncols))
+    nrows = ncells // ncols
+    header = json.dumps({'names': names, 'dtype': np.dtype(dtype).str, 'nrows': nrows,
+                         'ncols': ncols, 'nodata': nodata}).encode('utf-8')
+    offset = -(-(len(MBG_MAGIC) + 4 + len(header)) // 64) * 64  # data starts 64 byte aligned
+    block = np.empty((block_rows * ncols, len(layers)), dtype=dtype)
+    with open(outfile, 'wb') as f:
+        f.write(MBG_MAGIC + struct.pack('<I', offset) + header)
+        f.write(b'\0' * (offset - f.tell()))
+        for start in range(0, ncells, block_rows * ncols):
+            end = min(start + block_rows * ncols, ncells)
+            out = block[:end-start]
+            for j, layer in enumerate(layers):
+                out[:, j] = layer[start:end]
+            f.write(out.tobytes())
+    return outfile
+
+
+def merge_dir(dirname, ncols, outfile=None, **kwargs):
+    filenames = sorted(glob.glob(os.path.join(dirname, '*.sbg')))
+    outfile = outfile or os.path.join(dirname, 'merged.mbg')
+    return write_merged(filenames, outfile, ncols, **kwargs)
+
+
+def read_merged_header(filename):
+    with open(filename, 'rb') as f:
+        magic, offset = struct.unpack('<4sI', f.read(8))
+        if magic != MBG_MAGIC:
+            raise ValueError('%s is not a .mbg file' % filename)
+        header = json.loads(f.read(offset - 8).rstrip(b'\0').decode('utf-8'))
+    header['offset'] = offset
+    return header
+
+
+def open_merged(filename):
+    """ memory map a .mbg file as an (ncells x nlayers) array, returns (header, grid) """
+    merged = _merged.get(filename)
+    if merged is None:
+        header = read_merged_header(filename)
+        grid = np.memmap(filename, dtype=header['dtype'], mode='r', offset=header['offset'],
+                         shape=(header['nrows'] * header['ncols'], len(header['names'])))
+        merged = _merged[filename] = (header, grid)
+    return merged
+
+
+def read_merged(filename, indices, masked=False):
+    """ values of all layers for the given cells as an (n_points x n_layers) array
+        read from a .mbg file in one pass """
+    header, grid = open_merged(filename)
+    values = grid[np.asarray(indices, dtype=np.int64)]
+    return nodata_to_nan(values, masked, header['nodata'])
+
+
+def read_points(source, indices, masked=False):
+    """ (n_points x n_layers) values from either a .mbg file or a list of .sbg files """
+    if isinstance(source, str) and source.endswith('.mbg'):
+        return read_merged(source, indices, masked)
+    return read_layers(source, indices, masked)
+
+
 def getindices(n):
     return [10000+(i*3) for i in range(n)]
 
@@ -34,14 +270,126 @@ def timefn(method):
 
 @timefn
 def allmarspec(outer, inner):
-    paths = glob.glob(r'D:\temp\sbg_10m\*.sbg')
+    paths = glob.glob(os.path.join(SBG_DIR, '*.sbg'))
+    indices = getindices(inner)
+    r = []
+    for i in range(outer):
+        r = [read_values(os.path.join(SBG_DIR, path), indices) for path in paths]
+    return r
+
+
+@timefn
+def allmarspec_mmap(outer, inner):
+    paths = sorted(glob.glob(os.path.join(SBG_DIR, '*.sbg')))
+    indices = getindices(inner)
+    r = None
+    for i in range(outer):
+        r = read_layers(paths, indices)
+    return r
+
+
+@timefn
+def allmarspec_batched(outer, inner):
+    paths = sorted(glob.glob(os.path.join(SBG_DIR, '*.sbg')))
     indices = getindices(inner)
     r = []
     for i in range(outer):
-        r = [read_values(os.path.join(r'D:\temp\sbg_10m', path), indices) for path in paths]
+        r = [read_values_batched(path, indices) for path in paths]
+    return r
+
+
+@timefn
+def allmergedmarspec(outer, inner):
+    path = os.path.join(SBG_DIR, 'merged.mbg')
+    indices = getindices(inner)
+    r = None
+    for i in range(outer):
+        r = read_merged(path, indices)
     return r
 
+
+import unittest
+import tempfile
+class Test_binreader(unittest.TestCase):
+    def setUp(self):
+        self.initial = np.array([NODATA, NODATA+1, 2147483647, NODATA, 0, 1, -1, NODATA, 2, 213, NODATA], dtype='<i4')
+        fd, self.path = tempfile.mkstemp(suffix='.sbg')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.initial.tobytes())
+
+    def tearDown(self):
+        close_grids()
+        os.remove(self.path)
+
+    def test_read_values_mmap(self):
+        indices = [4, 3, 4, 4, 2] + list(range(len(self.initial)))
+        expected = read_values(self.path, indices)
+        actual = read_values_mmap(self.path, indices, masked=True)
+        self.assertEqual(expected, actual.tolist())
+        actual = read_values_mmap(self.path, indices)
+        self.assertEqual([v is None for v in expected], np.isnan(actual).tolist())
+
+    def test_read_layers(self):
+        values = read_layers([self.path, self.path], [9, 0])
+        self.assertEqual((2, 2), values.shape)
+        self.assertEqual([213.0, 213.0], values[0].tolist())
+        self.assertTrue(np.isnan(values[1]).all())
+
+    def test_read_values_batched(self):
+        indices = [10, 4, 3, 4, 4, 2, 0]
+        expected = read_values_mmap(self.path, indices, masked=True)
+        for gap in [0, 1, 1000, None]:
+            actual = read_values_batched(self.path, indices, masked=True, gap=gap)
+            self.assertEqual(expected.tolist(), actual.tolist())
+        starts, ends, range_ids = plan_ranges(np.array([1, 2, 3, 10, 11, 30]), gap=2)
+        self.assertEqual([1, 10, 30], starts.tolist())
+        self.assertEqual([3, 11, 30], ends.tolist())
+        self.assertEqual([0, 0, 0, 1, 1, 2], range_ids.tolist())
+
+    def test_layer_pool(self):
+        pool = LayerPool(max_handles=1)
+        pool.warm([self.path])
+        self.assertEqual(213, pool.get(self.path)[9])
+        self.assertEqual({'handles': 1, 'mapped_bytes': 44, 'hits': 1, 'misses': 1, 'evictions': 0}, pool.stats())
+        other = self.path + '.other.sbg'
+        self.initial.tofile(other)
+        try:
+            self.assertEqual(213, pool.get(other)[9])
+            self.assertEqual(list(pool.layers), [other])
+            self.assertEqual(1, pool.stats()['evictions'])
+        finally:
+            pool.clear()
+            os.remove(other)
+
+    def test_merged(self):
+        fd, merged = tempfile.mkstemp(suffix='.mbg')
+        os.close(fd)
+        try:
+            write_merged([self.path, self.path], merged, ncols=1, names=['a', 'b'], block_rows=4)
+            header = read_merged_header(merged)
+            self.assertEqual(['a', 'b'], header['names'])
+            self.assertEqual((11, 1), (header['nrows'], header['ncols']))
+            indices = [9, 0, 9, 5]
+            expected = read_layers([self.path, self.path], indices, masked=True)
+            actual = read_points(merged, indices, masked=True)
+            self.assertEqual(expected.tolist(), actual.tolist())
+            ## 11 cells aren't rows of 2 columns, layers of different sizes can't be merged
+            self.assertRaises(ValueError, write_merged, [self.path], merged, ncols=2)
+            other = self.path + '.short.sbg'
+            self.initial[:10].tofile(other)
+            try:
+                self.assertRaises(ValueError, write_merged, [self.path, other], merged, ncols=1)
+            finally:
+                os.remove(other)
+        finally:
+            close_grids()
+            os.remove(merged)
+
 if __name__ == '__main__':
     allmarspec(1, 10)  # 0.01 sec
     #allmarspec(10,10000)  # <26 sec
     allmarspec(10000, 10)  # <26 sec
+    allmarspec_mmap(10000, 10)
+    allmarspec_mmap(1, 1000000)
+    allmarspec_batched(100, 1000)
+    allmergedmarspec(1, 1000000)
@@ -0,0 +1,242 @@
+""" block compressed .sbg grids (.sbz) with random access
+
+.sbz layout (little endian):
+    magic 'SBZ1', uint32 nrows, ncols, block_rows, block_cols, uint8 codec (0 none, 1 zlib, 2 lzma),
+    uint8 shuffle, 2 bytes padding, int32 nodata
+    uint64 offsets[nblocks + 1]: block b is stored in bytes offsets[b]:offsets[b+1] of the file
+    the compressed blocks, row major by block, every block holds the int32 cells of its (possibly
+    smaller at the edges) rows x cols window in row major order
+Blocks that only contain nodata are stored with length 0 and aren't decompressed at all. With shuffle the
+bytes of the int32 values are stored per byte plane (all lowest bytes first), which compresses much better.
+"""
+import os
+import lzma
+import zlib
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from binreader import NODATA, nodata_to_nan
+
+BLOCK_EXTENSION = '.sbz'
+MAGIC = b'SBZ1'
+HEADER = struct.Struct('<4sIIIIBB2xi')
+CODECS = {'none': 0, 'zlib': 1, 'lzma': 2}
+
+
+def _compress(data, codec, level):
+    if codec == 1:
+        return zlib.compress(data, level)
+    if codec == 2:
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def _decompress(data, codec):
+    if codec == 1:
+        return zlib.decompress(data)
+    if codec == 2:
+        return lzma.decompress(data)
+    return data
+
+
+def _encode(block, shuffle):
+    data = np.ascontiguousarray(block, dtype='<i4')
+    if shuffle:
+        return data.view(np.uint8).reshape(-1, 4).T.tobytes()
+    return data.tobytes()
+
+
+def _decode(data, shape, shuffle):
+    if shuffle:
+        return np.frombuffer(data, np.uint8).reshape(4, -1).T.copy().view('<i4').reshape(shape)
+    return np.frombuffer(data, '<i4').reshape(shape)
+
+
+def write_blocks(filename, grid, block_rows=256, block_cols=256, codec='zlib', level=6, shuffle=True,
+                 nodata=NODATA):
+    """ write a 2d int32 grid (e.g. a memory mapped .sbg) as .sbz, one band of block rows at a time """
+    nrows, ncols = grid.shape
+    codec = CODECS[codec]
+    nblocks = -(-nrows // block_rows) * -(-ncols // block_cols)
+    offsets = np.zeros(nblocks + 1, dtype='<u8')
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, nrows, ncols, block_rows, block_cols, codec, shuffle, nodata))
+        f.write(offsets.tobytes())  # filled in at the end
+        position = f.tell()
+        b = 0
+        for r in range(0, nrows, block_rows):
+            band = np.asarray(grid[r:r+block_rows])
+            for c in range(0, ncols, block_cols):
+                offsets[b] = position
+                block = band[:, c:c+block_cols]
+                if not np.all(block == nodata):
+                    data = _compress(_encode(block, shuffle), codec, level)
+                    f.write(data)
+                    position += len(data)
+                b += 1
+        offsets[b] = position
+        f.seek(HEADER.size)
+        f.write(offsets.tobytes())
+    return filename
+
+
+def sbg_to_blocks(sbg_filename, ncols, out_filename=None, **kwargs):
+    """ convert a .sbg file to .sbz (next to it by default) """
+    grid = np.memmap(sbg_filename, dtype='<i4', mode='r')
+    grid = grid.reshape(-1, ncols)
+    out_filename = out_filename or os.path.splitext(sbg_filename)[0] + BLOCK_EXTENSION
+    return write_blocks(out_filename, grid, **kwargs)
+
+
+class BlockGrid(object):
+    """ reader of a .sbz file, decoded blocks are kept in a small LRU """
+    def __init__(self, filename, cache_blocks=64):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        magic, self.nrows, self.ncols, self.block_rows, self.block_cols, self.codec, self.shuffle, self.nodata = \
+            HEADER.unpack(self.f.read(HEADER.size))
+        if magic != MAGIC:
+            self.f.close()
+            raise ValueError('%s is not a .sbz file' % filename)
+        self.blocks_across = -(-self.ncols // self.block_cols)
+        nblocks = -(-self.nrows // self.block_rows) * self.blocks_across
+        self.offsets = np.frombuffer(self.f.read(8 * (nblocks + 1)), dtype='<u8').astype(np.int64)
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()  # block id -> decoded block
+        self.hits = self.misses = 0
+
+    def _read(self, offset, size):
+        if hasattr(os, 'pread'):
+            return os.pread(self.f.fileno(), size, offset)
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def block(self, b):
+        """ decoded (rows, cols) int32 array of block b """
+        block = self.cache.get(b)
+        if block is not None:
+            self.cache.move_to_end(b)
+            self.hits += 1
+            return block
+        self.misses += 1
+        r, c = divmod(b, self.blocks_across)
+        shape = (min(self.block_rows, self.nrows - r * self.block_rows),
+                 min(self.block_cols, self.ncols - c * self.block_cols))
+        start, end = self.offsets[b], self.offsets[b + 1]
+        if start == end:
+            block = np.full(shape, self.nodata, dtype=np.int32)
+        else:
+            block = _decode(_decompress(self._read(int(start), int(end - start)), self.codec), shape, self.shuffle)
+        self.cache[b] = block
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return block
+
+    def read(self, indices):
+        """ int32 values of cell indices (row * ncols + col) in any order, every touched block is decoded once """
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.nrows * self.ncols):
+            raise IndexError('cell index out of range for %s' % self.filename)
+        rows, cols = np.divmod(indices.ravel(), self.ncols)
+        block_rows, in_rows = np.divmod(rows, self.block_rows)
+        block_cols, in_cols = np.divmod(cols, self.block_cols)
+        blocks = block_rows * self.blocks_across + block_cols
+        order = np.argsort(blocks, kind='stable')
+        unique, starts = np.unique(blocks[order], return_index=True)
+        values = np.empty(len(blocks), dtype=np.int32)
+        for b, start, end in zip(unique.tolist(), starts.tolist(), np.r_[starts[1:], len(order)].tolist()):
+            points = order[start:end]
+            values[points] = self.block(b)[in_rows[points], in_cols[points]]
+        return values.reshape(indices.shape)
+
+    def read_rows(self, start, stop):
+        """ rows start:stop as a (stop - start, ncols) int32 array """
+        out = np.empty((stop - start, self.ncols), dtype=np.int32)
+        for r in range(start // self.block_rows, (stop - 1) // self.block_rows + 1):
+            r0, r1 = max(start, r * self.block_rows), min(stop, (r + 1) * self.block_rows)
+            for c in range(self.blocks_across):
+                block = self.block(r * self.blocks_across + c)
+                out[r0-start:r1-start, c*self.block_cols:c*self.block_cols+block.shape[1]] = \
+                    block[r0-r*self.block_rows:r1-r*self.block_rows]
+        return out
+
+    def close(self):
+        self.cache.clear()
+        self.f.close()
+
+
+_cache = {}  # filename -> BlockGrid
+
+
+def open_blocks(filename, cache_blocks=64):
+    if filename not in _cache:
+        _cache[filename] = BlockGrid(filename, cache_blocks)
+    return _cache[filename]
+
+
+def close_blocks():
+    for grid in _cache.values():
+        grid.close()
+    _cache.clear()
+
+
+def read_values_blocks(filename, indices, masked=False):
+    """ same as binreader.read_values_mmap but for a .sbz file """
+    return nodata_to_nan(open_blocks(filename).read(indices), masked)
+
+
+def read_values(filename, indices):
+    """ same as binreader.read_values but for a .sbz file: a list with None for nodata """
+    values = open_blocks(filename).read(indices).tolist()
+    return [None if v == NODATA else v for v in values]
+
+
+import unittest
+import tempfile
+import shutil
+class Test_blockgrid(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(2)
+        self.grid = rng.randint(-1000, 1000, size=(70, 90)).astype('<i4')
+        self.grid[:40, :50] = NODATA  # whole blocks of nodata
+        self.sbg = os.path.join(self.dir, 'layer.sbg')
+        self.grid.tofile(self.sbg)
+
+    def tearDown(self):
+        close_blocks()
+        shutil.rmtree(self.dir)
+
+    def test_read_values(self):
+        indices = np.random.RandomState(3).randint(0, self.grid.size, 500)
+        expected = self.grid.ravel()[indices]
+        for codec in CODECS:
+            for shuffle in (True, False):
+                path = sbg_to_blocks(self.sbg, 90, os.path.join(self.dir, '%s%d.sbz' % (codec, shuffle)),
+                                     block_rows=16, block_cols=20, codec=codec, shuffle=shuffle)
+                self.assertEqual(expected.tolist(), open_blocks(path).read(indices).tolist())
+                self.assertEqual(self.grid[5:37].tolist(), open_blocks(path).read_rows(5, 37).tolist())
+        values = read_values(path, [0, 89, 40 * 90 + 50])
+        self.assertEqual([None, self.grid[0, 89], self.grid[40, 50]], values)
+        masked = read_values_blocks(path, [[0, 89]], masked=True)
+        self.assertEqual((1, 2), masked.shape)
+        self.assertTrue(masked.mask[0, 0] and not masked.mask[0, 1])
+
+    def test_nodata_blocks_and_lru(self):
+        path = sbg_to_blocks(self.sbg, 90, block_rows=20, block_cols=25)
+        grid = BlockGrid(path, cache_blocks=2)
+        self.assertEqual(0, np.diff(grid.offsets)[[0, 1, 4, 5]].sum())  # blocks inside the nodata corner
+        grid.read([0, 1, 2])
+        grid.read([3, 89])
+        self.assertEqual((1, 2), (grid.hits, grid.misses))
+        grid.read([89, 90 * 69])
+        self.assertEqual(2, len(grid.cache))
+        for indices in ([-1], [0, 70 * 90]):
+            self.assertRaises(IndexError, grid.read, indices)
+        self.assertEqual((0,), grid.read([]).shape)
+        grid.close()
+
+if __name__ == '__main__':
+    unittest.main()
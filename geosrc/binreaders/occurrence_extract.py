@@ -0,0 +1,316 @@
+""" values of all environmental layers for every record of an occurrence csv (species,longitude,latitude)
+
+The csv is read chunk_rows records at a time. Longitudes and latitudes are converted to cell indices of a
+lon/lat grid (north row first, as the .sbg layers) in one vectorized step, every chunk is reduced to its
+unique cells and only cells that aren't in the cell cache are read, all layers at once. The values are
+scattered back to the records and appended to the output, so memory use is bounded by the chunk size and
+the cache size and not by the number of records.
+Outputs: .csv (the input columns followed by one column per layer, empty for nodata), .npy (an
+(n_records x n_layers) array) or .npz (cells, longitude, latitude, values and the layer names).
+Usage: python occurrence_extract.py occurrences.csv layer_dir output.csv [ncols]
+"""
+import os
+import csv
+import glob
+import time
+import zipfile
+import tempfile
+import shutil
+from itertools import islice
+
+import numpy as np
+
+from binreader import read_layers, read_merged, read_merged_header
+
+NCOLS = 2160  # 10 arc minutes global grid of sbg_10m
+EXTENT = (-180.0, -90.0, 180.0, 90.0)
+
+
+def cell_indices(lon, lat, ncols=NCOLS, nrows=None, extent=EXTENT):
+    """ row * ncols + col of the cells containing the points, -1 outside the grid or for nan coordinates,
+        points on the east and south edge belong to the last column and row """
+    nrows = nrows or ncols // 2
+    xmin, ymin, xmax, ymax = extent
+    lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        inside = (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+    cols = np.minimum(((np.where(inside, lon, xmin) - xmin) * (ncols / (xmax - xmin))).astype(np.int64), ncols - 1)
+    rows = np.minimum(((ymax - np.where(inside, lat, ymax)) * (nrows / (ymax - ymin))).astype(np.int64), nrows - 1)
+    return np.where(inside, rows * ncols + cols, -1)
+
+
+def open_layers(source):
+    """ (names, read) of a .mbg, a .qbg, a directory of .sbg files or a list of .sbg/.sbz files,
+        read(indices) returns the (n_points x n_layers) values with nan for nodata """
+    if isinstance(source, str) and source.endswith('.mbg'):
+        return read_merged_header(source)['names'], lambda indices: read_merged(source, indices)
+    if isinstance(source, str) and source.endswith('.qbg'):
+        from quantgrid import read_quantized, read_quantized_header
+        return [l['name'] for l in read_quantized_header(source)['layers']], lambda indices: read_quantized(source, indices)
+    filenames = sorted(glob.glob(os.path.join(source, '*.sbg'))) if isinstance(source, str) else list(source)
+    names = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    if any(f.endswith('.sbz') for f in filenames):
+        from blockgrid import read_values_blocks
+        from binreader import read_values_mmap
+
+        def read(indices):
+            return np.stack([read_values_blocks(f, indices) if f.endswith('.sbz') else read_values_mmap(f, indices)
+                             for f in filenames], axis=1)
+        return names, read
+    return names, lambda indices: read_layers(filenames, indices)
+
+
+class CellCache(object):
+    """ values of the cells read so far as sorted cell indices and their rows of values,
+        emptied when it would grow beyond max_cells """
+    def __init__(self, nlayers, max_cells=1 << 20, dtype=np.float64):
+        self.max_cells = max_cells
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros((0, nlayers), dtype=dtype)
+        self.reads = 0
+
+    def lookup(self, cells, read):
+        """ values of the sorted unique cells, only the missing ones are read """
+        position = np.minimum(np.searchsorted(self.cells, cells), max(len(self.cells) - 1, 0))
+        found = (self.cells[position] == cells) if len(self.cells) else np.zeros(len(cells), dtype=bool)
+        values = np.empty((len(cells), self.values.shape[1]), dtype=self.values.dtype)
+        values[found] = self.values[position[found]]
+        missing = cells[~found]
+        if len(missing):
+            values[~found] = read(missing)
+            self.reads += len(missing)
+            if len(self.cells) + len(missing) > self.max_cells:
+                self.cells, self.values = cells[:self.max_cells], values[:self.max_cells]
+            else:
+                cached = np.concatenate([self.cells, missing])
+                order = np.argsort(cached, kind='stable')
+                self.cells, self.values = cached[order], np.concatenate([self.values, values[~found]])[order]
+        return values
+
+
+def _floats(values):
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        result = np.empty(len(values))
+        for i, v in enumerate(values):
+            try:
+                result[i] = float(v)
+            except ValueError:
+                result[i] = np.nan
+        return result
+
+
+def read_chunks(filename, lon_column='longitude', lat_column='latitude', chunk_rows=1 << 20):
+    """ (header, rows, lon, lat, skipped) per chunk of a csv, unparsable coordinates are nan,
+        rows too short to have both coordinates are left out and counted in skipped """
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i, j = header.index(lon_column), header.index(lat_column)
+        width = max(i, j) + 1
+        while True:
+            rows = [row for row in islice(reader, chunk_rows) if row]
+            if not rows:
+                break
+            complete = [row for row in rows if len(row) >= width]
+            yield (header, complete, _floats([row[i] for row in complete]), _floats([row[j] for row in complete]),
+                   len(rows) - len(complete))
+
+
+def _npy_header(dtype, shape, size=128):
+    """ a .npy version 1.0 header of a fixed size, so it can be rewritten when the number of rows is known """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    prefix = b'\x93NUMPY\x01\x00' + np.array(size - 10, dtype='<u2').tobytes()
+    return prefix + header.ljust(size - 11).encode('latin1') + b'\n'
+
+
+class NpyWriter(object):
+    """ append rows to a .npy file, the shape in the header is set on close """
+    def __init__(self, filename, dtype, columns=None):
+        self.filename, self.dtype, self.columns = filename, np.dtype(dtype), columns
+        self.rows = 0
+        self.f = open(filename, 'wb')
+        self.f.write(_npy_header(self.dtype, self.shape()))
+
+    def shape(self):
+        return (self.rows,) if self.columns is None else (self.rows, self.columns)
+
+    def write(self, values):
+        self.f.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        self.rows += len(values)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(_npy_header(self.dtype, self.shape()))
+        self.f.close()
+
+
+class NpzWriter(object):
+    """ cells, longitude, latitude and values written as .npy files in a temporary directory and stored
+        in a .npz (zip) on close """
+    def __init__(self, filename, names, dtype):
+        self.filename, self.names = filename, names
+        self.dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+        self.arrays = {'cells': NpyWriter(os.path.join(self.dir, 'cells.npy'), np.int64),
+                       'longitude': NpyWriter(os.path.join(self.dir, 'longitude.npy'), np.float64),
+                       'latitude': NpyWriter(os.path.join(self.dir, 'latitude.npy'), np.float64),
+                       'values': NpyWriter(os.path.join(self.dir, 'values.npy'), dtype, len(names))}
+
+    def write(self, rows, lon, lat, cells, values):
+        for name, array in (('cells', cells), ('longitude', lon), ('latitude', lat), ('values', values)):
+            self.arrays[name].write(array)
+
+    def close(self):
+        try:
+            np.save(os.path.join(self.dir, 'names.npy'), np.array(self.names))
+            with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+                for name, writer in self.arrays.items():
+                    writer.close()
+                    z.write(writer.filename, name + '.npy')
+                z.write(os.path.join(self.dir, 'names.npy'), 'names.npy')
+        finally:
+            shutil.rmtree(self.dir)
+
+
+class CsvWriter(object):
+    """ the input records followed by the layer values, empty for nodata """
+    def __init__(self, filename, header, names):
+        self.f = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(list(header) + list(names))
+
+    def write(self, rows, lon, lat, cells, values):
+        text = np.char.mod('%.10g', values).tolist()
+        nodata = np.isnan(values).tolist()
+        self.writer.writerows(row + ['' if n else t for t, n in zip(texts, nans)]
+                              for row, texts, nans in zip(rows, text, nodata))
+
+    def close(self):
+        self.f.close()
+
+
+class _NpyValues(NpyWriter):
+    def __init__(self, filename, names, dtype):
+        NpyWriter.__init__(self, filename, dtype, len(names))
+
+    def write(self, rows, lon, lat, cells, values):
+        NpyWriter.write(self, values)
+
+
+def _writer(output, header, names, dtype):
+    extension = os.path.splitext(output)[1].lower()
+    if extension == '.npy':
+        return _NpyValues(output, names, dtype)
+    if extension == '.npz':
+        return NpzWriter(output, names, dtype)
+    return CsvWriter(output, header, names)
+
+
+def extract(occurrences, source, output, ncols=NCOLS, nrows=None, extent=EXTENT, lon_column='longitude',
+            lat_column='latitude', chunk_rows=1 << 20, cache_cells=1 << 20, dtype=np.float64):
+    """ write the values of all layers of source (see open_layers) for every record of the occurrences csv
+        to output (.csv, .npy or .npz), returns a dict with the number of records, rows skipped because they
+        are too short, unique cells per chunk, cells read from the layers and seconds """
+    start = time.time()
+    names, read = open_layers(source)
+    cache = CellCache(len(names), cache_cells, dtype)
+    writer = None
+    records = unique_cells = skipped = 0
+    try:
+        for header, rows, lon, lat, short in read_chunks(occurrences, lon_column, lat_column, chunk_rows):
+            if writer is None:
+                writer = _writer(output, header, names, dtype)
+            skipped += short
+            cells = cell_indices(lon, lat, ncols, nrows, extent)
+            unique, inverse = np.unique(cells, return_inverse=True)
+            values = np.full((len(unique), len(names)), np.nan, dtype=dtype)
+            valid = unique >= 0
+            if valid.any():
+                values[valid] = cache.lookup(unique[valid], read)
+            writer.write(rows, lon, lat, cells, values[inverse.reshape(-1)])
+            records += len(rows)
+            unique_cells += int(valid.sum())
+        if writer is None:
+            writer = _writer(output, [lon_column, lat_column], names, dtype)
+    finally:
+        if writer is not None:
+            writer.close()
+    return {'records': records, 'skipped': skipped, 'unique_cells': unique_cells, 'reads': cache.reads,
+            'seconds': time.time() - start}
+
+
+import unittest
+from binreader import NODATA, write_merged, close_grids
+class Test_occurrence_extract(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.grids = [np.arange(32, dtype='<i4').reshape(4, 8), np.arange(32, dtype='<i4').reshape(4, 8) * -10]
+        self.grids[1][0, 0] = NODATA
+        self.layers = []
+        for name, grid in zip(('depth', 'sst'), self.grids):
+            path = os.path.join(self.dir, name + '.sbg')
+            grid.tofile(path)
+            self.layers.append(path)
+        self.csv = os.path.join(self.dir, 'occurrences.csv')
+        self.points = [(-179.0, 89.0), (10.0, 10.0), (10.0, 10.0), (181.0, 0.0), (180.0, -90.0),
+                       (-100.0, -50.0), (10.5, 11.0), (-179.5, 80.0)]
+        with open(self.csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['species', 'longitude', 'latitude'])
+            writer.writerows(['Alaria esculenta', lon, lat] for lon, lat in self.points)
+            writer.writerow(['Alaria esculenta', '', 'NA'])
+            writer.writerow(['Alaria esculenta', '12.5'])  # too short, skipped
+
+    def tearDown(self):
+        close_grids()
+        shutil.rmtree(self.dir)
+
+    def expected(self):
+        cells = [0, 8 + 4, 8 + 4, -1, 31, 3 * 8 + 1, 8 + 4, 0, -1]
+        values = np.array([[g.ravel()[c] if c >= 0 else NODATA for g in self.grids] for c in cells], dtype=np.float64)
+        values[values == NODATA] = np.nan
+        return cells, values
+
+    def test_cell_indices(self):
+        lon, lat = zip(*self.points)
+        self.assertEqual(self.expected()[0][:-1], cell_indices(lon, lat, 8).tolist())
+        self.assertEqual([-1], cell_indices([np.nan], [0.0], 8).tolist())
+
+    def test_extract(self):
+        cells, expected = self.expected()
+        merged = write_merged(self.layers, os.path.join(self.dir, 'merged.mbg'), 8)
+        for source in (self.layers, self.dir, merged):
+            output = os.path.join(self.dir, 'out.npz')
+            stats = extract(self.csv, source, output, ncols=8, chunk_rows=3, cache_cells=2)
+            self.assertEqual(9, stats['records'])
+            self.assertEqual(1, stats['skipped'])
+            self.assertTrue(stats['reads'] < 7)
+            with np.load(output) as result:
+                self.assertEqual(['depth', 'sst'], result['names'].tolist())
+                self.assertEqual(cells, result['cells'].tolist())
+                self.assertTrue(np.array_equal(expected, result['values'], equal_nan=True))
+        stats = extract(self.csv, self.layers, os.path.join(self.dir, 'out.npy'), ncols=8, chunk_rows=4,
+                        dtype=np.float32)
+        self.assertEqual(4, stats['reads'])  # cells 0, 12, 31 and 25, each read once
+        values = np.load(os.path.join(self.dir, 'out.npy'))
+        self.assertEqual(np.float32, values.dtype)
+        self.assertTrue(np.array_equal(expected, values, equal_nan=True))
+
+    def test_csv_output(self):
+        output = os.path.join(self.dir, 'out.csv')
+        extract(self.csv, self.dir, output, ncols=8, chunk_rows=2)
+        with open(output, newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(['species', 'longitude', 'latitude', 'depth', 'sst'], rows[0])
+        self.assertEqual(['Alaria esculenta', '-179.0', '89.0', '0', ''], rows[1])
+        self.assertEqual(['12', '-120'], rows[2][3:])
+        self.assertEqual(['', ''], rows[4][3:])
+        self.assertEqual(10, len(rows))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 3:
+        print(extract(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else NCOLS))
+    else:
+        unittest.main()
@@ -0,0 +1,258 @@
+""" quantized layers (.qbg): int32 .sbg values stored as uint8 or int16 with a scale and offset per layer
+
+.qbg layout: magic 'QBG1', uint32 data offset, a JSON header (padded with zeros so the data starts 64 byte
+aligned) and the (ncells x nlayers) pixel interleaved codes. One layer is the same as a .sbg in half or a
+quarter of the bytes, several layers are the same as a .mbg. The header holds the code dtype, the nodata
+code and per layer the name, scale, offset and the maximum absolute error of value = code * scale + offset.
+The converter picks the narrowest dtype for which every layer stays within max_error (0 means lossless).
+"""
+import os
+import glob
+import json
+import struct
+
+import numpy as np
+
+from binreader import NODATA
+
+QBG_MAGIC = b'QBG1'
+## dtype -> (lowest code, highest code, nodata code)
+CODES = {'|u1': (0, 254, 255), '<i2': (-32767, 32767, -32768), '<i4': (-2147483647, 2147483647, NODATA)}
+DTYPES = ('|u1', '<i2', '<i4')
+
+_quantized = {}  # filename -> (header, memory mapped codes)
+
+
+def layer_range(layer, nodata=NODATA, block=1 << 22):
+    """ (min, max) of the data values of an int32 layer, None when there are none """
+    low, high = None, None
+    for start in range(0, len(layer), block):
+        values = np.asarray(layer[start:start+block])
+        values = values[values != nodata]
+        if len(values):
+            low = int(values.min()) if low is None else min(low, int(values.min()))
+            high = int(values.max()) if high is None else max(high, int(values.max()))
+    return (low, high) if low is not None else None
+
+
+def quantization(value_range, dtype):
+    """ (scale, offset, max_error) to store values of value_range as codes of dtype,
+        integers that fit the code range are stored without loss """
+    lowest, highest, _ = CODES[np.dtype(dtype).str]
+    if value_range is None:
+        return 1.0, 0.0, 0.0
+    low, high = value_range
+    if lowest <= low and high <= highest:
+        return 1.0, 0.0, 0.0
+    if high - low <= highest - lowest:
+        return 1.0, float(low - lowest), 0.0
+    scale = (high - low) / float(highest - lowest)
+    return scale, low - lowest * scale, scale / 2
+
+
+def choose_dtype(value_ranges, max_error=0.0, dtypes=DTYPES):
+    """ narrowest dtype for which all layers stay within max_error (a number or one per layer) """
+    if np.isscalar(max_error):
+        max_error = [max_error] * len(value_ranges)
+    for dtype in dtypes:
+        if all(quantization(r, dtype)[2] <= e for r, e in zip(value_ranges, max_error)):
+            return np.dtype(dtype).str
+    return np.dtype(dtypes[-1]).str
+
+
+def quantize(values, scale, offset, dtype, nodata=NODATA):
+    """ codes of int32 values, nodata becomes the nodata code of dtype """
+    lowest, highest, code_nodata = CODES[np.dtype(dtype).str]
+    codes = np.subtract(values, offset, dtype=np.float64)
+    codes /= scale
+    np.rint(codes, out=codes)
+    np.clip(codes, lowest, highest, out=codes)
+    codes = codes.astype(dtype)
+    codes[values == nodata] = code_nodata
+    return codes
+
+
+def dequantize(codes, scale, offset, nodata_code, out=None):
+    """ float32 values of codes, nan for the nodata code, computed in float64 so that large offsets don't
+        cost precision """
+    values = codes * scale
+    values += offset
+    values[codes == nodata_code] = np.nan
+    if out is None:
+        return values.astype(np.float32)
+    out[...] = values
+    return out
+
+
+def write_quantized(filenames, outfile, ncols, max_error=0.0, names=None, dtype=None, nodata=NODATA,
+                    block_rows=64):
+    """ quantize .sbg layers into one .qbg file, block_rows rows at a time, dtype is chosen from max_error
+        (absolute error in the units of the .sbg values, a number or one per layer) unless given """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    if names is None:
+        names = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    layers = [np.memmap(f, dtype='<i4', mode='r') for f in filenames]
+    ncells = len(layers[0])
+    for filename, layer in zip(filenames, layers):
+        if len(layer) != ncells:
+            raise ValueError('%s has %d cells instead of %d like %s' % (filename, len(layer), ncells, filenames[0]))
+    if ncells % ncols:
+        raise ValueError('%d cells are not a whole number of rows of %d columns' % (ncells, ncols))
+    ranges = [layer_range(layer, nodata) for layer in layers]
+    dtype = np.dtype(dtype).str if dtype else choose_dtype(ranges, max_error)
+    params = [quantization(r, dtype) for r in ranges]
+    header = json.dumps({'dtype': dtype, 'nodata': CODES[dtype][2], 'nrows': ncells // ncols, 'ncols': ncols,
+                         'layers': [{'name': name, 'scale': scale, 'offset': offset, 'max_error': error}
+                                    for name, (scale, offset, error) in zip(names, params)]}).encode('utf-8')
+    offset = -(-(len(QBG_MAGIC) + 4 + len(header)) // 64) * 64
+    block = np.empty((block_rows * ncols, len(layers)), dtype=dtype)
+    with open(outfile, 'wb') as f:
+        f.write(QBG_MAGIC + struct.pack('<I', offset) + header)
+        f.write(b'\0' * (offset - f.tell()))
+        for start in range(0, ncells, block_rows * ncols):
+            end = min(start + block_rows * ncols, ncells)
+            out = block[:end-start]
+            for j, (layer, (scale, layer_offset, _)) in enumerate(zip(layers, params)):
+                out[:, j] = quantize(layer[start:end], scale, layer_offset, dtype, nodata)
+            f.write(out.tobytes())
+    return outfile
+
+
+def quantize_dir(dirname, ncols, outfile=None, max_error=0.0, **kwargs):
+    filenames = sorted(glob.glob(os.path.join(dirname, '*.sbg')))
+    outfile = outfile or os.path.join(dirname, 'merged.qbg')
+    return write_quantized(filenames, outfile, ncols, max_error, **kwargs)
+
+
+def read_quantized_header(filename):
+    with open(filename, 'rb') as f:
+        magic, offset = struct.unpack('<4sI', f.read(8))
+        if magic != QBG_MAGIC:
+            raise ValueError('%s is not a .qbg file' % filename)
+        header = json.loads(f.read(offset - 8).rstrip(b'\0').decode('utf-8'))
+    header['offset'] = offset
+    return header
+
+
+def open_quantized(filename):
+    """ memory map a .qbg file as an (ncells x nlayers) array of codes, returns (header, codes) """
+    quantized = _quantized.get(filename)
+    if quantized is None:
+        header = read_quantized_header(filename)
+        codes = np.memmap(filename, dtype=header['dtype'], mode='r', offset=header['offset'],
+                          shape=(header['nrows'] * header['ncols'], len(header['layers'])))
+        quantized = _quantized[filename] = (header, codes)
+    return quantized
+
+
+def close_quantized():
+    _quantized.clear()
+
+
+def read_quantized(filename, indices, layers=None, masked=False):
+    """ float32 values of all (or the given) layers for the given cells as an (n_points x n_layers) array,
+        read from the .qbg file in one pass """
+    header, codes = open_quantized(filename)
+    indices = np.asarray(indices, dtype=np.int64)
+    columns = range(len(header['layers'])) if layers is None else [
+        header_index(header, layer) for layer in layers]
+    values = np.empty((len(indices), len(columns)), dtype=np.float32)
+    selected = codes[indices]
+    for j, column in enumerate(columns):
+        layer = header['layers'][column]
+        dequantize(selected[:, column], layer['scale'], layer['offset'], header['nodata'], out=values[:, j])
+    return np.ma.masked_invalid(values, copy=False) if masked else values
+
+
+def header_index(header, layer):
+    """ column of a layer given by name or number """
+    if isinstance(layer, str):
+        return [l['name'] for l in header['layers']].index(layer)
+    return layer
+
+
+def read_values_quantized(filename, indices, masked=False):
+    """ same as binreader.read_values_mmap for a single layer .qbg file but float32 """
+    return read_quantized(filename, indices, [0], masked)[:, 0]
+
+
+def read_quantized_rows(filename, start, stop, layer=0):
+    """ float32 rows start:stop of one layer as an (stop - start, ncols) array """
+    header, codes = open_quantized(filename)
+    column = header_index(header, layer)
+    ncols = header['ncols']
+    info = header['layers'][column]
+    return dequantize(codes[start*ncols:stop*ncols, column], info['scale'], info['offset'],
+                      header['nodata']).reshape(-1, ncols)
+
+
+import unittest
+import tempfile
+import shutil
+class Test_quantgrid(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(4)
+        self.layers = {
+            'aspect': rng.randint(0, 360, size=(30, 40)),  # fits uint8 only with loss, int16 lossless
+            'flags': rng.randint(-3, 100, size=(30, 40)),  # fits uint8 lossless
+            'sst': rng.randint(-2000, 300000, size=(30, 40)),  # needs int32 to be lossless
+        }
+        self.paths = []
+        for name, grid in sorted(self.layers.items()):
+            grid = grid.astype('<i4')
+            grid[0, :3] = NODATA
+            self.layers[name] = grid
+            path = os.path.join(self.dir, name + '.sbg')
+            grid.tofile(path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        close_quantized()
+        shutil.rmtree(self.dir)
+
+    def expected(self, name, indices):
+        values = self.layers[name].ravel()[indices].astype(np.float64)
+        values[values == NODATA] = np.nan
+        return values
+
+    def test_dtype_choice(self):
+        for name, max_error, dtype in (('flags', 0, '|u1'), ('aspect', 0, '<i2'), ('aspect', 1, '|u1'),
+                                       ('sst', 0, '<i4'), ('sst', 5, '<i2')):
+            path = write_quantized(os.path.join(self.dir, name + '.sbg'), os.path.join(self.dir, 'q.qbg'),
+                                   40, max_error)
+            close_quantized()
+            header = read_quantized_header(path)
+            self.assertEqual(dtype, header['dtype'], name)
+            self.assertEqual(name, header['layers'][0]['name'])
+            self.assertTrue(header['layers'][0]['max_error'] <= max_error)
+            self.assertEqual(os.path.getsize(path), header['offset'] + 1200 * np.dtype(dtype).itemsize)
+            indices = np.arange(1200)
+            values = read_values_quantized(path, indices)
+            self.assertEqual(np.float32, values.dtype)
+            expected = self.expected(name, indices)
+            self.assertTrue(np.array_equal(np.isnan(expected), np.isnan(values)))
+            error = np.nanmax(np.abs(values - expected))
+            self.assertTrue(error <= max_error + np.nanmax(np.abs(expected)) * 1e-7, (name, error))
+            self.assertTrue(np.allclose(read_quantized_rows(path, 10, 12), values[400:480].reshape(2, 40),
+                                        equal_nan=True))
+
+    def test_merged(self):
+        path = quantize_dir(self.dir, 40, max_error=[1, 0, 5])  # aspect, flags, sst
+        header = read_quantized_header(path)
+        self.assertEqual('<i2', header['dtype'])
+        self.assertEqual(['aspect', 'flags', 'sst'], [l['name'] for l in header['layers']])
+        indices = [5, 0, 1199, 5, 700]
+        values = read_quantized(path, indices)
+        self.assertEqual((5, 3), values.shape)
+        for j, (name, error) in enumerate((('aspect', 1), ('flags', 0), ('sst', 5))):
+            expected = self.expected(name, indices)
+            self.assertTrue(np.allclose(expected, values[:, j], atol=error + 1, equal_nan=True))
+        self.assertTrue(np.array_equal(values[:, [2]], read_quantized(path, indices, ['sst']), equal_nan=True))
+        self.assertRaises(ValueError, write_quantized, self.paths, path, 41)
+        masked = read_quantized(path, indices, masked=True)
+        self.assertTrue(masked.mask[1].all() and not masked.mask[0].any())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+""" sparse binary grids, byte compatible with SparseReadWrite in AsciiToBin.fsx
+
+.sbm (sparse binary map): int32 nrows, int32 ncols, then per row ceil(ncols/8) bytes with one bit
+                          per cell (least significant bit first), set when the cell has a value
+.sbv (sparse binary values): the int32 values of the set cells only, in cell order
+"""
+import os
+import struct
+
+import numpy as np
+
+from binreader import NODATA, nodata_to_nan
+
+BITMAP_EXTENSION = '.sbm'
+VALUES_EXTENSION = '.sbv'
+
+## number of set bits in the low k bits of byte b: _LOW_BITS[b, k]
+_LOW_BITS = np.array([[bin(b & ((1 << k) - 1)).count('1') for k in range(8)] for b in range(256)], dtype=np.uint8)
+
+
+class SparseBitmap(object):
+    """ packed bitmap with prefix counts so that a cell index maps to its offset in the .sbv in O(1):
+        row_offsets[r] is the number of set cells before row r and
+        byte_offsets[r, k] the number of set cells before byte k within row r """
+    def __init__(self, packed, ncols):
+        self.packed = packed
+        self.nrows, self.ncols = packed.shape[0], ncols
+        counts = _LOW_BITS[packed, 7] + (packed >> 7)  # popcount per byte
+        byte_offsets = np.cumsum(counts, axis=1, dtype=np.int64)
+        row_totals = byte_offsets[:, -1] if packed.shape[1] else np.zeros(self.nrows, dtype=np.int64)
+        self.count = int(row_totals.sum())
+        self.row_offsets = np.r_[0, np.cumsum(row_totals)[:-1]].astype(np.int64)
+        byte_offsets -= counts
+        self.byte_offsets = byte_offsets.astype(np.uint32 if ncols >= 65536 else np.uint16)
+
+    def sparse_index(self, cells):
+        """ (has_value, offsets) for an array of cell indices, offsets are only valid where has_value """
+        cells = np.asarray(cells, dtype=np.int64)
+        rows, cols = np.divmod(cells, self.ncols)
+        bytes_, bits = cols >> 3, cols & 7
+        b = self.packed[rows, bytes_]
+        has_value = ((b >> bits) & 1).astype(bool)
+        offsets = self.row_offsets[rows] + self.byte_offsets[rows, bytes_] + _LOW_BITS[b, bits]
+        return has_value, offsets
+
+
+def read_bitmap(filename):
+    with open(filename, 'rb') as f:
+        nrows, ncols = struct.unpack('<ii', f.read(8))
+        packed = np.fromfile(f, dtype=np.uint8, count=nrows * ((ncols + 7) // 8))
+    return SparseBitmap(packed.reshape(nrows, (ncols + 7) // 8), ncols)
+
+
+_cache = {}  # bitmap filename -> (SparseBitmap, memory mapped values)
+
+
+def open_sparse(filename):
+    """ the bitmap and values of a sparse grid, filename can have any extension """
+    base = os.path.splitext(filename)[0]
+    if base not in _cache:
+        bitmap = read_bitmap(base + BITMAP_EXTENSION)
+        values_path = base + VALUES_EXTENSION
+        if os.path.getsize(values_path):
+            values = np.memmap(values_path, dtype='<i4', mode='r')
+        else:
+            values = np.empty(0, dtype='<i4')
+        _cache[base] = (bitmap, values)
+    return _cache[base]
+
+
+def close_sparse():
+    _cache.clear()
+
+
+def read_values_sparse(filename, indices, masked=False):
+    """ same as binreader.read_values_mmap but for a .sbm/.sbv pair """
+    bitmap, values = open_sparse(filename)
+    has_value, offsets = bitmap.sparse_index(indices)
+    result = np.full(has_value.shape, NODATA, dtype=np.int32)
+    result[has_value] = values[offsets[has_value]]
+    return nodata_to_nan(result, masked)
+
+
+class SparseWriter(object):
+    """ writes a sparse grid row block by row block, the row count in the .sbm header is filled in on close """
+    def __init__(self, filename, ncols, nodata=NODATA):
+        base = os.path.splitext(filename)[0]
+        self.ncols, self.nodata, self.nrows = ncols, nodata, 0
+        self.bitmap = open(base + BITMAP_EXTENSION, 'wb')
+        self.values = open(base + VALUES_EXTENSION, 'wb')
+        self.bitmap.write(struct.pack('<ii', 0, ncols))
+
+    def write_rows(self, rows):
+        rows = np.asarray(rows).reshape(-1, self.ncols)
+        mask = rows != self.nodata
+        self.bitmap.write(np.packbits(mask, axis=1, bitorder='little').tobytes())
+        self.values.write(rows[mask].astype('<i4').tobytes())
+        self.nrows += rows.shape[0]
+
+    def close(self):
+        self.bitmap.seek(0)
+        self.bitmap.write(struct.pack('<i', self.nrows))
+        self.bitmap.close()
+        self.values.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_sparse(filename, grid, nodata=NODATA):
+    """ write a 2d grid as .sbm/.sbv """
+    grid = np.asarray(grid)
+    with SparseWriter(filename, grid.shape[1], nodata) as writer:
+        writer.write_rows(grid)
+
+
+def sbg_to_sparse(sbg_filename, ncols, block_rows=256):
+    """ convert a .sbg file to .sbm/.sbv next to it """
+    grid = np.memmap(sbg_filename, dtype='<i4', mode='r')
+    grid = grid.reshape(-1, ncols)
+    with SparseWriter(sbg_filename, ncols) as writer:
+        for start in range(0, grid.shape[0], block_rows):
+            writer.write_rows(grid[start:start+block_rows])
+    return os.path.splitext(sbg_filename)[0] + VALUES_EXTENSION
+
+
+import unittest
+import tempfile
+import shutil
+class Test_sparsegrid(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        self.grid = rng.randint(-5, 5, size=(7, 21)).astype(np.int32)
+        self.grid[self.grid < 0] = NODATA
+
+    def tearDown(self):
+        close_sparse()
+        shutil.rmtree(self.dir)
+
+    def test_fsharp_layout(self):
+        path = os.path.join(self.dir, 'a.sbv')
+        write_sparse(path, np.array([[1, NODATA, NODATA, 4, 5, NODATA, 7, 8, 9]]))
+        with open(os.path.join(self.dir, 'a.sbm'), 'rb') as f:
+            self.assertEqual(struct.pack('<ii', 1, 9) + bytes([1 + 8 + 16 + 64 + 128, 1]), f.read())
+        with open(path, 'rb') as f:
+            self.assertEqual(struct.pack('<6i', 1, 4, 5, 7, 8, 9), f.read())
+
+    def test_read_values_sparse(self):
+        path = os.path.join(self.dir, 'b.sbv')
+        write_sparse(path, self.grid)
+        indices = np.array([146, 0, 3, 3, 20, 21, 100])
+        expected = self.grid.ravel()[indices]
+        actual = read_values_sparse(path, indices, masked=True)
+        self.assertEqual(expected.tolist(), actual.filled(NODATA).tolist())
+
+if __name__ == '__main__':
+    unittest.main()
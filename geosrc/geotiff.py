@@ -11,7 +11,525 @@ https://svn.osgeo.org/metacrs/geotiff/trunk/libgeotiff/
 http://bitmiracle.com/libtiff/
 
 """
-import binascii, struct
+import os
+import struct
+import zlib
+
+import numpy as np
+
+## tiff field type -> (struct format, size in bytes)
+TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('L', 4), 5: ('L', 8), 6: ('b', 1), 7: ('B', 1),
+         8: ('h', 2), 9: ('l', 4), 10: ('l', 8), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+TAGS = {254: 'NewSubfileType', 256: 'ImageWidth', 257: 'ImageLength', 258: 'BitsPerSample', 259: 'Compression',
+        262: 'PhotometricInterpretation', 273: 'StripOffsets', 277: 'SamplesPerPixel', 278: 'RowsPerStrip',
+        279: 'StripByteCounts', 282: 'XResolution', 283: 'YResolution', 284: 'PlanarConfiguration',
+        296: 'ResolutionUnit', 317: 'Predictor', 322: 'TileWidth', 323: 'TileLength', 324: 'TileOffsets',
+        325: 'TileByteCounts', 339: 'SampleFormat', 33550: 'ModelPixelScale', 33922: 'ModelTiepoint',
+        34264: 'ModelTransformation', 34675: 'InterColorProfile', 34735: 'GeoKeyDirectory',
+        34736: 'GeoDoubleParams', 34737: 'GeoAsciiParams', 42113: 'GDAL_NODATA'}
+TAG_CODES = dict((name, code) for code, name in TAGS.items())
+
+GEOKEYS = {1024: 'GTModelTypeGeoKey', 1025: 'GTRasterTypeGeoKey', 1026: 'GTCitationGeoKey',
+           2048: 'GeographicTypeGeoKey', 2049: 'GeogCitationGeoKey', 2050: 'GeogGeodeticDatumGeoKey',
+           2051: 'GeogPrimeMeridianGeoKey', 2052: 'GeogLinearUnitsGeoKey', 2054: 'GeogAngularUnitsGeoKey',
+           2056: 'GeogEllipsoidGeoKey', 2057: 'GeogSemiMajorAxisGeoKey', 2058: 'GeogSemiMinorAxisGeoKey',
+           2059: 'GeogInvFlatteningGeoKey', 3072: 'ProjectedCSTypeGeoKey', 3073: 'PCSCitationGeoKey',
+           3074: 'ProjectionGeoKey', 3075: 'ProjCoordTransGeoKey', 3076: 'ProjLinearUnitsGeoKey',
+           4096: 'VerticalCSTypeGeoKey', 4099: 'VerticalUnitsGeoKey'}
+
+
+class TiffTag(object):
+    """ a directory entry, values stored outside the entry are only read on first access """
+    def __init__(self, tiff, code, type_, count, value=None, offset=None):
+        self.tiff, self.code, self.type, self.count = tiff, code, type_, count
+        self.offset = offset
+        self._value = value
+
+    @property
+    def name(self):
+        return TAGS.get(self.code, str(self.code))
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self.tiff.decode(self.type, self.count, self.tiff.read(self.offset, self.nbytes))
+        return self._value
+
+    @property
+    def nbytes(self):
+        return TYPES.get(self.type, ('B', 1))[1] * self.count
+
+
+class IFD(object):
+    """ one image file directory, tags can be looked up by code or by name """
+    def __init__(self, tiff, offset, tags):
+        self.tiff, self.offset, self.tags = tiff, offset, tags
+
+    def __contains__(self, tag):
+        return TAG_CODES.get(tag, tag) in self.tags
+
+    def __getitem__(self, tag):
+        return self.tags[TAG_CODES.get(tag, tag)].value
+
+    def get(self, tag, default=None):
+        return self[tag] if tag in self else default
+
+    @property
+    def width(self):
+        return self['ImageWidth']
+
+    @property
+    def height(self):
+        return self['ImageLength']
+
+    @property
+    def is_reduced(self):
+        """ reduced resolution version of another image in the file (an overview) """
+        return bool(self.get('NewSubfileType', 0) & 1)
+
+    @property
+    def geokeys(self):
+        if 'GeoKeyDirectory' not in self:
+            return {}
+        return parse_geokeys(self['GeoKeyDirectory'], self.get('GeoDoubleParams', ()), self.get('GeoAsciiParams', ''))
+
+    ## pixel access
+
+    def _first(self, tag, default):
+        value = self.get(tag, default)
+        return value[0] if isinstance(value, tuple) else value
+
+    @property
+    def samples(self):
+        return self.get('SamplesPerPixel', 1)
+
+    @property
+    def dtype(self):
+        bits = self._first('BitsPerSample', 1)
+        kind = {1: 'u', 2: 'i', 3: 'f'}[self._first('SampleFormat', 1)]
+        if bits % 8:
+            raise NotImplementedError('%d bits per sample is not supported' % bits)
+        return np.dtype('%s%s%d' % (self.tiff.symbol, kind, bits // 8))
+
+    @property
+    def tiled(self):
+        return 'TileWidth' in self
+
+    @property
+    def chunk_shape(self):
+        """ (rows, cols) of a tile or a strip """
+        if self.tiled:
+            return self['TileLength'], self['TileWidth']
+        return min(self.get('RowsPerStrip', self.height), self.height), self.width
+
+    def _chunk_table(self):
+        offsets = self['TileOffsets' if self.tiled else 'StripOffsets']
+        counts = self['TileByteCounts' if self.tiled else 'StripByteCounts']
+        if not isinstance(offsets, tuple):
+            offsets, counts = (offsets,), (counts,)
+        return offsets, counts
+
+    @property
+    def chunks_across(self):
+        return -(-self.width // self.chunk_shape[1])
+
+    def _check_layout(self):
+        if self.samples > 1 and self.get('PlanarConfiguration', 1) != 1:
+            raise NotImplementedError('only chunky (PlanarConfiguration 1) images are supported')
+
+    def read_chunk(self, i):
+        """ decoded strip or tile i as a (rows, cols, samples) array,
+            a view on the memory mapped file when the data is not compressed """
+        self._check_layout()
+        predictor = self.get('Predictor', 1)
+        if predictor not in (1, 2):
+            ## 3 is the floating point predictor of GDAL, its byte shuffled differences aren't undone
+            raise NotImplementedError('predictor %d is not supported' % predictor)
+        offsets, counts = self._chunk_table()
+        rows, cols = self.chunk_shape
+        if not self.tiled:
+            rows = min(rows, self.height - i * rows)
+        dtype, compression = self.dtype, self.get('Compression', 1)
+        raw = self.tiff.map()[offsets[i]:offsets[i] + counts[i]]
+        if compression == 1:
+            data = raw
+        elif compression in (8, 32946):
+            data = np.frombuffer(zlib.decompress(raw.tobytes()), dtype=np.uint8)
+        elif compression == 5:
+            data = np.frombuffer(lzw_decode(raw.tobytes()), dtype=np.uint8)
+        else:
+            raise NotImplementedError('compression %d is not supported' % compression)
+        nbytes = rows * cols * self.samples * dtype.itemsize
+        chunk = data[:nbytes].view(dtype).reshape(rows, cols, self.samples)
+        if predictor == 2:  # horizontal differencing
+            chunk = np.cumsum(chunk, axis=1, dtype=dtype)
+        return chunk
+
+    def _contiguous(self):
+        """ uncompressed strips that follow each other in the file can be mapped as one array """
+        if self.tiled or self.get('Compression', 1) != 1 or self.get('Predictor', 1) != 1:
+            return False
+        offsets, counts = self._chunk_table()
+        return all(offsets[i] + counts[i] == offsets[i+1] for i in range(len(offsets) - 1))
+
+    def image(self):
+        """ the full image as a zero copy view when possible, decoded otherwise """
+        if self._contiguous():
+            self._check_layout()
+            shape = (self.height, self.width, self.samples)
+            offset = self._chunk_table()[0][0]
+            view = np.ndarray(shape, dtype=self.dtype, buffer=self.tiff.map(), offset=offset)
+            return view[..., 0] if self.samples == 1 else view
+        return self.read_window(0, 0, self.height, self.width)
+
+    def read_window(self, row, col, nrows, ncols):
+        """ pixels of a window, only the strips or tiles overlapping the window are touched """
+        if row < 0 or col < 0 or row + nrows > self.height or col + ncols > self.width:
+            raise IndexError('window outside of the image')
+        if self._contiguous():
+            return self.image()[row:row+nrows, col:col+ncols]
+        ch, cw = self.chunk_shape
+        out = np.empty((nrows, ncols, self.samples), dtype=self.dtype)
+        for r in range(row // ch, (row + nrows - 1) // ch + 1):
+            for c in range(col // cw, (col + ncols - 1) // cw + 1):
+                chunk = self.read_chunk(r * self.chunks_across + c)
+                r0, c0 = max(row, r * ch), max(col, c * cw)
+                r1, c1 = min(row + nrows, r * ch + chunk.shape[0]), min(col + ncols, c * cw + cw)
+                out[r0-row:r1-row, c0-col:c1-col] = chunk[r0-r*ch:r1-r*ch, c0-c*cw:c1-c*cw]
+        return out[..., 0] if self.samples == 1 else out
+
+    def read_points(self, rows, cols):
+        """ pixel values at (rows, cols), every touched strip or tile is decoded only once """
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        if rows.shape != cols.shape:
+            raise ValueError('rows and cols should have the same shape')
+        if rows.size and (rows.min() < 0 or cols.min() < 0 or rows.max() >= self.height or cols.max() >= self.width):
+            raise IndexError('points outside of the image')
+        if self._contiguous():
+            return self.image()[rows, cols]
+        ch, cw = self.chunk_shape
+        ids = (rows // ch) * self.chunks_across + cols // cw
+        out = np.empty(rows.shape + (self.samples,), dtype=self.dtype)
+        order = np.argsort(ids, kind='stable')
+        splits = np.flatnonzero(np.diff(ids[order])) + 1
+        for group in np.split(order, splits):
+            if len(group) == 0:
+                continue
+            i = ids[group[0]]
+            chunk = self.read_chunk(i)
+            out[group] = chunk[rows[group] - (i // self.chunks_across) * ch, cols[group] - (i % self.chunks_across) * cw]
+        return out[..., 0] if self.samples == 1 else out
+
+    ## georeferencing
+
+    @property
+    def transform(self):
+        """ (x of the left edge, pixel width, y of the top edge, pixel height) from the tiepoint and pixel scale """
+        i, j, _, x, y, _ = self['ModelTiepoint'][:6]
+        sx, sy = self['ModelPixelScale'][:2]
+        return x - i * sx, sx, y + j * sy, sy
+
+    def xy_to_rowcol(self, x, y):
+        x0, sx, y0, sy = self.transform
+        cols = np.floor((np.asarray(x) - x0) / sx).astype(np.int64)
+        rows = np.floor((y0 - np.asarray(y)) / sy).astype(np.int64)
+        return rows, cols
+
+
+def lzw_decode(data):
+    """ tiff flavoured lzw: msb first codes of 9 to 12 bits, clear code 256, end code 257
+        and the code width increases one code early """
+    out = bytearray()
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    data = data + b'\0\0'
+    nbits = (len(data) - 2) * 8
+    bitpos, width, prev = 0, 9, None
+    while bitpos + width <= nbits:
+        byte = bitpos >> 3
+        code = (int.from_bytes(data[byte:byte+3], 'big') >> (24 - (bitpos & 7) - width)) & ((1 << width) - 1)
+        bitpos += width
+        if code == 257:
+            break
+        if code == 256:
+            del table[258:]
+            width, prev = 9, None
+            continue
+        if prev is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else prev + prev[:1]
+            table.append(prev + entry[:1])
+        out += entry
+        prev = entry
+        if len(table) >= (1 << width) - 1 and width < 12:
+            width += 1
+    return bytes(out)
+
+
+def parse_geokeys(directory, doubles, ascii):
+    """ GeoKeyDirectory header (version, revision, minor revision, key count) and
+        entries (key, tag location, count, value or offset) to a dict of key name -> value """
+    keys = {}
+    for i in range(directory[3]):
+        key, location, count, value = directory[4+i*4:8+i*4]
+        if location == 34736:
+            value = doubles[value:value+count] if count > 1 else doubles[value]
+        elif location == 34737:
+            value = ascii[value:value+count].rstrip('|\0')
+        elif location != 0:
+            value = directory[value:value+count]
+        keys[GEOKEYS.get(key, key)] = value
+    return keys
+
+
+class TiffFile(object):
+    """ lazy tiff / bigtiff reader: the header and all directories are parsed on open
+        with one read and one struct.unpack_from per directory, large tag values
+        (offsets, geokeys, ...) are only read when they are accessed """
+    def __init__(self, filename):
+        self.filename = filename
+        self._map = None
+        self.f = open(filename, 'rb')
+        try:
+            self._read_header()
+            self.ifds = list(self._read_ifds())
+        except Exception:
+            self.f.close()
+            raise
+
+    def _read_header(self):
+        header = self.f.read(16)
+        if header[:2] == b'II':
+            self.symbol = '<'
+        elif header[:2] == b'MM':
+            self.symbol = '>'
+        else:
+            raise ValueError('invalid endian %r' % header[:2])
+        version = struct.unpack_from(self.symbol + 'H', header, 2)[0]
+        if version == 42:
+            self.bigtiff, self.first_ifd = False, struct.unpack_from(self.symbol + 'L', header, 4)[0]
+        elif version == 43:
+            self.bigtiff, self.first_ifd = True, struct.unpack_from(self.symbol + 'Q', header, 8)[0]
+        else:
+            raise ValueError('Not a Tiff file')
+
+    def read(self, offset, size):
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def map(self):
+        """ the whole file memory mapped as bytes, created on first pixel access """
+        if self._map is None:
+            self._map = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        return self._map
+
+    def decode(self, type_, count, data):
+        if type_ == 2:
+            return data[:count].rstrip(b'\0').decode('latin-1')
+        fmt, size = TYPES.get(type_, ('B', 1))
+        if type_ in (5, 10):  # (s)rational: numerator, denominator pairs
+            pairs = struct.unpack_from('%s%d%s' % (self.symbol, count * 2, fmt), data)
+            values = tuple(n / float(d) if d else float('nan') for n, d in zip(pairs[::2], pairs[1::2]))
+        else:
+            values = struct.unpack_from('%s%d%s' % (self.symbol, count, fmt), data)
+        return values[0] if count == 1 else values
+
+    def _read_ifds(self):
+        count_fmt, entry_fmt, entry_size, inline = ('Q', 'HHQ8s', 20, 8) if self.bigtiff else ('H', 'HHL4s', 12, 4)
+        count_size = struct.calcsize(count_fmt)
+        offset, seen = self.first_ifd, set()
+        while offset and offset not in seen:  # follow the chain of directories
+            seen.add(offset)
+            data = self.read(offset, 4096)
+            n = struct.unpack_from(self.symbol + count_fmt, data)[0]
+            size = count_size + n * entry_size + inline
+            if len(data) < size:
+                data = self.read(offset, size)
+            entries = struct.unpack_from(self.symbol + entry_fmt * n + ('Q' if self.bigtiff else 'L'), data, count_size)
+            tags = {}
+            for i in range(n):
+                code, type_, count, raw = entries[i*4:i*4+4]
+                tag = TiffTag(self, code, type_, count)
+                if tag.nbytes <= inline:
+                    tag._value = self.decode(type_, count, raw)
+                else:
+                    tag.offset = struct.unpack_from(self.symbol + ('Q' if self.bigtiff else 'L'), raw)[0]
+                tags[code] = tag
+            yield IFD(self, offset, tags)
+            offset = entries[-1]
+
+    ## overviews
+
+    @property
+    def levels(self):
+        """ the full resolution image followed by its overviews (reduced resolution subfiles), largest first """
+        full = [ifd for ifd in self.ifds if not ifd.is_reduced][:1]
+        return full + sorted((ifd for ifd in self.ifds if ifd.is_reduced), key=lambda ifd: -ifd.width)
+
+    def level_for(self, width, height):
+        """ the smallest level that is at least width x height pixels (or the full image) """
+        levels = self.levels
+        for ifd in reversed(levels):
+            if ifd.width >= width and ifd.height >= height:
+                return ifd
+        return levels[0]
+
+    def read_preview(self, width, height):
+        """ pixels of the pyramid level that best matches a thumbnail or tile of width x height,
+            only that level is read """
+        return self.level_for(width, height).image()
+
+    def close(self):
+        self._map = None
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+## writing tiled tiffs with overviews
+
+def decimate(image, method='mean', nodata=None, band_rows=1024):
+    """ halve the resolution, mean ignores nodata (and NaN) cells, nearest takes every other cell,
+        the image is processed in bands of rows so that a memory mapped layer isn't loaded at once """
+    if method == 'nearest':
+        return np.ascontiguousarray(image[::2, ::2])
+    if method != 'mean':
+        raise ValueError('unknown decimation method %s' % method)
+    band_rows += band_rows % 2  # bands should not split a pair of rows
+    return np.vstack([_mean2x2(image[r:r+band_rows], nodata) for r in range(0, image.shape[0], band_rows)])
+
+
+def _mean2x2(image, nodata):
+    h, w = image.shape
+    data = image.astype(np.float64)
+    valid = ~np.isnan(data)
+    if nodata is not None:
+        valid &= image != nodata
+    data[~valid] = 0
+    pad = ((0, h % 2), (0, w % 2))
+    data, valid = np.pad(data, pad), np.pad(valid, pad)
+    shape = (data.shape[0] // 2, 2, data.shape[1] // 2, 2)
+    sums, counts = data.reshape(shape).sum(axis=(1, 3)), valid.reshape(shape).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+    empty = counts == 0
+    if image.dtype.kind in 'iu':
+        ## integers have no nan, cells without data need a nodata value before the cast
+        if nodata is None and empty.any():
+            raise ValueError('nodata is required to decimate integer images with empty cells')
+        mean = np.rint(mean)
+    mean[empty] = np.nan if nodata is None else nodata
+    return mean.astype(image.dtype)
+
+
+def build_overviews(image, min_size=256, method='mean', nodata=None):
+    """ halve the image until it fits in min_size x min_size """
+    levels = []
+    while max(image.shape) > min_size:
+        image = decimate(image, method, nodata)
+        levels.append(image)
+    return levels
+
+
+def _ifd_entries(shape, dtype, tile, offsets, counts, compression, reduced):
+    return [(254, 4, [1 if reduced else 0]), (256, 4, [shape[1]]), (257, 4, [shape[0]]),
+               (258, 3, [dtype.itemsize * 8]), (259, 3, [compression]), (262, 3, [1]), (277, 3, [1]),
+               (284, 3, [1]), (322, 3, [tile]), (323, 3, [tile]), (324, 4, offsets), (325, 4, counts),
+               (339, 3, [{'u': 1, 'i': 2, 'f': 3}[dtype.kind]])]
+
+
+def _pack_ifd(entries, offset):
+    """ little endian directory at offset, values that don't fit in an entry follow the directory """
+    entries = sorted(entries)
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    head, extra = [struct.pack('<H', len(entries))], []
+    for code, type_, values in entries:
+        fmt, size = TYPES[type_]
+        if type_ == 2:
+            raw = values.encode('latin-1') + b'\0'
+            count = len(raw)
+        else:
+            raw = struct.pack('<%d%s' % (len(values), fmt), *values)
+            count = len(values)
+        if len(raw) <= 4:
+            head.append(struct.pack('<HHL', code, type_, count) + raw.ljust(4, b'\0'))
+        else:
+            head.append(struct.pack('<HHLL', code, type_, count, data_offset))
+            raw += b'\0' * (len(raw) % 2)  # keep the next value word aligned
+            extra.append(raw)
+            data_offset += len(raw)
+    return b''.join(head), b''.join(extra)
+
+
+def write_tiff(filename, image, overviews=(), tile=256, compression='deflate',
+               transform=None, epsg=None, nodata=None):
+    """ write a 2d array as a tiled (geo)tiff followed by its overviews as reduced resolution subfiles,
+        transform is (x of the left edge, pixel width, y of the top edge, pixel height) """
+    image = np.asarray(image)
+    code = {None: 1, 'deflate': 8}[compression]
+    dtype = image.dtype.newbyteorder('<')
+    geo = []
+    if transform is not None:
+        x0, sx, y0, sy = transform
+        geo += [(33550, 12, [sx, sy, 0.0]), (33922, 12, [0.0, 0.0, 0.0, x0, y0, 0.0])]
+    if epsg is not None:
+        geographic = 4000 <= epsg < 5000
+        geo.append((34735, 3, [1, 1, 0, 3, 1024, 0, 1, 2 if geographic else 1, 1025, 0, 1, 1,
+                               2048 if geographic else 3072, 0, 1, epsg]))
+    if nodata is not None:
+        ## GDAL parses the tag as a number, numpy scalars have a repr like np.int32(-9999)
+        geo.append((42113, 2, str(int(nodata)) if dtype.kind in 'iu' else repr(float(nodata))))
+    with open(filename, 'wb') as f:
+        f.write(b'II' + struct.pack('<HL', 42, 0))
+        ifds = []
+        for level, data in enumerate([image] + list(overviews)):
+            offsets, counts = [], []
+            h, w = data.shape
+            for r in range(0, h, tile):
+                for c in range(0, w, tile):
+                    block = np.zeros((tile, tile), dtype=dtype)
+                    if nodata is not None:
+                        block[:] = nodata
+                    part = data[r:r+tile, c:c+tile]
+                    block[:part.shape[0], :part.shape[1]] = part
+                    raw = block.tobytes()
+                    if code == 8:
+                        raw = zlib.compress(raw, 6)
+                    offsets.append(f.tell())
+                    counts.append(len(raw))
+                    f.write(raw)
+            entries = _ifd_entries(data.shape, dtype, tile, offsets, counts, code, level > 0)
+            ifds.append(entries + (geo if level == 0 else []))
+        if f.tell() % 2:
+            f.write(b'\0')
+        positions = []
+        for i, entries in enumerate(ifds):
+            offset = f.tell()
+            positions.append(offset)
+            head, extra = _pack_ifd(entries, offset)
+            f.write(head + b'\0\0\0\0' + extra)  # next ifd offset is patched below
+        for i, offset in enumerate(positions):
+            f.seek(offset + 2 + 12 * len(ifds[i]))
+            f.write(struct.pack('<L', positions[i+1] if i + 1 < len(positions) else 0))
+        f.seek(4)
+        f.write(struct.pack('<L', positions[0]))
+    return filename
+
+
+def sbg_to_tiff(sbg_filename, ncols, tiff_filename=None, method='mean', min_size=256, tile=256):
+    """ global .sbg layer to a tiled geotiff with overviews, nodata is Int32.MinValue like in the .sbg """
+    nodata = -2147483648
+    grid = np.memmap(sbg_filename, dtype='<i4', mode='r').reshape(-1, ncols)
+    cellsize = 360.0 / ncols
+    tiff_filename = tiff_filename or os.path.splitext(sbg_filename)[0] + '.tif'
+    overviews = build_overviews(grid, min_size, method, nodata)
+    return write_tiff(tiff_filename, grid, overviews, tile=tile, transform=(-180.0, cellsize, 90.0, cellsize),
+                      epsg=4326, nodata=nodata)
 
 
 class GeoTiffInfo(object):
@@ -19,57 +537,26 @@ class GeoTiffInfo(object):
     ColorsPerSample = -1
     ImageLength = -1
     ImageWidth = -1
+    GeoKeys = {}
+    ModelPixelScale = None
+    ModelTiepoint = None
 
 def getGeoTiffInfo(geotiff):
-    image = open(geotiff, 'rb')
-    #read the first 2 bytes to know "endian"
-    start = image.read(2)
-    endian = binascii.hexlify(start).upper()
-    if endian == "4949":
-        symbol = "<"
-    elif endian == "4D4D":
-        symbol = ">"
-    else:
-        print("invalid endian %s" % endian)
-        return None
-
-    #if the_answer isn't 42 then the file not a tiff image!
-    #BTW - this IS a Douglas Adams reference.
-    the_answer = image.read(2)
-    the_answer = struct.unpack(symbol+'H',the_answer)[0]
-    if the_answer != 42:
-        print("Not a Tiff file")
+    try:
+        tiff = TiffFile(geotiff)
+    except ValueError as e:
+        print(e)
         return None
-    #Figure out where the Image File Directory is.  It can be
-    #anywhere in the file believe it or not.
-    dir_loc = image.read(4)
-    dir_loc = struct.unpack(symbol+'L',dir_loc)[0]
-
-    #goto that section of the file            
-    image.seek(dir_loc)
-    #figure out how many tags there are            
-    directory_data = image.read(2)
-    num_entries = struct.unpack(symbol+'H',directory_data)[0]
-    return image, symbol, num_entries
-
-    #loop through the Image File Directory and look for the tags we care about
-    #Width, Height, SamplesPerPixel, and ColorProfile
-    for i in range(num_entries):
-        a_tag = image.read(12)
-        tag = struct.unpack(symbol+'HHLL',a_tag)
-        #catch in case the type is SHORT
-        if tag[1] == 3:
-            tag = struct.unpack(symbol+'HHLHH',a_tag)
-        #set the class attributes if the tag is one we care about
-        if tag[0] == 256:
-            info.ImageWidth = tag[3]
-        elif tag[0] == 257:
-            info.ImageLength = tag[3]
-        elif tag[0] == 34735:
-            ## START of GEOTIFF information => but how should it be parsed ?
-            
-        else:
-            info.ColorProfile = "None"
+    with tiff:
+        ifd = tiff.ifds[0]
+        info = GeoTiffInfo()
+        info.ImageWidth = ifd.width
+        info.ImageLength = ifd.height
+        info.ColorsPerSample = ifd.get('SamplesPerPixel', 1)
+        info.GeoKeys = ifd.geokeys
+        info.ModelPixelScale = ifd.get('ModelPixelScale')
+        info.ModelTiepoint = ifd.get('ModelTiepoint')
+    return info
 
 class GetTiffInfo(object):
     def __set__(self,inst,tiff):
@@ -78,84 +565,32 @@ class GetTiffInfo(object):
         #and all internal references are based on the instance - inst.
         inst.__dict__['tiff'] = tiff
         try:
-            image = open(tiff,'rb')
-        except:
-            inst.ColorProfile,inst.ColorsPerSample,inst.ImageLength\
-            ,inst.ImageWidth = self.error()
-            return
-            
-        #read the first 2 bytes to know "endian"
-        start = image.read(2)
-        endian = binascii.hexlify(start).upper()
-        if endian == "4949":
-            symbol = "<"
-        elif endian == "4D4D":
-            symbol = ">"
-        else:
+            image = TiffFile(tiff)
+        except (IOError, ValueError):
             inst.ColorProfile,inst.ColorsPerSample,inst.ImageLength\
             ,inst.ImageWidth = self.error()
             return
 
-        #if the_answer isn't 42 then the file not a tiff image!
-        #BTW - this IS a Douglas Adams reference.
-        the_answer = image.read(2)
-        the_answer = struct.unpack(symbol+'H',the_answer)[0]
-        #the_answer = int(binascii.hexlify(the_answer)[0:2],16)
-        if the_answer != 42:
-            inst.ColorProfile,inst.ColorsPerSample,inst.ImageLength\
-            ,inst.ImageWidth = self.error()
-            return
-        
-        #Figure out where the Image File Directory is.  It can be
-        #anywhere in the file believe it or not.
-        dir_loc = image.read(4)
-        dir_loc = struct.unpack(symbol+'L',dir_loc)[0]
-
-        #goto that section of the file            
-        image.seek(dir_loc)
-
-        #figure out how many tags there are            
-        directory_data = image.read(2)
-        num_entries = struct.unpack(symbol+'H',directory_data)[0]
-
-        #loop through the Image File Directory and look for the tags we care about
-        #Width, Height, SamplesPerPixel, and ColorProfile
-        for i in range(num_entries):
-            a_tag = image.read(12)
-            tag = struct.unpack(symbol+'HHLL',a_tag)
-            #catch in case the type is SHORT
-            if tag[1] == 3:
-                tag = struct.unpack(symbol+'HHLHH',a_tag)
-            #set the class attributes if the tag is one we care about
-            if tag[0] == 256:
-                inst.ImageWidth = tag[3]
-            if tag[0] == 257:
-                inst.ImageLength = tag[3]
-            if tag[0] == 258:
-                inst.ColorsPerSample = tag[2]
-            if tag[0] == 34675:
-                inst.ColorProfile = True
-                if inst.ColorProfile == True:
-                    icc_loc = tag[3]
-                    icc_length = tag[2]
-                    image.seek(icc_loc)
-                    icc_data = image.read(icc_length)
-                    struct_format = '%s%s%s' % (symbol,icc_length,'s')
-                    icc_string = struct.unpack(struct_format,icc_data)[0]
-                    if "Adobe RGB (1998)" in icc_string:
-                        inst.ColorProfile = "Adobe RGB (1998)"
-                    elif "sRGB IEC61966-2-1" in icc_string:
-                        inst.ColorProfile = "sRGB IEC61966-2-1"
-                    elif "ProPhoto RGB" in icc_string:
-                        inst.ColorProfile = "Kodak ProPhoto RGB"
-                    elif "eciRGB" in icc_string:
-                        inst.ColorProfile = "eciRGB v2"
-                    elif "e\0c\0i\0R\0G\0B\0" in icc_string:
-                        inst.ColorProfile = "eciRGB v4"
-                    else:
-                        inst.ColorProfile = "Other"
-            else:
-                inst.ColorProfile = "None"
+        with image:
+            ifd = image.ifds[0]
+            inst.ImageWidth = ifd.width
+            inst.ImageLength = ifd.height
+            inst.ColorsPerSample = ifd.tags[258].count if 258 in ifd.tags else -1
+            inst.ColorProfile = "None"
+            if 'InterColorProfile' in ifd:
+                icc_string = image.read(ifd.tags[34675].offset, ifd.tags[34675].count)
+                if b"Adobe RGB (1998)" in icc_string:
+                    inst.ColorProfile = "Adobe RGB (1998)"
+                elif b"sRGB IEC61966-2-1" in icc_string:
+                    inst.ColorProfile = "sRGB IEC61966-2-1"
+                elif b"ProPhoto RGB" in icc_string:
+                    inst.ColorProfile = "Kodak ProPhoto RGB"
+                elif b"eciRGB" in icc_string:
+                    inst.ColorProfile = "eciRGB v2"
+                elif b"e\0c\0i\0R\0G\0B\0" in icc_string:
+                    inst.ColorProfile = "eciRGB v4"
+                else:
+                    inst.ColorProfile = "Other"
 
     def error(self):
         #This error function just resets all the tiff values
@@ -174,4 +609,109 @@ class TiffInfo(object):
         self.ColorsPerSample = -1
         self.ImageLength = -1
         self.ImageWidth = -1
-    tiff = GetTiffInfo()    
+    tiff = GetTiffInfo()
+
+import unittest
+TEST_TIFF = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'UTM2GTIF.TIF')
+class Test_geotiff(unittest.TestCase):
+    def test_getGeoTiffInfo(self):
+        info = getGeoTiffInfo(TEST_TIFF)
+        self.assertEqual((699, 929), (info.ImageWidth, info.ImageLength))
+        self.assertEqual((10.0, 10.0, 0.0), info.ModelPixelScale)
+        self.assertEqual((0.0, 0.0, 0.0, 444650.0, 4640510.0, 0.0), info.ModelTiepoint)
+        self.assertEqual(1, info.GeoKeys['GTModelTypeGeoKey'])
+        self.assertEqual(26716, info.GeoKeys['ProjectedCSTypeGeoKey'])
+        self.assertEqual('UTM Zone 16N NAD27"', info.GeoKeys['GTCitationGeoKey'])
+        self.assertEqual('Clarke, 1866 by Default', info.GeoKeys['GeogCitationGeoKey'])
+
+    def test_lazy_tags(self):
+        with TiffFile(TEST_TIFF) as tiff:
+            self.assertEqual(1, len(tiff.ifds))
+            offsets = tiff.ifds[0].tags[273]
+            self.assertEqual(None, offsets._value)
+            self.assertEqual(85, len(offsets.value))
+            self.assertEqual(8, offsets.value[0])
+
+    def test_read_window(self):
+        with TiffFile(TEST_TIFF) as tiff:
+            ifd = tiff.ifds[0]
+            image = ifd.image()
+            self.assertEqual((929, 699), image.shape)
+            self.assertEqual(np.uint8, image.dtype)
+            self.assertTrue(np.shares_memory(image, tiff.map()))
+            window = ifd.read_window(100, 200, 30, 40)
+            self.assertEqual((30, 40), window.shape)
+            rows, cols = np.array([928, 0, 105, 105]), np.array([698, 0, 201, 201])
+            self.assertEqual(image[rows, cols].tolist(), ifd.read_points(rows, cols).tolist())
+            self.assertEqual(window[5, 1], ifd.read_points([105], [201])[0])
+            for rows, cols in (([-1], [0]), ([0], [-1]), ([929], [0]), ([0], [699])):
+                self.assertRaises(IndexError, ifd.read_points, rows, cols)
+
+    def test_read_points_tiled(self):
+        import tempfile
+        image = np.arange(50 * 70, dtype=np.int32).reshape(50, 70)
+        fd, path = tempfile.mkstemp(suffix='.tif')
+        os.close(fd)
+        try:
+            write_tiff(path, image, tile=32)
+            with TiffFile(path) as tiff:
+                ifd = tiff.ifds[0]
+                rows, cols = np.array([49, 0, 33, 49]), np.array([69, 0, 64, 3])
+                self.assertEqual(image[rows, cols].tolist(), ifd.read_points(rows, cols).tolist())
+                ## in the padding of the edge tiles and before the image
+                for rows, cols in (([50], [0]), ([0], [70]), ([-1], [5]), ([5], [-1])):
+                    self.assertRaises(IndexError, ifd.read_points, rows, cols)
+                ## a floating point predictor (3) is refused instead of returning the differenced bytes
+                ifd.tags[317] = TiffTag(tiff, 317, 3, 1, value=3)
+                self.assertRaises(NotImplementedError, ifd.read_chunk, 0)
+                self.assertRaises(NotImplementedError, ifd.read_window, 0, 0, 10, 10)
+        finally:
+            os.remove(path)
+
+    def test_lzw_decode(self):
+        codes = [256, 65, 66, 258, 257]
+        bits = ''.join(format(c, '09b') for c in codes)
+        bits += '0' * (-len(bits) % 8)
+        data = int(bits, 2).to_bytes(len(bits) // 8, 'big')
+        self.assertEqual(b'ABAB', lzw_decode(data))
+
+    def test_overviews(self):
+        import tempfile
+        image = np.arange(600 * 300, dtype=np.int32).reshape(300, 600)
+        image[:2, :2] = -1
+        fd, path = tempfile.mkstemp(suffix='.tif')
+        os.close(fd)
+        try:
+            overviews = build_overviews(image, min_size=100, nodata=-1)
+            write_tiff(path, image, overviews, tile=64, transform=(-180.0, 0.6, 90.0, 0.6), epsg=4326, nodata=-1)
+            with TiffFile(path) as tiff:
+                levels = tiff.levels
+                self.assertEqual([600, 300, 150, 75], [ifd.width for ifd in levels])
+                self.assertEqual([False, True, True, True], [ifd.is_reduced for ifd in levels])
+                self.assertEqual(image.tolist(), levels[0].image().tolist())
+                self.assertEqual(2, levels[0].geokeys['GTModelTypeGeoKey'])
+                preview = tiff.read_preview(100, 50)
+                self.assertEqual((75, 150), preview.shape)
+                self.assertEqual(-1, overviews[0][0, 0])
+                self.assertEqual(np.rint((1204 + 1205 + 1804 + 1805) / 4.0), overviews[0][1, 2])
+                self.assertEqual('-1', levels[0]['GDAL_NODATA'].strip('\0'))
+            ## numpy scalar nodata values are written as plain numbers
+            write_tiff(path, image.astype(np.float32), tile=64, nodata=np.float32(-1.5))
+            with TiffFile(path) as tiff:
+                self.assertEqual(-1.5, float(tiff.levels[0]['GDAL_NODATA'].strip('\0')))
+            write_tiff(path, image, tile=64, nodata=np.int32(-1))
+            with TiffFile(path) as tiff:
+                self.assertEqual('-1', tiff.levels[0]['GDAL_NODATA'].strip('\0'))
+            ## odd sized integer images without nodata: every 2x2 block has data
+            odd = build_overviews(np.arange(35, dtype=np.int32).reshape(5, 7), min_size=4)
+            self.assertEqual([[4, 6, 8, 10], [18, 20, 22, 24], [28, 30, 32, 34]], odd[0].tolist())
+        finally:
+            os.remove(path)
+
+    def test_tiffinfo(self):
+        info = TiffInfo()
+        info.tiff = TEST_TIFF
+        self.assertEqual((699, 929, 1), (info.ImageWidth, info.ImageLength, info.ColorsPerSample))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 from math import atan2, sqrt, degrees
+import csv
+from itertools import islice
 import numpy as np
 from math import radians, sin, cos
 
@@ -7,15 +9,131 @@ RADIUS = 6371.009
 
 def get_centroid(points):
     xy = np.asarray(points)
-    xy = np.radians(xy)
-    lon, lat = xy[:, 0], xy[:, 1]
-    avg_x = np.sum(np.cos(lat) * np.cos(lon)) / xy.shape[0]
-    avg_y = np.sum(np.cos(lat) * np.sin(lon)) / xy.shape[0]
-    avg_z = np.sum(np.sin(lat)) / xy.shape[0]
-    center_lon = atan2(avg_y, avg_x)
-    hyp = sqrt(avg_x * avg_x + avg_y * avg_y)
-    center_lat = atan2(avg_z, hyp)
-    return degrees(center_lon), degrees(center_lat)
+    return CentroidAccumulator().add(xy[:, 0], xy[:, 1]).centroid()
+
+
+def _floats(values):
+    """ float array of strings, nan for empty or unparsable values like NA """
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        result = np.empty(len(values))
+        for i, v in enumerate(values):
+            try:
+                result[i] = float(v)
+            except ValueError:
+                result[i] = np.nan
+        return result
+
+
+class CentroidAccumulator(object):
+    """ streaming version of get_centroid: sums of the cartesian coordinates (optionally weighted and
+        per group key, e.g. per species) are accumulated chunk by chunk so that the points never have
+        to be in memory at once, accumulators of different chunks or processes can be merged """
+    def __init__(self):
+        self.slots = {}  # key -> row in sums
+        self.sums = np.zeros((0, 4))  # x, y, z, total weight
+        self.skipped = 0  # csv rows without valid coordinates
+
+    def _rows(self, keys):
+        rows = []
+        for key in keys:
+            row = self.slots.get(key)
+            if row is None:
+                row = self.slots[key] = len(self.slots)
+            rows.append(row)
+        if len(self.slots) > len(self.sums):
+            self.sums = np.vstack((self.sums, np.zeros((len(self.slots) - len(self.sums), 4))))
+        return np.array(rows, dtype=np.int64)
+
+    def add(self, lon, lat, weights=None, keys=None):
+        """ add a chunk of points in degrees, keys is one group key per point (None for a single group) """
+        lon = np.radians(np.asarray(lon, dtype=np.float64))
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        cos_lat = np.cos(lat)
+        z = np.sin(lat, out=lat)
+        x = np.cos(lon) * cos_lat
+        y = np.sin(lon, out=lon)
+        y *= cos_lat
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            x *= weights
+            y *= weights
+            z *= weights
+        if keys is None:
+            total = len(x) if weights is None else weights.sum()
+            row = self._rows([None])[0]
+            self.sums[row] += (x.sum(), y.sum(), z.sum(), total)
+            return self
+        uniques, inverse = np.unique(np.asarray(keys), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        rows = self._rows(uniques.tolist())
+        n = len(uniques)
+        self.sums[rows, 0] += np.bincount(inverse, weights=x, minlength=n)
+        self.sums[rows, 1] += np.bincount(inverse, weights=y, minlength=n)
+        self.sums[rows, 2] += np.bincount(inverse, weights=z, minlength=n)
+        self.sums[rows, 3] += np.bincount(inverse, weights=weights, minlength=n)
+        return self
+
+    def add_chunks(self, chunks):
+        """ add (lon, lat[, weights[, keys]]) tuples from an iterator """
+        for chunk in chunks:
+            self.add(*chunk)
+        return self
+
+    def add_csv(self, filename, lon_column='longitude', lat_column='latitude', key_column=None,
+                weight_column=None, chunk_rows=1000000):
+        """ add the points of a csv file (with a header row) chunk_rows rows at a time,
+            rows with an empty or unparsable coordinate or weight or without a key are skipped and counted in self.skipped """
+        with open(filename, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            columns = [header.index(c) for c in (lon_column, lat_column)]
+            if weight_column is not None:
+                columns.append(header.index(weight_column))
+            key_index = header.index(key_column) if key_column is not None else None
+            while True:
+                rows = list(islice(reader, chunk_rows))
+                if not rows:
+                    break
+                values = [_floats([row[c] if c < len(row) else '' for row in rows]) for c in columns]
+                valid = np.isfinite(values[0])
+                for v in values[1:]:
+                    valid &= np.isfinite(v)
+                if key_index is not None:
+                    valid &= np.array([key_index < len(row) for row in rows], dtype=bool)
+                self.skipped += len(rows) - int(valid.sum())
+                values = [v[valid] for v in values]
+                weights = values[2] if weight_column is not None else None
+                keys = None
+                if key_index is not None:
+                    keys = [row[key_index] for row, ok in zip(rows, valid.tolist()) if ok]
+                if len(values[0]):
+                    self.add(values[0], values[1], weights, keys)
+        return self
+
+    def merge(self, other):
+        """ add the sums of another accumulator (e.g. from another process) """
+        rows = self._rows(list(other.slots))
+        self.sums[rows] += other.sums[list(other.slots.values())].reshape(-1, 4)
+        self.skipped += other.skipped
+        return self
+
+    def centroid(self, key=None):
+        """ (lon, lat) in degrees of the points added with key """
+        if key not in self.slots:
+            if key is None and self.slots:
+                raise KeyError('only points with a key were added, pass one of the keys or use centroids()')
+            raise KeyError('no points were added for key %r' % (key,))
+        x, y, z, total = self.sums[self.slots[key]]
+        center_lon = atan2(y, x)
+        hyp = sqrt(x * x + y * y)
+        center_lat = atan2(z, hyp)
+        return degrees(center_lon), degrees(center_lat)
+
+    def centroids(self):
+        """ dict of key -> (lon, lat) """
+        return dict((key, self.centroid(key)) for key in self.slots)
 
 
 def gc_distance_points(a, points):
@@ -56,6 +174,268 @@ def gc_dist(a, b):
         return RADIUS * d
 
 
+## array in, array out versions of the functions in GreatCircle.py
+## coordinates are in degrees, inputs broadcast against each other like numpy ufuncs,
+## with outer=True the first set of points (N,) is combined with the second set (M,) into (N, M),
+## the computations run in float32 when all inputs are float32 and the result can be written into out
+
+
+def _float_arrays(*arrays):
+    arrays = [np.asarray(a) for a in arrays]
+    dtype = np.float32 if all(a.dtype == np.float32 for a in arrays) else np.float64
+    return [a.astype(dtype, copy=False) for a in arrays]
+
+
+def _outer(outer, *arrays):
+    """ adds a trailing axis to the first set of arrays so that they broadcast against the second set """
+    if not outer:
+        return arrays
+    return tuple(a[..., np.newaxis] for a in arrays)
+
+
+def gc_distance(lon1, lat1, lon2, lat2, radius=RADIUS, outer=False, out=None):
+    """ great circle distance, in the unit of radius (km by default) """
+    lon1, lat1, lon2, lat2 = _float_arrays(lon1, lat1, lon2, lat2)
+    lon1, lat1 = _outer(outer, lon1, lat1)
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return np.multiply(c, radius, out=out)
+
+
+def gc_bearing(lon1, lat1, lon2, lat2, outer=False, out=None):
+    """ initial bearing from the first to the second points, in radians """
+    lon1, lat1, lon2, lat2 = _float_arrays(lon1, lat1, lon2, lat2)
+    lon1, lat1 = _outer(outer, lon1, lat1)
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    dlon = np.radians(lon2 - lon1)
+    cos_lat2 = np.cos(lat2)
+    y = np.sin(dlon) * cos_lat2
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * cos_lat2 * np.cos(dlon)
+    return np.arctan2(y, x, out=out)
+
+
+def gc_midpoint(lon1, lat1, lon2, lat2, outer=False, out=None):
+    """ (lon, lat) of the point halfway along the great circle, out is an optional (lon, lat) pair of arrays """
+    lon1, lat1, lon2, lat2 = _float_arrays(lon1, lat1, lon2, lat2)
+    lon1, lat1 = _outer(outer, lon1, lat1)
+    lon1, lat1, lat2 = np.radians(lon1), np.radians(lat1), np.radians(lat2)
+    dlon = np.radians(lon2) - lon1
+    cos_lat1, cos_lat2 = np.cos(lat1), np.cos(lat2)
+    bx = cos_lat2 * np.cos(dlon) + cos_lat1
+    by = cos_lat2 * np.sin(dlon)
+    lon_out, lat_out = out if out is not None else (None, None)
+    lat3 = np.arctan2(np.sin(lat1) + np.sin(lat2), np.sqrt(bx * bx + by * by))
+    lon3 = lon1 + np.arctan2(by, bx)
+    return np.degrees(lon3, out=lon_out), np.degrees(lat3, out=lat_out)
+
+
+def gc_crosstrack(lon, lat, lon1, lat1, lon2, lat2, radius=RADIUS, outer=False, out=None):
+    """ distance from the points to the great circle through (lon1, lat1) and (lon2, lat2),
+        with outer=True N points are combined with M great circles into (N, M) """
+    lon, lat, lon1, lat1, lon2, lat2 = _float_arrays(lon, lat, lon1, lat1, lon2, lat2)
+    lon, lat = _outer(outer, lon, lat)
+    d13 = gc_distance(lon1, lat1, lon, lat, radius=1)
+    theta = gc_bearing(lon1, lat1, lon, lat) - gc_bearing(lon1, lat1, lon2, lat2)
+    dxt = np.abs(np.arcsin(np.sin(d13) * np.sin(theta)))
+    return np.multiply(dxt, radius, out=out)
+
+
+def gc_destination(lon, lat, distance, bearing, outer=False, out=None):
+    """ (lon, lat) reached from the points after travelling an angular distance (radians)
+        along the given bearings (radians), with outer=True N points are combined with M distance/bearing pairs """
+    lon, lat, distance, bearing = _float_arrays(lon, lat, distance, bearing)
+    lon, lat = _outer(outer, lon, lat)
+    x, y = np.radians(lon), np.radians(lat)
+    sin_y, cos_y = np.sin(y), np.cos(y)
+    sin_d, cos_d = np.sin(distance), np.cos(distance)
+    y2 = np.arcsin(sin_y * cos_d + cos_y * sin_d * np.cos(bearing))
+    x2 = x + np.arctan2(np.sin(bearing) * sin_d * cos_y, cos_d - sin_y * np.sin(y2))
+    x2 = (x2 + 3 * np.pi) % (2 * np.pi) - np.pi  ## normalise to -180..+180
+    lon_out, lat_out = out if out is not None else (None, None)
+    return np.degrees(x2, out=lon_out), np.degrees(y2, out=lat_out)
+
+
+def unit_vectors(lon, lat):
+    """ lon/lat in degrees to cartesian coordinates on the unit sphere, shape (..., 3) """
+    lon, lat = _float_arrays(lon, lat)
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def _angle(u, v):
+    """ angle between unit vectors along the last axis, accurate for small and large angles """
+    return np.arctan2(np.linalg.norm(np.cross(u, v), axis=-1), np.sum(u * v, axis=-1))
+
+
+def _segment_distance(p, a, b, n):
+    """ angular distance from points p to the segments a-b with unit normals n (zero for degenerate segments):
+        the distance to the great circle when the closest point of the circle lies between a and b,
+        else the distance to the nearest end point """
+    pn = np.sum(p * n, axis=-1)
+    c = p - pn[..., np.newaxis] * n
+    inside = ((np.sum(np.cross(a, c) * n, axis=-1) > 0) & (np.sum(np.cross(c, b) * n, axis=-1) > 0))
+    d_circle = np.arcsin(np.minimum(np.abs(pn), 1.0))
+    d_ends = np.minimum(_angle(p, a), _angle(p, b))
+    return np.where(inside, d_circle, d_ends)
+
+
+def _zorder(lon, lat, cellsize=0.25):
+    """ z-order (morton) key of the grid cell of each point, sorting on it keeps nearby points together """
+    x = np.floor((np.asarray(lon) + 180) / cellsize).astype(np.uint64)
+    y = np.floor((np.asarray(lat) + 90) / cellsize).astype(np.uint64)
+    key = np.zeros(x.shape, dtype=np.uint64)
+    for bit in range(12):
+        key |= ((x >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        key |= ((y >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return key
+
+
+def point_polyline_distance(lon, lat, polylines, radius=RADIUS, chunk_size=256):
+    """ distance from every point to the nearest of the polylines, a polyline is a (lon, lat) pair of arrays
+
+        Every segment gets a bounding cap (centred on its midpoint, radius half its length). The points are
+        sorted along a z-order curve and processed in chunks of nearby points, per chunk only the segments whose
+        cap can be closer than the nearest segment midpoint are kept and per point only those segments are
+        evaluated exactly (distance to the great circle or to the nearest end point). """
+    starts, ends = [], []
+    for line_lon, line_lat in polylines:
+        v = unit_vectors(np.atleast_1d(line_lon), np.atleast_1d(line_lat))
+        starts.append(v[:-1] if len(v) > 1 else v)
+        ends.append(v[1:] if len(v) > 1 else v)
+    lon, lat = np.broadcast_arrays(np.asarray(lon), np.asarray(lat))
+    if not starts or not sum(len(v) for v in starts):
+        return np.full(lon.shape, np.inf)  # no segments: nothing is at a finite distance
+    a, b = np.concatenate(starts), np.concatenate(ends)
+    n = np.cross(a, b)
+    norm = np.linalg.norm(n, axis=-1)[:, np.newaxis]
+    n = np.divide(n, norm, out=np.zeros_like(n), where=norm > 0)
+    center = a + b
+    norm = np.linalg.norm(center, axis=-1)[:, np.newaxis]
+    center = np.divide(center, norm, out=a.copy(), where=norm > 0)
+    cap = np.maximum(_angle(center, a), _angle(center, b))
+
+    p = unit_vectors(lon, lat).reshape(-1, 3)
+    order = np.argsort(_zorder(lon.ravel(), lat.ravel()), kind='stable')
+    result = np.empty(len(p), dtype=p.dtype)
+    for start in range(0, len(p), chunk_size):
+        idx = order[start:start+chunk_size]
+        q = p[idx]
+        ## chunk level pruning with a cap around the points of the chunk
+        chunk_center = q.sum(axis=0)
+        chunk_norm = np.linalg.norm(chunk_center)
+        chunk_center = chunk_center / chunk_norm if chunk_norm > 0 else q[0]
+        chunk_cap = np.arccos(np.clip(np.dot(q, chunk_center), -1.0, 1.0)).max()
+        dcs = np.arccos(np.clip(np.dot(center, chunk_center), -1.0, 1.0))
+        segments = np.flatnonzero(dcs - cap - chunk_cap <= (dcs + chunk_cap).min() + 1e-9)
+        ## point level pruning
+        dc = np.arccos(np.clip(np.dot(q, center[segments].T), -1.0, 1.0))
+        upper = dc.min(axis=1)
+        i, j = np.nonzero(dc - cap[segments] <= upper[:, np.newaxis] + 1e-9)
+        j = segments[j]
+        d = _segment_distance(q[i], a[j], b[j], n[j])
+        result[idx] = np.minimum.reduceat(d, np.flatnonzero(np.r_[True, np.diff(i) > 0]))
+    return (result * radius).reshape(lon.shape)
+
+
+import unittest
+def get_centroid_points(points):
+    """ reference implementation, the in memory version that get_centroid used to be """
+    xy = np.radians(np.asarray(points))
+    lon, lat = xy[:, 0], xy[:, 1]
+    avg_x, avg_y, avg_z = np.mean(np.cos(lat) * np.cos(lon)), np.mean(np.cos(lat) * np.sin(lon)), np.mean(np.sin(lat))
+    return degrees(atan2(avg_y, avg_x)), degrees(atan2(avg_z, sqrt(avg_x * avg_x + avg_y * avg_y)))
+
+class Test_numpy_gc(unittest.TestCase):
+    def test_gc_distance(self):
+        d = gc_distance(-10.0001, 80.0001, 7.935, 63.302, radius=6371000)
+        self.assertAlmostEqual(float(d), 1939037.0, places=0)
+        lons, lats = np.array([0.0, 10.0, 20.0]), np.array([0.0, 5.0, -5.0])
+        d = gc_distance(lons, lats, lons[:2], lats[:2], outer=True)
+        self.assertEqual((3, 2), d.shape)
+        self.assertAlmostEqual(0.0, d[1, 1])
+        self.assertAlmostEqual(gc_dist((20.0, -5.0), (10.0, 5.0)), d[2, 1], places=5)
+        out = np.empty((3, 2), dtype=np.float32)
+        d32 = gc_distance(lons.astype(np.float32), lats.astype(np.float32), lons[:2].astype(np.float32),
+                          lats[:2].astype(np.float32), outer=True, out=out)
+        self.assertIs(out, d32)
+        self.assertTrue(np.allclose(d, d32, rtol=1e-5))
+
+    def test_gc_bearing_midpoint_destination(self):
+        b = gc_bearing(-10.0001, 80.0001, 7.935, 63.302)
+        self.assertAlmostEqual(float(b), 2.661709, places=6)
+        lon, lat = gc_midpoint([-20.0, 7.0], [5.0, 5.0], [-10.0, 7.0], [5.0, 15.0])
+        self.assertTrue(np.allclose([-15.0, 7.0], lon))
+        self.assertAlmostEqual(10.0, lat[1])
+        lon, lat = gc_destination(0.0, 0.0, np.pi / 2, [0.0, np.pi / 2])
+        self.assertTrue(np.allclose([0.0, 90.0], lon))
+        self.assertTrue(np.allclose([90.0, 0.0], lat))
+
+    def test_gc_crosstrack(self):
+        d = gc_crosstrack([0.0, 5.0], [1.0, 0.0], 0.0, 0.0, 10.0, 0.0)
+        self.assertAlmostEqual(gc_dist((0.0, 1.0), (0.0, 0.0)), d[0], places=6)
+        self.assertAlmostEqual(0.0, d[1])
+
+    def test_centroid_accumulator(self):
+        rng = np.random.RandomState(3)
+        lon, lat = rng.uniform(-180, 180, 1000), rng.uniform(-90, 90, 1000)
+        keys = rng.choice(['a', 'b', 'c'], 1000)
+        acc1 = CentroidAccumulator().add(lon[:400], lat[:400], keys=keys[:400])
+        acc2 = CentroidAccumulator().add_chunks([(lon[400:700], lat[400:700], None, keys[400:700]),
+                                                 (lon[700:], lat[700:], None, keys[700:])])
+        centroids = acc1.merge(acc2).centroids()
+        for key in 'abc':
+            pts = np.c_[lon, lat][keys == key]
+            self.assertTrue(np.allclose(get_centroid_points(pts), centroids[key]))
+        ## weights act like repeated points
+        acc = CentroidAccumulator().add([0.0, 10.0], [0.0, 0.0], weights=[1, 3])
+        self.assertTrue(np.allclose(get_centroid([(0.0, 0.0)] + 3 * [(10.0, 0.0)]), acc.centroid()))
+        self.assertAlmostEqual(5.0, get_centroid([(0.0, 0.0), (10.0, 0.0), (5.0, 10.0)])[0])
+        self.assertRaises(KeyError, acc1.centroid)
+        self.assertRaises(KeyError, acc1.centroid, 'd')
+
+    def test_centroid_add_csv(self):
+        import tempfile, os
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['species', 'longitude', 'latitude'])
+            writer.writerows([['a', 0.0, 0.0], ['a', '', 5.0], ['b', 10.0, 'NA'], ['a', 10.0, 0.0],
+                              [], ['b', 20.0, 10.0], ['b', 'x', 1.0]])
+        try:
+            acc = CentroidAccumulator().add_csv(path, key_column='species', chunk_rows=3)
+            self.assertEqual(4, acc.skipped)
+            centroids = acc.centroids()
+            self.assertTrue(np.allclose(get_centroid([(0.0, 0.0), (10.0, 0.0)]), centroids['a']))
+            self.assertTrue(np.allclose((20.0, 10.0), centroids['b']))
+            ## valid coordinates but no key
+            with open(path, 'w') as f:
+                f.write('longitude,latitude,species\n0.0,0.0,a\n5.0,5.0\n10.0,0.0,a\n')
+            acc = CentroidAccumulator().add_csv(path, key_column='species')
+            self.assertEqual(1, acc.skipped)
+            self.assertTrue(np.allclose(get_centroid([(0.0, 0.0), (10.0, 0.0)]), acc.centroid('a')))
+        finally:
+            os.remove(path)
+
+    def test_point_polyline_distance(self):
+        rng = np.random.RandomState(42)
+        line_lon, line_lat = np.linspace(-30, 40, 50), 20 * np.sin(np.linspace(0, 6, 50))
+        lon, lat = rng.uniform(-180, 180, 200), rng.uniform(-90, 90, 200)
+        d = point_polyline_distance(lon, lat, [(line_lon, line_lat)], chunk_size=16)
+        ## brute force: distance to densely sampled points along every segment
+        t = np.linspace(0, 1, 2001)[:, np.newaxis]
+        v = unit_vectors(line_lon, line_lat)
+        samples = (v[:-1][np.newaxis] * (1 - t[..., np.newaxis]) + v[1:][np.newaxis] * t[..., np.newaxis]).reshape(-1, 3)
+        samples /= np.linalg.norm(samples, axis=1)[:, np.newaxis]
+        brute = np.arccos(np.clip(np.dot(unit_vectors(lon, lat), samples.T), -1, 1)).min(axis=1) * RADIUS
+        self.assertTrue(np.all(d <= brute + 1e-6))
+        self.assertTrue(np.allclose(d, brute, atol=0.05))
+        self.assertEqual([np.inf, np.inf], point_polyline_distance([0.0, 1.0], [0.0, 2.0], []).tolist())
+        self.assertEqual((), point_polyline_distance(0.0, 0.0, [([], [])]).shape)
+
+
 if __name__ == '__main__':
 
     import random
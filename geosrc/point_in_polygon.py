@@ -0,0 +1,318 @@
+""" bulk point in polygon, e.g. assigning MEOW ecoregions to millions of occurrence records
+(python replacement for get_ecoregions in misc/meow_intersect.R)
+
+The polygons are prepared once into a regular lon/lat grid: every cell gets the edges that pass through it
+and the polygon that contains a reference point in the cell (found with one crossing number ray per grid row).
+Cells without edges are completely inside one polygon (or outside all of them) and their points need no test
+at all. For a point in a cell with edges only the segment from the point to the reference point of the cell is
+tested against the edges of the cell: every crossing of a polygon boundary flips whether the point is inside
+that polygon compared to the reference point.
+Polygons are expected not to overlap (as ecoregions or countries), holes are supported.
+"""
+import os
+import struct
+
+import numpy as np
+
+## position of the reference point in a cell, off center so that it is unlikely to be on an (axis aligned) edge
+_REFERENCE = (0.5137, 0.4719)
+
+
+def read_shapefile(filename):
+    """ polygons of a polygon shapefile (types 5, 15 and 25, z and m are ignored) as lists of (n, 2) ring arrays,
+        and the attributes from the .dbf next to it (if any) as a list of dicts """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    polygons = []
+    position = 100
+    while position + 8 <= len(data):
+        length = struct.unpack_from('>i', data, position + 4)[0] * 2
+        content = position + 8
+        shape_type = struct.unpack_from('<i', data, content)[0]
+        if shape_type in (5, 15, 25):
+            nparts, npoints = struct.unpack_from('<ii', data, content + 36)
+            parts = np.frombuffer(data, '<i4', nparts, content + 44)
+            points = np.frombuffer(data, '<f8', npoints * 2, content + 44 + 4 * nparts).reshape(-1, 2)
+            polygons.append(np.split(points, parts[1:]))
+        else:
+            polygons.append([])  # null shape
+        position = content + length
+    dbf = os.path.splitext(filename)[0] + '.dbf'
+    records = read_dbf(dbf) if os.path.exists(dbf) else None
+    return polygons, records
+
+
+def read_dbf(filename):
+    """ records of a dBase III file as dicts, numeric fields are converted to int or float """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    nrecords, header_size, record_size = struct.unpack_from('<IHH', data, 4)
+    fields = []
+    position = 32
+    while data[position] != 0x0d:
+        name = data[position:position+11].split(b'\0')[0].decode('ascii')
+        fields.append((name, chr(data[position+11]), data[position+16], data[position+17]))
+        position += 32
+    records = []
+    for i in range(nrecords):
+        position = header_size + i * record_size + 1  # skip the deleted flag
+        record = {}
+        for name, type_, size, decimals in fields:
+            value = data[position:position+size].decode('latin-1').strip()
+            position += size
+            if type_ in 'NF':
+                value = (float(value) if decimals or '.' in value else int(value)) if value else None
+            record[name] = value
+        records.append(record)
+    return records
+
+
+def _expand(starts, counts):
+    """ concatenation of the ranges starts[i]:starts[i]+counts[i] """
+    return np.arange(int(counts.sum())) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+
+def _orient(ax, ay, bx, by, px, py):
+    """ > 0 when p is left of the line a -> b """
+    return (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+
+
+class PolygonIndex(object):
+    def __init__(self, polygons, cellsize=None, max_pairs=1 << 24):
+        """ polygons is a list of polygons, each a list of rings as (n, 2) lon/lat arrays (closed or not),
+            by default the cell size is chosen to have about as many cells as edges """
+        x1, y1, x2, y2, ids = [], [], [], [], []
+        for polygon_id, rings in enumerate(polygons):
+            for ring in rings:
+                ring = np.asarray(ring, dtype=np.float64)[:, :2]
+                if len(ring) < 3:
+                    continue
+                closed = np.vstack((ring, ring[:1])) if not np.array_equal(ring[0], ring[-1]) else ring
+                x1.append(closed[:-1, 0]), y1.append(closed[:-1, 1])
+                x2.append(closed[1:, 0]), y2.append(closed[1:, 1])
+                ids.append(np.full(len(closed) - 1, polygon_id, dtype=np.int32))
+        self.npolygons = len(polygons)
+        if not ids:
+            x1 = y1 = x2 = y2 = [np.zeros(0)]
+            ids = [np.zeros(0, dtype=np.int32)]
+        self.x1, self.y1, self.x2, self.y2 = (np.concatenate(a) for a in (x1, y1, x2, y2))
+        self.polygon = np.concatenate(ids)
+        nedges = len(self.polygon)
+        if nedges:
+            self.xmin, self.ymin = min(self.x1.min(), self.x2.min()), min(self.y1.min(), self.y2.min())
+            self.xmax, self.ymax = max(self.x1.max(), self.x2.max()), max(self.y1.max(), self.y2.max())
+        else:
+            self.xmin = self.ymin = self.xmax = self.ymax = 0.0
+        width, height = max(self.xmax - self.xmin, 1e-9), max(self.ymax - self.ymin, 1e-9)
+        if cellsize is None:
+            cellsize = np.sqrt(width * height / max(nedges, 1))
+        self.cellsize = float(cellsize)
+        self.ncols = int(width // self.cellsize) + 1
+        self.nrows = int(height // self.cellsize) + 1
+        self.max_pairs = max_pairs
+        self._bucket_edges()
+        self._classify_cells()
+
+    def _bucket_edges(self):
+        """ cell -> edges (CSR: edge_starts, cell_edges) for all cells an edge passes through """
+        cs = self.cellsize
+        c1 = ((np.minimum(self.x1, self.x2) - self.xmin) // cs).astype(np.int64)
+        c2 = ((np.maximum(self.x1, self.x2) - self.xmin) // cs).astype(np.int64)
+        r1 = ((np.minimum(self.y1, self.y2) - self.ymin) // cs).astype(np.int64)
+        r2 = ((np.maximum(self.y1, self.y2) - self.ymin) // cs).astype(np.int64)
+        ncells = (c2 - c1 + 1) * (r2 - r1 + 1)
+        cells, edges = [], []
+        start = 0
+        while start < len(ncells):
+            ## edges in chunks so that long edges don't expand into too many (edge, cell) pairs at once
+            stop = start + max(1, int(np.searchsorted(np.cumsum(ncells[start:]), self.max_pairs)))
+            e = np.repeat(np.arange(start, stop), ncells[start:stop])
+            k = _expand(np.zeros(stop - start, dtype=np.int64), ncells[start:stop])
+            width = (c2 - c1 + 1)[e]
+            col, row = c1[e] + k % width, r1[e] + k // width
+            ## drop the cells of the bounding box that the line of the edge doesn't cross
+            x0, y0 = self.xmin + col * cs, self.ymin + row * cs
+            ax, ay, bx, by = self.x1[e], self.y1[e], self.x2[e], self.y2[e]
+            signs = np.stack([np.sign(_orient(ax, ay, bx, by, x0 + dx, y0 + dy))
+                              for dx, dy in ((0, 0), (cs, 0), (0, cs), (cs, cs))])
+            keep = ~(np.all(signs > 0, axis=0) | np.all(signs < 0, axis=0))
+            cells.append(row[keep] * self.ncols + col[keep])
+            edges.append(e[keep])
+            start = stop
+        cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+        edges = np.concatenate(edges) if edges else np.zeros(0, dtype=np.int64)
+        order = np.argsort(cells, kind='stable')
+        self.cell_edges = edges[order]
+        self.edge_starts = np.searchsorted(cells[order], np.arange(self.nrows * self.ncols + 1))
+
+    def _reference_points(self, cells):
+        rows, cols = np.divmod(cells, self.ncols)
+        return (self.xmin + (cols + _REFERENCE[0]) * self.cellsize,
+                self.ymin + (rows + _REFERENCE[1]) * self.cellsize)
+
+    def _classify_cells(self):
+        """ owner[cell] is the polygon containing the reference point of the cell (-1 if none), found by casting
+            a ray to the east per grid row: only the edges bucketed in that row can cross it """
+        self.owner = np.full(self.nrows * self.ncols, -1, dtype=np.int32)
+        ref_x = self.xmin + (np.arange(self.ncols) + _REFERENCE[0]) * self.cellsize
+        for row in range(self.nrows):
+            ry = self.ymin + (row + _REFERENCE[1]) * self.cellsize
+            e = np.unique(self.cell_edges[self.edge_starts[row * self.ncols]:self.edge_starts[(row + 1) * self.ncols]])
+            y1, y2 = self.y1[e], self.y2[e]
+            crosses = (y1 > ry) != (y2 > ry)
+            e, y1, y2 = e[crosses], y1[crosses], y2[crosses]
+            if not len(e):
+                continue
+            x1, x2 = self.x1[e], self.x2[e]
+            xs = x1 + (ry - y1) * (x2 - x1) / (y2 - y1)
+            polygons = self.polygon[e]
+            order = np.lexsort((xs, polygons))
+            xs, polygons = xs[order], polygons[order]
+            bounds = np.flatnonzero(np.r_[True, polygons[1:] != polygons[:-1], True])
+            owner = self.owner[row * self.ncols:(row + 1) * self.ncols]
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                ## an odd number of crossings east of the reference point means inside
+                east = (stop - start) - np.searchsorted(xs[start:stop], ref_x, side='right')
+                owner[east % 2 == 1] = polygons[start]
+
+    def locate(self, lon, lat, chunk_size=1 << 20):
+        """ id of the polygon containing each point, -1 for points outside all polygons """
+        lon, lat = np.ravel(np.asarray(lon, dtype=np.float64)), np.ravel(np.asarray(lat, dtype=np.float64))
+        result = np.full(len(lon), -1, dtype=np.int32)
+        for start in range(0, len(lon), chunk_size):
+            result[start:start+chunk_size] = self._locate(lon[start:start+chunk_size], lat[start:start+chunk_size])
+        return result
+
+    def _locate(self, px, py):
+        col = np.floor((px - self.xmin) / self.cellsize)
+        row = np.floor((py - self.ymin) / self.cellsize)
+        valid = (col >= 0) & (col < self.ncols) & (row >= 0) & (row < self.nrows)
+        cells = np.where(valid, row * self.ncols + col, 0).astype(np.int64)
+        result = np.where(valid, self.owner[cells], -1)
+        ## points in cells with edges: count crossings of the segment point -> reference point per polygon
+        starts = self.edge_starts[cells]
+        counts = np.where(valid, self.edge_starts[cells + 1] - starts, 0)
+        points = np.flatnonzero(counts)
+        if not len(points):
+            return result
+        counts = counts[points]
+        p = np.repeat(points, counts)
+        e = self.cell_edges[_expand(starts[points], counts)]
+        qx, qy = px[p], py[p]
+        rx, ry = self._reference_points(cells[p])
+        ax, ay, bx, by = self.x1[e], self.y1[e], self.x2[e], self.y2[e]
+        ## the edge endpoints on different sides of the segment (half open so a vertex counts once) and the
+        ## point and the reference point on different sides of the edge
+        crossed = (_orient(qx, qy, rx, ry, ax, ay) > 0) != (_orient(qx, qy, rx, ry, bx, by) > 0)
+        crossed &= (_orient(ax, ay, bx, by, qx, qy) > 0) != (_orient(ax, ay, bx, by, rx, ry) > 0)
+        p, polygons = p[crossed], self.polygon[e[crossed]]
+        keys, n = np.unique(p.astype(np.int64) * self.npolygons + polygons, return_counts=True)
+        keys = keys[n % 2 == 1]
+        p, polygons = np.divmod(keys, self.npolygons)
+        ## crossing the boundary of the owner of the cell leaves it, crossing another polygon's boundary enters it
+        leaves = polygons == result[p]
+        result[p[leaves]] = -1
+        result[p[~leaves]] = polygons[~leaves]
+        return result
+
+    def stats(self):
+        """ share of cells that need no point tests and the mean number of edges in the other cells """
+        counts = np.diff(self.edge_starts)
+        mixed = counts > 0
+        return {'cells': len(counts), 'resolved_cells': float(1 - mixed.mean()) if len(counts) else 1.0,
+                'edges_per_mixed_cell': float(counts[mixed].mean()) if mixed.any() else 0.0}
+
+
+def point_in_polygon(lon, lat, polygons, cellsize=None):
+    """ id of the polygon containing each point (-1 if none), see PolygonIndex to reuse the preparation """
+    return PolygonIndex(polygons, cellsize).locate(lon, lat)
+
+
+def assign_regions(lon, lat, shapefile, field=None):
+    """ polygon ids (or the values of a .dbf field, None outside all polygons) of the shapefile
+        that contains each point, e.g. assign_regions(lon, lat, 'meow_ecos.shp', 'ECOREGION') """
+    polygons, records = read_shapefile(shapefile)
+    if field is not None:
+        if records is None:
+            raise ValueError('field %s needs the attributes in %s, which does not exist'
+                             % (field, os.path.splitext(shapefile)[0] + '.dbf'))
+        if records and field not in records[0]:
+            raise ValueError('%s has no field %s, the fields are %s' % (shapefile, field, ', '.join(records[0])))
+    ids = PolygonIndex(polygons).locate(lon, lat)
+    if field is None:
+        return ids
+    values = np.array([r[field] for r in records] + [None], dtype=object)
+    return values[ids]
+
+
+import unittest
+import tempfile
+import shutil
+def _crossing_number(px, py, ring):
+    """ reference implementation: classic ray crossing test of every point against every edge """
+    ring = np.asarray(ring, dtype=np.float64)
+    x1, y1 = ring[:, 0][None, :], ring[:, 1][None, :]
+    x2, y2 = np.roll(ring[:, 0], -1)[None, :], np.roll(ring[:, 1], -1)[None, :]
+    px, py = px[:, None], py[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+    return cross.sum(axis=1) % 2 == 1
+
+class Test_point_in_polygon(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 200))
+        star = np.c_[20 + (5 + 4 * np.sin(7 * angles)) * np.cos(angles), 10 + (5 + 4 * np.sin(7 * angles)) * np.sin(angles)]
+        square = np.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=float)
+        hole = np.array([[2, 2], [2, 8], [8, 8], [8, 2]], dtype=float)
+        island = np.array([[4, 4], [6, 4], [5, 6]], dtype=float)
+        triangle = np.array([[10, 0], [14, 0], [10, 10], [10, 0]], dtype=float)  # shares an edge with the square
+        self.polygons = [[square, hole], [star], [island], [triangle]]
+        self.px = np.r_[rng.uniform(-2, 27, 20000), 0.5, 5.0, 10.0, 5.0, 12.0]
+        self.py = np.r_[rng.uniform(-2, 17, 20000), 0.5, 5.0, 5.0, 1.0, 2.0]
+
+    def expected(self):
+        inside = [np.logical_xor.reduce([_crossing_number(self.px, self.py, ring) for ring in rings])
+                  for rings in self.polygons]
+        return np.where(np.any(inside, axis=0), np.argmax(inside, axis=0), -1)
+
+    def test_locate(self):
+        expected = self.expected()
+        for cellsize in [None, 0.37, 3.0, 100.0]:
+            index = PolygonIndex(self.polygons, cellsize)
+            actual = index.locate(self.px, self.py, chunk_size=7000)
+            on_boundary = (self.px == 10.0) & (self.py == 5.0)
+            self.assertEqual(expected[~on_boundary].tolist(), actual[~on_boundary].tolist())
+        self.assertEqual([0, 2, 0, 3], actual[[-5, -4, -2, -1]].tolist())
+        self.assertTrue(0 < PolygonIndex(self.polygons).stats()['resolved_cells'] < 1)
+
+    def test_shapefile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'squares.shp')
+            rings = [np.array([[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]], dtype=float),
+                     np.array([[2, 0], [2, 1], [3, 1], [3, 0], [2, 0]], dtype=float)]
+            records = b''
+            with open(path, 'wb') as f:
+                f.write(struct.pack('>7i', 9994, 0, 0, 0, 0, 0, 0) + struct.pack('<2i4d4d', 1000, 5, 0, 0, 3, 1, 0, 0, 0, 0))
+                for i, ring in enumerate(rings):
+                    content = struct.pack('<i4d2i', 5, 0, 0, 1, 1, 1, len(ring)) + struct.pack('<i', 0) + ring.astype('<f8').tobytes()
+                    f.write(struct.pack('>2i', i + 1, len(content) // 2) + content)
+            with open(os.path.join(directory, 'squares.dbf'), 'wb') as f:
+                f.write(struct.pack('<4BIHH20x', 3, 0, 0, 0, 2, 32 + 2 * 32 + 1, 1 + 4 + 3))
+                f.write(struct.pack('<11sc4xBB14x', b'NAME', b'C', 4, 0) + struct.pack('<11sc4xBB14x', b'ID', b'N', 3, 0) + b'\r')
+                f.write(b' west 12 east  7\x1a')
+            polygons, records = read_shapefile(path)
+            self.assertEqual([{'NAME': 'west', 'ID': 12}, {'NAME': 'east', 'ID': 7}], records)
+            self.assertEqual(['east', 'west', None], assign_regions([2.5, 0.5, 1.5], [0.5, 0.5, 0.5], path, 'NAME').tolist())
+            self.assertRaises(ValueError, assign_regions, [0.5], [0.5], path, 'REGION')
+            os.remove(os.path.join(directory, 'squares.dbf'))
+            self.assertEqual([1, 0], assign_regions([2.5, 0.5], [0.5, 0.5], path).tolist())
+            with self.assertRaises(ValueError) as error:
+                assign_regions([0.5], [0.5], path, 'NAME')
+            self.assertTrue('squares.dbf' in str(error.exception))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+""" render a .sbg or GeoTIFF layer as a png, python version of version 2 of misc/raster2png.R
+
+The raster is read in blocks of rows. The 1% and 99% quantiles are estimated from a sample of evenly
+spaced rows, every value is scaled to 0-1000 (1002 for nodata) and mapped to its colour with one take on
+a 1003 entry RGBA lookup table, and the png is compressed and written scanline block by scanline block,
+so memory use is bounded by the block size and not by the size of the raster.
+Usage: python raster2png.py bathymetry.sbg bathymetry.png [ncols]
+"""
+import os
+import struct
+import zlib
+
+import numpy as np
+
+## leaflet::colorNumeric(rev(...)) ramp of the R version, deep (low) values are dark
+COLORS = ['#08306b', '#08519c', '#2171b5', '#4292c6', '#6baed6', '#9ecae1', '#c6dbef', '#deebf7', '#f7fbff']
+NA_COLOR = '#818181'
+LUT_SIZE = 1003  # 0-1000 scaled values, 1001 unused, 1002 nodata
+NA_INDEX = 1002
+SBG_NODATA = -2147483648
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def hex_to_rgba(color):
+    color = color.lstrip('#')
+    return [int(color[i:i+2], 16) for i in (0, 2, 4)] + [int(color[6:8], 16) if len(color) == 8 else 255]
+
+
+def color_ramp_lut(colors=COLORS, na_color=NA_COLOR):
+    """ (1003, 4) uint8 RGBA lookup table: entry i is the colour of i on a ramp over -1..1001 (as in the
+        R version), the last entry is the nodata colour, colours are interpolated linearly in RGB """
+    stops = np.array([hex_to_rgba(c) for c in colors], dtype=np.float64)
+    positions = (np.arange(LUT_SIZE - 1) + 1) / float(LUT_SIZE - 1) * (len(colors) - 1)
+    lut = np.empty((LUT_SIZE, 4), dtype=np.uint8)
+    for channel in range(4):
+        lut[:-1, channel] = np.rint(np.interp(positions, np.arange(len(colors)), stops[:, channel]))
+    lut[NA_INDEX] = hex_to_rgba(na_color)
+    return lut
+
+
+class SbgRaster(object):
+    """ rows of a headerless int32 .sbg, nodata as nan, ncols defaults to a global grid twice as wide as high """
+    def __init__(self, filename, ncols=None):
+        ncells = os.path.getsize(filename) // 4
+        if ncols is None:
+            ncols = int(round(np.sqrt(ncells * 2)))
+        if ncells % ncols:
+            raise ValueError('%s does not contain a whole number of rows of %d columns' % (filename, ncols))
+        self.ncols, self.nrows = ncols, ncells // ncols
+        self.grid = np.memmap(filename, dtype='<i4', mode='r', shape=(self.nrows, self.ncols))
+
+    def read_rows(self, start, stop, step=1):
+        return self._to_float(self.grid[start:stop:step])
+
+    def read_cells(self, rows, cols):
+        """ (len(rows), len(cols)) values of the cells at every combination of rows and cols,
+            only these cells are read and converted """
+        return self._to_float(self.grid[np.ix_(rows, cols)])
+
+    def _to_float(self, values):
+        result = values.astype(np.float32)
+        result[values == SBG_NODATA] = np.nan
+        return result
+
+    def close(self):
+        self.grid = None
+
+
+class TiffRaster(object):
+    """ rows of the first band of a GeoTIFF, GDAL_NODATA values as nan """
+    def __init__(self, filename):
+        from geotiff import TiffFile
+        self.tiff = TiffFile(filename)
+        self.ifd = self.tiff.levels[0]
+        self.ncols, self.nrows = self.ifd.width, self.ifd.height
+        nodata = self.ifd.get('GDAL_NODATA')
+        self.nodata = float(nodata.strip('\0 ')) if nodata is not None else None
+
+    def read_rows(self, start, stop, step=1):
+        stop = min(stop, self.nrows)
+        rows = self.ifd.read_window(start, 0, stop - start, self.ncols)
+        if rows.ndim == 3:
+            rows = rows[..., 0]
+        rows = rows[::step].astype(np.float32)
+        if self.nodata is not None:
+            rows[rows == self.nodata] = np.nan
+        return rows
+
+    def close(self):
+        self.tiff.close()
+
+
+def open_raster(filename, ncols=None):
+    if os.path.splitext(filename)[1].lower() in ('.tif', '.tiff'):
+        return TiffRaster(filename)
+    return SbgRaster(filename, ncols)
+
+
+def sample_quantiles(raster, probs=(0.01, 0.99), sample_size=1 << 20, chunk_rows=256):
+    """ quantiles of the values in about sample_size cells of evenly spaced rows """
+    step = max(1, raster.nrows * raster.ncols // sample_size)
+    values = []
+    for start in range(0, raster.nrows, chunk_rows * step):
+        rows = raster.read_rows(start, min(start + chunk_rows * step, raster.nrows), step)
+        values.append(rows[~np.isnan(rows)])
+    values = np.concatenate(values) if values else np.zeros(0, dtype=np.float32)
+    if not len(values):
+        return tuple(0.0 for _ in probs)
+    return tuple(float(q) for q in np.quantile(values, probs))
+
+
+def scale_to_lut(values, low, high):
+    """ lut indices of values: 0-1000 between low and high (clipped), NA_INDEX for nan """
+    factor = 1000.0 / (high - low) if high > low else 0.0
+    scaled = np.subtract(values, low, dtype=np.float32)
+    scaled *= factor
+    np.clip(scaled, 0, 1000, out=scaled)
+    scaled[np.isnan(scaled)] = NA_INDEX
+    return np.rint(scaled, out=scaled).astype(np.int16)
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def png_chunks(blocks, width, height, level=6, idat_size=1 << 20):
+    """ the chunks of an RGBA png from an iterator of (rows, width, 4) uint8 blocks, compressed as they come """
+    compressor = zlib.compressobj(level)
+    written = 0
+    yield PNG_SIGNATURE
+    yield _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+    pending = []
+    size = 0
+    for block in blocks:
+        ## every scanline starts with filter type 0 (none)
+        scanlines = np.zeros((block.shape[0], 1 + width * 4), dtype=np.uint8)
+        scanlines[:, 1:] = block.reshape(block.shape[0], -1)
+        data = compressor.compress(scanlines.tobytes())
+        written += block.shape[0]
+        if data:
+            pending.append(data)
+            size += len(data)
+        if size >= idat_size:
+            yield _chunk(b'IDAT', b''.join(pending))
+            pending, size = [], 0
+    if written != height:
+        raise ValueError('%d rows written instead of %d' % (written, height))
+    pending.append(compressor.flush())
+    yield _chunk(b'IDAT', b''.join(pending))
+    yield _chunk(b'IEND', b'')
+
+
+def write_png(filename, blocks, width, height, level=6, idat_size=1 << 20):
+    """ write an RGBA png from an iterator of (rows, width, 4) uint8 blocks """
+    with open(filename, 'wb') as f:
+        for chunk in png_chunks(blocks, width, height, level, idat_size):
+            f.write(chunk)
+
+
+def encode_png(rgba, level=6):
+    """ png bytes of a (height, width, 4) uint8 image """
+    return b''.join(png_chunks([rgba], rgba.shape[1], rgba.shape[0], level))
+
+
+def render(source, png=None, ncols=None, limits=None, lut=None, chunk_rows=256, level=6):
+    """ render a .sbg or GeoTIFF to png, limits defaults to the sampled 1% and 99% quantiles """
+    png = png or os.path.splitext(source)[0] + '.png'
+    lut = color_ramp_lut() if lut is None else lut
+    raster = open_raster(source, ncols)
+    try:
+        low, high = limits if limits is not None else sample_quantiles(raster)
+
+        def blocks():
+            for start in range(0, raster.nrows, chunk_rows):
+                rows = raster.read_rows(start, min(start + chunk_rows, raster.nrows))
+                yield np.take(lut, scale_to_lut(rows, low, high), axis=0)
+
+        write_png(png, blocks(), raster.ncols, raster.nrows, level)
+    finally:
+        raster.close()
+    return png
+
+
+import unittest
+import tempfile
+import shutil
+def read_png(filename):
+    """ decode an unfiltered RGBA png as written by write_png, for testing """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    position, idat, shape = 8, [], None
+    while position < len(data):
+        length, = struct.unpack_from('>I', data, position)
+        kind, content = data[position+4:position+8], data[position+8:position+8+length]
+        if kind == b'IHDR':
+            shape = struct.unpack_from('>II', content)
+        elif kind == b'IDAT':
+            idat.append(content)
+        position += 12 + length
+    width, height = shape
+    raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8).reshape(height, 1 + width * 4)
+    return raw[:, 1:].reshape(height, width, 4)
+
+class Test_raster2png(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lut(self):
+        lut = color_ramp_lut()
+        self.assertEqual((LUT_SIZE, 4), lut.shape)
+        self.assertEqual(hex_to_rgba(COLORS[-1]), lut[LUT_SIZE - 2].tolist())
+        self.assertEqual(hex_to_rgba(NA_COLOR), lut[NA_INDEX].tolist())
+        self.assertEqual([0, 500, 1000, NA_INDEX], scale_to_lut(np.array([-5, 50, 200, np.nan]), 0, 100).tolist())
+
+    def test_render_sbg(self):
+        grid = np.arange(40 * 20, dtype='<i4').reshape(20, 40)
+        grid[3, 5] = SBG_NODATA
+        path = os.path.join(self.dir, 'layer.sbg')
+        grid.tofile(path)
+        png = render(path, chunk_rows=7)
+        image = read_png(png)
+        self.assertEqual((20, 40, 4), image.shape)
+        expected = color_ramp_lut()[scale_to_lut(np.where(grid == SBG_NODATA, np.nan, grid), 0, 799)]
+        self.assertEqual(hex_to_rgba(NA_COLOR), image[3, 5].tolist())
+        low, high = sample_quantiles(SbgRaster(path))
+        self.assertTrue(abs(low - 8) <= 1 and abs(high - 791) <= 1)
+        self.assertTrue(np.abs(image.astype(int) - expected).max() <= 8)
+
+    def test_render_tiff(self):
+        png = render(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'UTM2GTIF.TIF'),
+                     os.path.join(self.dir, 'utm.png'), chunk_rows=100)
+        self.assertEqual((929, 699, 4), read_png(png).shape)
+
+    def test_render_tiff_nodata(self):
+        from geotiff import write_tiff
+        grid = np.arange(40 * 20, dtype=np.int32).reshape(20, 40)
+        grid[3, 5] = -9999
+        path = write_tiff(os.path.join(self.dir, 'layer.tif'), grid, tile=16, nodata=-9999)
+        image = read_png(render(path, chunk_rows=7, limits=(0, 799)))
+        self.assertEqual((20, 40, 4), image.shape)
+        self.assertEqual(hex_to_rgba(NA_COLOR), image[3, 5].tolist())
+        self.assertEqual(hex_to_rgba(COLORS[-1]), image[19, 39].tolist())
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        print(render(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None, int(sys.argv[3]) if len(sys.argv) > 3 else None))
+    else:
+        unittest.main()
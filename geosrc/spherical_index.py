@@ -0,0 +1,202 @@
+""" spatial index for lon/lat points on the unit sphere
+
+The points are converted to cartesian unit vectors (like get_centroid does) and bucketed in a regular
+3-D grid of cubes, so there is no special handling needed for the poles or the date line. The cubes are
+numbered along a z-order (morton) curve, so every block of 2**l x 2**l x 2**l cubes is a contiguous range
+of the sorted keys and one sorted array serves queries at any distance: a query looks at the 27 blocks
+around it at the level where a block is at least as large as the chord of the query distance.
+Matches are returned as (query, point, distance) arrays, distances are great circle distances consistent
+with RADIUS.
+"""
+import numpy as np
+
+from numpy_greatcircle import RADIUS, unit_vectors
+
+MAX_BITS = 20  # bits per axis, 3 * 20 bit keys fit in an int64 and the smallest cube is about 12 m
+
+
+def chord(distance, radius=RADIUS):
+    """ straight line distance through the unit sphere for a great circle distance """
+    return 2 * np.sin(np.minimum(np.asarray(distance, dtype=np.float64) / radius, np.pi) / 2)
+
+
+def arc(chord_length, radius=RADIUS):
+    """ great circle distance for a chord length on the unit sphere """
+    return 2 * np.arcsin(np.minimum(chord_length / 2, 1.0)) * radius
+
+
+def _spread(v):
+    """ insert two zero bits between the bits of v """
+    v = v.astype(np.int64) & 0x1fffff
+    v = (v | (v << 32)) & 0x1f00000000ffff
+    v = (v | (v << 16)) & 0x1f0000ff0000ff
+    v = (v | (v << 8)) & 0x100f00f00f00f00f
+    v = (v | (v << 4)) & 0x10c30c30c30c30c3
+    v = (v | (v << 2)) & 0x1249249249249249
+    return v
+
+
+def morton(cubes):
+    return _spread(cubes[..., 0]) | (_spread(cubes[..., 1]) << 1) | (_spread(cubes[..., 2]) << 2)
+
+
+def _expand(starts, counts):
+    """ concatenation of the ranges starts[i]:starts[i]+counts[i] """
+    return np.arange(int(counts.sum())) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+
+_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+class SphericalIndex(object):
+    def __init__(self, lon, lat, cell_km=10.0, radius=RADIUS):
+        """ cell_km is the size of the smallest cubes, close to the smallest typical query distance """
+        self.radius, self.cell_km = radius, cell_km
+        self.points = unit_vectors(np.ravel(lon), np.ravel(lat)).astype(np.float64)
+        self.cell = max(float(chord(cell_km, radius)), 2.0 / 2 ** MAX_BITS)
+        self.bits = max(1, int(np.ceil(np.log2(2 / self.cell + 1))))
+        keys = morton(self._cubes(self.points))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cubes(self, p):
+        return np.floor((p + 1) / self.cell).astype(np.int64)
+
+    def _level(self, distance):
+        """ level at which a block of cubes is at least as large as the chord of distance """
+        blocks = float(chord(distance, self.radius)) / self.cell
+        return max(0, int(np.ceil(np.log2(blocks)))) if blocks > 1 else 0
+
+    def _candidates(self, q, level):
+        """ (query, point) pairs for all points in the 27 blocks around every query point,
+            the block lookups are done once per distinct query block """
+        blocks = self._cubes(q) >> level
+        keys = morton(blocks)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        neighbours = blocks[first][:, np.newaxis, :] + _OFFSETS[np.newaxis, :, :]
+        inside = np.all((neighbours >= 0) & (neighbours < 2 ** (self.bits - level)), axis=-1)
+        codes = morton(np.maximum(neighbours, 0))
+        starts = np.searchsorted(self.keys, codes << (3 * level))
+        counts = np.where(inside, np.searchsorted(self.keys, (codes + 1) << (3 * level)) - starts, 0)
+        ## points near every distinct query block, concatenated block after block
+        block_points = self.order[_expand(starts.ravel(), counts.ravel())]
+        block_totals = counts.sum(axis=1)
+        block_starts = np.cumsum(block_totals) - block_totals
+        inverse = inverse.reshape(-1)
+        counts = block_totals[inverse]
+        return np.repeat(np.arange(len(q)), counts), block_points[_expand(block_starts[inverse], counts)]
+
+    def query_radius(self, lon, lat, distance, max_candidates=1 << 22):
+        """ all indexed points within distance (in units of radius) of the query points,
+            returns (query indices, point indices, distances) sorted by query,
+            queries are sorted along the z-order curve and processed in chunks of about max_candidates pairs """
+        q = unit_vectors(np.ravel(lon), np.ravel(lat)).astype(np.float64)
+        max_chord = float(chord(distance, self.radius))
+        level = self._level(distance)
+        order = np.argsort(morton(self._cubes(q)), kind='stable')
+        results = []
+        start, chunk_size = 0, 4096
+        while start < len(q):
+            ids = order[start:start+chunk_size]
+            qi, pi = self._candidates(q[ids], level)
+            qi = ids[qi]
+            diff = q[qi] - self.points[pi]
+            c = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            keep = c <= max_chord
+            results.append((qi[keep], pi[keep], arc(c[keep], self.radius)))
+            start += len(ids)
+            ## adapt the chunk size to the number of candidates per query
+            chunk_size = int(min(max(1, max_candidates * len(ids) // max(len(pi), 1)), 1 << 16))
+        if not results:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+        qi, pi, d = (np.concatenate(r) for r in zip(*results))
+        order = np.argsort(qi, kind='stable')
+        return qi[order], pi[order], d[order]
+
+    def query_knn(self, lon, lat, k=1, distance=None):
+        """ the k nearest indexed points of every query point as (distances, indices) arrays of shape (n, k),
+            the search radius starts at distance (by default the cell size) and doubles until k points are found """
+        q_lon, q_lat = np.ravel(lon), np.ravel(lat)
+        n, k = len(q_lon), min(k, len(self))
+        distances = np.full((n, k), np.inf)
+        indices = np.full((n, k), -1, dtype=np.int64)
+        if distance is None:
+            distance = self.cell_km
+        todo = np.arange(n)
+        while len(todo):
+            qi, pi, d = self.query_radius(q_lon[todo], q_lat[todo], distance)
+            order = np.lexsort((d, qi))
+            qi, pi, d = qi[order], pi[order], d[order]
+            counts = np.bincount(qi, minlength=len(todo))
+            done = counts >= k
+            if distance >= np.pi * self.radius:
+                done[:] = True
+            rank = np.arange(len(qi)) - np.repeat(np.cumsum(counts) - counts, counts)
+            keep = done[qi] & (rank < k)
+            distances[todo[qi[keep]], rank[keep]] = d[keep]
+            indices[todo[qi[keep]], rank[keep]] = pi[keep]
+            todo = todo[~done]
+            distance *= 2
+        return distances, indices
+
+    def pairs_within(self, distance):
+        """ pairs (i, j) with i < j of indexed points within distance of each other, with their distances """
+        lon = np.degrees(np.arctan2(self.points[:, 1], self.points[:, 0]))
+        lat = np.degrees(np.arcsin(np.clip(self.points[:, 2], -1, 1)))
+        i, j, d = self.query_radius(lon, lat, distance)
+        keep = i < j
+        return i[keep], j[keep], d[keep]
+
+    def thin(self, distance):
+        """ indices of a subset of the points in which no two points are within distance of each other,
+            points are visited in index order and kept when none of their kept neighbours is too close """
+        i, j, _ = self.pairs_within(distance)
+        order = np.argsort(i, kind='stable')
+        i, j = i[order], j[order]
+        starts = np.searchsorted(i, np.arange(len(self) + 1))
+        removed = np.zeros(len(self), dtype=bool)
+        for p in np.unique(i).tolist():
+            if not removed[p]:
+                removed[j[starts[p]:starts[p+1]]] = True
+        return np.flatnonzero(~removed)
+
+
+import unittest
+from numpy_greatcircle import gc_distance
+class Test_SphericalIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.lon = np.r_[rng.uniform(-180, 180, 2000), 179.99, -179.99, 0.0, 120.0]
+        self.lat = np.r_[np.degrees(np.arcsin(rng.uniform(-1, 1, 2000))), 10.0, 10.0, 89.999, 89.999]
+        self.index = SphericalIndex(self.lon, self.lat, cell_km=200)
+
+    def test_query_radius(self):
+        qlon, qlat = np.array([180.0, 0.0, 35.0]), np.array([10.0, 90.0, -20.0])
+        qi, pi, d = self.index.query_radius(qlon, qlat, 500)
+        brute = gc_distance(qlon, qlat, self.lon, self.lat, outer=True)
+        expected = np.nonzero(brute <= 500)
+        self.assertEqual(sorted(zip(*expected)), sorted(zip(qi, pi)))
+        self.assertTrue(np.allclose(brute[qi, pi], d))
+        self.assertIn((0, 2000), list(zip(qi, pi)))  # across the date line
+        self.assertIn((1, 2003), list(zip(qi, pi)))  # across the pole
+
+    def test_query_knn(self):
+        qlon, qlat = np.array([180.0, 0.0, 35.0]), np.array([10.0, 90.0, -20.0])
+        d, idx = self.index.query_knn(qlon, qlat, k=5)
+        brute = gc_distance(qlon, qlat, self.lon, self.lat, outer=True)
+        self.assertTrue(np.allclose(np.sort(brute, axis=1)[:, :5], d))
+        self.assertTrue(np.allclose(brute[np.arange(3)[:, None], idx], d))
+
+    def test_pairs_and_thin(self):
+        i, j, d = self.index.pairs_within(300)
+        self.assertTrue(np.all(i < j) and np.all(d <= 300))
+        kept = self.index.thin(300)
+        brute = gc_distance(self.lon[kept], self.lat[kept], self.lon[kept], self.lat[kept], outer=True)
+        np.fill_diagonal(brute, np.inf)
+        self.assertTrue(brute.min() > 300)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,388 @@
+""" XYZ (web mercator) png tile server for global .sbg layers, asyncio and the standard library only
+
+GET /{layer}/{z}/{x}/{y}.png renders a 256x256 tile of layer_dir/{layer}.sbg: every tile pixel is mapped
+to its nearest grid cell, so only the grid rows and columns under the tile are read from the memory
+mapped layer, and coloured with the lookup table of raster2png (nodata is transparent). The colour range
+of a layer (sampled 1%/99% quantiles) is computed once per version of the layer file. Rendered tiles are
+kept in a size bounded LRU cache in memory and, optionally, in a size bounded directory on disk. ETags are
+derived from the layer file version (modification time, size and inode, checked on every request) and the
+tile coordinates, so If-None-Match is answered with 304 without touching any cache.
+Usage: python tileserver.py layer_dir [port] [cache_dir]
+"""
+import os
+import re
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from raster2png import SbgRaster, color_ramp_lut, scale_to_lut, sample_quantiles, encode_png, NA_INDEX
+
+TILE_SIZE = 256
+MAX_ZOOM = 22
+TILE_PATH = re.compile(r'^/([\w.-]+)/(\d+)/(\d+)/(\d+)\.png$')
+
+
+class SizeBoundedCache(object):
+    """ LRU cache of bytes values with a bound on the total size """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            self.size -= len(self.items.pop(key))
+        if len(value) > self.max_bytes:
+            return
+        self.items[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class DiskCache(object):
+    """ tiles as files in a directory tree, the least recently used files are removed above max_bytes """
+    def __init__(self, directory, max_bytes):
+        self.directory, self.max_bytes = directory, max_bytes
+        self.files = OrderedDict()  # path -> size, least recently used first
+        self.size = 0
+        existing = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                existing.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(existing):
+            self.files[path] = size
+            self.size += size
+
+    def path(self, key):
+        return os.path.join(self.directory, *[str(k) for k in key]) + '.png'
+
+    def get(self, key):
+        path = self.path(key)
+        if path not in self.files:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.size -= self.files.pop(path)
+            return None
+        self.files.move_to_end(path)
+        return data
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp%d-%d' % (os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(value)
+        os.replace(tmp, path)
+        self.size += len(value) - self.files.pop(path, 0)
+        self.files[path] = len(value)
+        while self.size > self.max_bytes and len(self.files) > 1:
+            evicted, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(evicted)
+            except OSError:
+                pass
+
+
+def file_version(filename):
+    """ changes when the file is modified or replaced, None when it doesn't exist """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return '%x-%x-%x' % (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class Layer(object):
+    """ a global lon/lat .sbg layer (extent -180, -90, 180, 90 unless given) with its colour range """
+    def __init__(self, filename, ncols=None, extent=(-180.0, -90.0, 180.0, 90.0), limits=None):
+        self.raster = SbgRaster(filename, ncols)
+        self.version = file_version(filename)
+        self.extent = extent
+        self.limits = limits if limits is not None else sample_quantiles(self.raster)
+
+    def cells(self, z, x, y):
+        """ grid rows and columns (-1 outside the layer) of the pixel centers of a tile """
+        world = TILE_SIZE * 2 ** z
+        xmin, ymin, xmax, ymax = self.extent
+        pixels = np.arange(TILE_SIZE) + 0.5
+        lon = (x * TILE_SIZE + pixels) / world * 360.0 - 180.0
+        lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y * TILE_SIZE + pixels) / world))))
+        cols = np.floor((lon - xmin) / (xmax - xmin) * self.raster.ncols).astype(np.int64)
+        rows = np.floor((ymax - lat) / (ymax - ymin) * self.raster.nrows).astype(np.int64)
+        cols[(cols < 0) | (cols >= self.raster.ncols)] = -1
+        rows[(rows < 0) | (rows >= self.raster.nrows)] = -1
+        return rows, cols
+
+    def read_tile(self, z, x, y):
+        """ (256, 256) float32 values of a tile, nan for nodata and outside the layer """
+        rows, cols = self.cells(z, x, y)
+        values = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+        r, c = np.flatnonzero(rows >= 0), np.flatnonzero(cols >= 0)
+        if len(r) and len(c):
+            ## only the cells under the tile pixels are read, not the full grid rows
+            values[np.ix_(r, c)] = self.raster.read_cells(rows[r], cols[c])
+        return values
+
+
+class TileServer(object):
+    def __init__(self, layer_dir, cache_dir=None, memory_bytes=64 << 20, disk_bytes=1 << 30, layers=None,
+                 threads=4):
+        """ layers optionally maps layer names to Layer keyword arguments (ncols, extent, limits) """
+        self.layer_dir = layer_dir
+        self.layer_options = layers or {}
+        self.layers = {}
+        self.memory = SizeBoundedCache(memory_bytes)
+        self.disk = DiskCache(cache_dir, disk_bytes) if cache_dir else None
+        self.lut = color_ramp_lut()
+        self.lut[NA_INDEX] = 0  # transparent nodata
+        self.executor = ThreadPoolExecutor(threads)
+        self.lock = threading.Lock()  # tiles are rendered in the executor threads, the caches are shared
+
+    def layer(self, name, load=True):
+        """ the Layer of name, reloaded when its file changed, None when there is no such layer
+            (or it isn't loaded yet and load is False) """
+        path = os.path.join(self.layer_dir, name + '.sbg')
+        version = file_version(path)
+        with self.lock:
+            layer = self.layers.get(name)
+            if layer is not None and layer.version == version:
+                return layer
+            if version is None or not load:
+                return None
+        ## computing the colour range of a new layer is slow, don't hold the lock
+        layer = Layer(path, **self.layer_options.get(name, {}))
+        with self.lock:
+            self.layers[name] = layer
+        return layer
+
+    def etag(self, layer, z, x, y):
+        return '"%s-%d-%d-%d"' % (layer.version, z, x, y)
+
+    def render(self, layer, z, x, y):
+        values = layer.read_tile(z, x, y)
+        low, high = layer.limits
+        return encode_png(np.take(self.lut, scale_to_lut(values, low, high), axis=0))
+
+    def tile(self, name, z, x, y):
+        """ (status, etag, png bytes) of a tile, from the memory cache, the disk cache or rendered """
+        if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            return 404, None, None
+        layer = self.layer(name)
+        if layer is None:
+            return 404, None, None
+        key = (name, layer.version, z, x, y)
+        with self.lock:
+            data = self.memory.get(key)
+            if data is None and self.disk is not None:
+                data = self.disk.get(key)
+                if data is not None:
+                    self.memory.put(key, data)
+        if data is None:
+            data = self.render(layer, z, x, y)
+            with self.lock:
+                self.memory.put(key, data)
+                if self.disk is not None:
+                    self.disk.put(key, data)
+        return 200, self.etag(layer, z, x, y), data
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                parts = request.decode('latin-1').split()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                match = TILE_PATH.match(parts[1].split('?')[0]) if len(parts) == 3 and parts[0] in ('GET', 'HEAD') else None
+                if match is None:
+                    status, etag, data = 400, None, None
+                else:
+                    name, z, x, y = match.group(1), int(match.group(2)), int(match.group(3)), int(match.group(4))
+                    layer = self.layer(name, load=False)
+                    if layer is not None and headers.get('if-none-match') == self.etag(layer, z, x, y):
+                        status, etag, data = 304, self.etag(layer, z, x, y), None
+                    else:
+                        try:
+                            status, etag, data = await loop.run_in_executor(self.executor, self.tile, name, z, x, y)
+                        except Exception:
+                            ## e.g. a layer of the wrong size or an unreadable file, answer instead of dropping the connection
+                            logging.exception('rendering %s failed', parts[1])
+                            status, etag, data = 500, None, None
+                writer.write(self.response(status, etag, data, parts[0] == 'HEAD' if parts else False, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def response(self, status, etag, data, head=False, keep_alive=True):
+        reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+                   500: 'Internal Server Error'}
+        body = data if status == 200 else (b'' if status == 304 else reasons[status].encode('ascii'))
+        headers = ['HTTP/1.1 %d %s' % (status, reasons[status]),
+                   'Content-Length: %d' % (len(body) if status != 304 else 0),
+                   'Connection: %s' % ('keep-alive' if keep_alive else 'close'),
+                   'Access-Control-Allow-Origin: *']
+        if status == 200:
+            headers.append('Content-Type: image/png')
+        if etag:
+            headers += ['ETag: %s' % etag, 'Cache-Control: public, max-age=3600']
+        return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + (b'' if head or status == 304 else body)
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def serve_forever(layer_dir, port=8000, cache_dir=None, host='127.0.0.1'):
+    async def main():
+        server = await TileServer(layer_dir, cache_dir).serve(host, port)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+import unittest
+import tempfile
+import shutil
+import http.client
+class Test_tileserver(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.layers = os.path.join(self.dir, 'layers')
+        os.makedirs(self.layers)
+        grid = np.repeat(np.arange(180, dtype='<i4')[:, None], 360, axis=1)  # latitude bands
+        grid[:, :10] = -2147483648
+        grid.tofile(os.path.join(self.layers, 'lat.sbg'))
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def start(self, cache_dir):
+        self.tiles = TileServer(self.layers, cache_dir, memory_bytes=1 << 20)
+        server = asyncio.run_coroutine_threadsafe(self.tiles.serve(port=0), self.loop).result()
+        return server, server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        ## let the handlers see the closed connections before stopping the loop
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        shutil.rmtree(self.dir)
+
+    def get(self, connection, path, headers={}):
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.getheader('ETag'), response.read()
+
+    def test_tiles(self):
+        from raster2png import read_png
+        cache_dir = os.path.join(self.dir, 'cache')
+        server, port = self.start(cache_dir)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        status, etag, data = self.get(connection, '/lat/1/0/0.png')
+        self.assertEqual(200, status)
+        with open(os.path.join(self.dir, 't.png'), 'wb') as f:
+            f.write(data)
+        image = read_png(os.path.join(self.dir, 't.png'))
+        self.assertEqual((256, 256, 4), image.shape)
+        self.assertEqual(0, image[100, 0, 3])  # nodata west of -170 is transparent
+        self.assertEqual(255, image[100, 200, 3])
+        ## values increase southwards (darker to lighter), rows at the same latitude have the same colour
+        self.assertTrue(np.all(image[0, 30:] == image[0, 30]) and image[250, 100, 2] >= image[0, 100, 2])
+        self.assertEqual((200, etag, data), self.get(connection, '/lat/1/0/0.png'))
+        self.assertEqual(1, self.tiles.memory.hits)
+        self.assertEqual(304, self.get(connection, '/lat/1/0/0.png', {'If-None-Match': etag})[0])
+        self.assertEqual(404, self.get(connection, '/lat/1/2/0.png')[0])
+        self.assertEqual(404, self.get(connection, '/other/0/0/0.png')[0])
+        self.assertEqual(400, self.get(connection, '/lat/a/0/0.png')[0])
+        self.assertEqual(200, self.get(connection, '/lat/8/130/90.png')[0])
+        connection.close()
+        server.close()
+        ## a new server finds the rendered tile on disk
+        server, port = self.start(cache_dir)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.assertEqual((200, etag, data), self.get(connection, '/lat/1/0/0.png'))
+        self.assertEqual(0, self.tiles.memory.hits)
+        self.assertEqual(2, len(self.tiles.disk.files))
+        connection.close()
+        server.close()
+
+    def test_replaced_layer(self):
+        server, port = self.start(None)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        status, etag, data = self.get(connection, '/lat/0/0/0.png')
+        path = os.path.join(self.layers, 'lat.sbg')
+        replacement = path + '.new'
+        np.full((180, 360), 5, dtype='<i4').tofile(replacement)
+        os.replace(replacement, path)
+        status, new_etag, new_data = self.get(connection, '/lat/0/0/0.png', {'If-None-Match': etag})
+        self.assertEqual(200, status)
+        self.assertTrue(new_etag != etag and new_data != data)
+        self.assertEqual(0, self.tiles.memory.hits)
+        self.assertEqual((200, new_etag, new_data), self.get(connection, '/lat/0/0/0.png'))
+        connection.close()
+        server.close()
+
+    def test_render_error(self):
+        with open(os.path.join(self.layers, 'broken.sbg'), 'wb') as f:
+            f.write(b'\0' * 12)  # 3 cells are not a whole number of rows of 2 columns
+        server, port = self.start(None)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertEqual(500, self.get(connection, '/broken/0/0/0.png')[0])
+        finally:
+            logging.disable(logging.NOTSET)
+        ## the connection is still usable
+        self.assertEqual(200, self.get(connection, '/lat/0/0/0.png')[0])
+        connection.close()
+        server.close()
+
+    def test_caches_are_bounded(self):
+        cache = SizeBoundedCache(10)
+        for key in 'abcd':
+            cache.put(key, b'1234')
+        self.assertEqual(['c', 'd'], list(cache.items))
+        disk = DiskCache(os.path.join(self.dir, 'disk'), 10)
+        for key in 'abcd':
+            disk.put(('l', key), b'1234')
+        self.assertEqual(8, disk.size)
+        self.assertIsNone(disk.get(('l', 'a')))
+        self.assertEqual(b'1234', disk.get(('l', 'd')))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        serve_forever(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8000, sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        unittest.main()
@@ -0,0 +1,223 @@
+""" binned 2-D kernel density estimate, python version of kernel_density.R (KernSmooth bkde2D)
+
+The points are linearly binned onto the grid and the binned counts are convolved with a Gaussian kernel
+truncated at 3.4 bandwidths (as bkde2D does) using FFTs. The FFT of the kernel only depends on the grid
+and the bandwidth so it is cached and reused for every species.
+Usage: python kernel_density.py Alaria_esculenta.csv [Alaria_esculenta_density.asc|.sbg]
+"""
+import os
+import csv
+from multiprocessing import Pool
+
+import numpy as np
+
+GRIDSIZE = (4320, 2160)
+RANGE = ((-180.0, 180.0), (-90.0, 90.0))
+THRESHOLD = 0.00001  # ignore very small values
+TRUNCATE = 3.4  # kernel support in bandwidths, same as bkde2D
+SBG_SCALE = 1e6  # .sbg files are int32, densities are stored multiplied by this
+NODATA = -9999
+
+_kernels = {}  # (gridsize, range, bandwidth, truncate) -> (kernel fft, padded shape)
+
+
+def read_coordinates(filename, lon_column='longitude', lat_column='latitude'):
+    """ longitudes and latitudes of an occurrence csv (species,longitude,latitude) """
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i, j = header.index(lon_column), header.index(lat_column)
+        xy = np.array([(row[i], row[j]) for row in reader if row], dtype=np.float64)
+    return xy.reshape(-1, 2)[:, 0], xy.reshape(-1, 2)[:, 1]
+
+
+def grid_points(gridsize=GRIDSIZE, range_x=RANGE):
+    """ the grid points of bkde2D, the range end points included """
+    return [np.linspace(r[0], r[1], m) for m, r in zip(gridsize, range_x)]
+
+
+def linear_binning(x, y, gridsize=GRIDSIZE, range_x=RANGE):
+    """ (M1, M2) counts, every point is split over its 4 surrounding grid points by bilinear weights,
+        points outside the range are dropped """
+    counts = np.zeros(gridsize[0] * gridsize[1])
+    positions = []
+    for v, m, (low, high) in zip((x, y), gridsize, range_x):
+        p = (np.asarray(v, dtype=np.float64) - low) / ((high - low) / (m - 1))
+        positions.append(p)
+    px, py = positions
+    inside = (px >= 0) & (px <= gridsize[0] - 1) & (py >= 0) & (py <= gridsize[1] - 1)
+    px, py = px[inside], py[inside]
+    ix = np.minimum(px.astype(np.int64), gridsize[0] - 2)
+    iy = np.minimum(py.astype(np.int64), gridsize[1] - 2)
+    fx, fy = px - ix, py - iy
+    cell = ix * gridsize[1] + iy
+    for offset, w in ((0, (1 - fx) * (1 - fy)), (1, (1 - fx) * fy),
+                      (gridsize[1], fx * (1 - fy)), (gridsize[1] + 1, fx * fy)):
+        counts += np.bincount(cell + offset, weights=w, minlength=len(counts))
+    return counts.reshape(gridsize)
+
+
+def _fft_size(n):
+    """ smallest 2^a 3^b 5^c >= n, fast for numpy.fft """
+    best = 1 << int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            size = p35
+            while size < n:
+                size *= 2
+            best = min(best, size)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _kernel_fft(gridsize, range_x, bandwidth, truncate):
+    key = (tuple(gridsize), tuple(map(tuple, range_x)), tuple(bandwidth), truncate)
+    if key not in _kernels:
+        half, kernels = [], []
+        for m, (low, high), h in zip(gridsize, range_x, bandwidth):
+            delta = (high - low) / (m - 1)
+            L = min(int(truncate * h / delta), m - 1)
+            lags = np.arange(-L, L + 1) * delta / h
+            kernels.append(np.exp(-0.5 * lags ** 2) / (np.sqrt(2 * np.pi) * h))
+            half.append(L)
+        shape = tuple(_fft_size(m + 2 * L) for m, L in zip(gridsize, half))
+        ## the 2-D kernel is separable, its FFT is the outer product of the 1-D FFTs
+        ## (kernels are centered on index 0 with wrap around so the convolution needs no shift)
+        k1 = np.zeros(shape[0])
+        k1[:half[0] + 1], k1[shape[0] - half[0]:] = kernels[0][half[0]:], kernels[0][:half[0]]
+        k2 = np.zeros(shape[1])
+        k2[:half[1] + 1], k2[shape[1] - half[1]:] = kernels[1][half[1]:], kernels[1][:half[1]]
+        _kernels[key] = (np.fft.fft(k1)[:, np.newaxis] * np.fft.rfft(k2)[np.newaxis, :], shape)
+    return _kernels[key]
+
+
+def bkde2d(x, y, bandwidth=(3.0, 3.0), gridsize=GRIDSIZE, range_x=RANGE, truncate=TRUNCATE):
+    """ same result as bkde2D in KernSmooth: (x1, x2, fhat) with fhat of shape gridsize """
+    counts = linear_binning(x, y, gridsize, range_x)
+    kernel, shape = _kernel_fft(gridsize, range_x, bandwidth, truncate)
+    fhat = np.fft.irfft2(np.fft.rfft2(counts, shape) * kernel, shape)[:gridsize[0], :gridsize[1]]
+    fhat /= max(len(np.ravel(x)), 1)
+    x1, x2 = grid_points(gridsize, range_x)
+    return x1, x2, fhat
+
+
+def density_grid(x, y, bandwidth=3.0, ncols=GRIDSIZE[0], nrows=GRIDSIZE[1], threshold=THRESHOLD):
+    """ the density estimate as a (nrows, ncols) raster with the north row first, small values set to 0 """
+    _, _, fhat = bkde2d(x, y, (bandwidth, bandwidth), (ncols, nrows))
+    fhat[fhat < threshold] = 0
+    return fhat.T[::-1]
+
+
+def write_ascii(filename, grid, xllcorner=-180.0, yllcorner=-90.0, cellsize=None, nodata=NODATA):
+    """ write a raster as ESRI ASCII grid row by row, rows of zeros are written from one cached line """
+    nrows, ncols = grid.shape
+    if cellsize is None:
+        cellsize = 360.0 / ncols
+    zeros = ' '.join(['0'] * ncols) + '\n'
+    with open(filename, 'w') as f:
+        f.write('ncols %d\nnrows %d\nxllcorner %r\nyllcorner %r\ncellsize %r\nNODATA_value %d\n' %
+                (ncols, nrows, xllcorner, yllcorner, cellsize, nodata))
+        for row in grid:
+            nonzero = np.flatnonzero(row)
+            if not len(nonzero):
+                f.write(zeros)
+                continue
+            values = ['0'] * ncols
+            for i, v in zip(nonzero.tolist(), row[nonzero].tolist()):
+                values[i] = '%.6g' % v
+            f.write(' '.join(values) + '\n')
+
+
+def write_sbg(filename, grid, scale=SBG_SCALE, block_rows=256):
+    """ write a raster as .sbg (int32, values multiplied by scale) """
+    with open(filename, 'wb') as f:
+        for start in range(0, grid.shape[0], block_rows):
+            f.write(np.rint(grid[start:start+block_rows] * scale).astype('<i4').tobytes())
+
+
+def kernel_density(input_csv, output=None, bandwidth=3.0, ncols=GRIDSIZE[0], nrows=GRIDSIZE[1],
+                   threshold=THRESHOLD):
+    """ density raster for one occurrence csv, written as .asc or .sbg depending on the output extension """
+    if output is None:
+        output = os.path.splitext(input_csv)[0] + '_density.asc'
+    x, y = read_coordinates(input_csv)
+    grid = density_grid(x, y, bandwidth, ncols, nrows, threshold)
+    if output.endswith('.sbg'):
+        write_sbg(output, grid)
+    else:
+        write_ascii(output, grid)
+    return output
+
+
+def _kernel_density(args):
+    input_csv, output, kwargs = args
+    return kernel_density(input_csv, output, **kwargs)
+
+
+def kernel_density_many(input_csvs, outdir=None, extension='.sbg', processes=None, **kwargs):
+    """ density rasters for many species files, one file per task """
+    jobs = []
+    for path in input_csvs:
+        name = os.path.splitext(os.path.basename(path))[0] + '_density' + extension
+        jobs.append((path, os.path.join(outdir or os.path.dirname(path), name), kwargs))
+    pool = Pool(processes)
+    try:
+        return pool.map(_kernel_density, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+import unittest
+import tempfile
+import shutil
+class Test_kernel_density(unittest.TestCase):
+    def test_linear_binning(self):
+        counts = linear_binning([0.3, 10], [0.5, 0], (5, 3), ((0, 1), (0, 1)))
+        self.assertAlmostEqual(1.0, counts.sum())
+        self.assertAlmostEqual(0.8, counts[1, 1])
+        self.assertAlmostEqual(0.2, counts[2, 1])
+
+    def test_bkde2d_direct(self):
+        rng = np.random.RandomState(2)
+        x, y = rng.normal(0, 20, 50), rng.normal(10, 15, 50)
+        gridsize, range_x, h = (73, 37), ((-180, 180), (-90, 90)), (15.0, 10.0)
+        x1, x2, fhat = bkde2d(x, y, h, gridsize, range_x)
+        ## direct convolution of the binned counts with the truncated kernel
+        counts = linear_binning(x, y, gridsize, range_x)
+        dx, dy = x1[:, None, None, None] - x1[None, None, :, None], x2[None, :, None, None] - x2[None, None, None, :]
+        kx = np.where(np.abs(dx) <= int(TRUNCATE * h[0] / 5.0) * 5.0, np.exp(-0.5 * (dx / h[0]) ** 2) / (np.sqrt(2 * np.pi) * h[0]), 0)
+        ky = np.where(np.abs(dy) <= int(TRUNCATE * h[1] / 5.0) * 5.0, np.exp(-0.5 * (dy / h[1]) ** 2) / (np.sqrt(2 * np.pi) * h[1]), 0)
+        expected = np.einsum('ijkl,kl->ij', kx * ky, counts) / len(x)
+        self.assertTrue(np.allclose(expected, fhat, atol=1e-12))
+        self.assertAlmostEqual(1.0, fhat.sum() * 25, places=2)
+
+    def test_kernel_density(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'species.csv')
+            with open(path, 'w') as f:
+                f.write('species,longitude,latitude\n"a, b",2.9,51.2\na,3.1,51.3\n')
+            asc = kernel_density(path, ncols=360, nrows=180)
+            sbg = kernel_density(path, os.path.join(directory, 'species.sbg'), ncols=360, nrows=180)
+            with open(asc) as f:
+                header = [next(f) for _ in range(6)]
+                values = np.loadtxt(f)
+            self.assertEqual('ncols 360\n', header[0])
+            self.assertEqual((180, 360), values.shape)
+            row, col = np.unravel_index(np.argmax(values), values.shape)
+            self.assertTrue(abs(row - (179 - 141.25 * 179 / 180)) <= 1 and abs(col - 183 * 359 / 360) <= 1)
+            ints = np.fromfile(sbg, dtype='<i4').reshape(180, 360)
+            self.assertTrue(np.allclose(values * SBG_SCALE, ints, atol=1))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        print(kernel_density(*sys.argv[1:3]))
+    else:
+        unittest.main()
@@ -0,0 +1,153 @@
+""" kernel density on the sphere: the kernel is a Gaussian of the great circle distance in km instead of
+a planar Gaussian in degrees, so densities are not stretched towards the poles
+
+The grid is evaluated tile by tile: every tile only looks at the points within its radius plus the kernel
+cutoff and the tiles are spread over a process pool. Densities are per km2.
+Usage: python spherical_kernel_density.py Alaria_esculenta.csv [Alaria_esculenta_spherical.asc|.sbg]
+"""
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from kernel_density import GRIDSIZE, TRUNCATE, read_coordinates, write_ascii, write_sbg
+
+RADIUS = 6371.009  # mean earth radius in km, same as numpy_greatcircle
+SBG_SCALE = 1e9  # densities per km2 are small, stored as int32 multiplied by this
+
+
+def unit_vectors(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def cell_centers(ncols=GRIDSIZE[0], nrows=GRIDSIZE[1]):
+    """ longitudes and latitudes of the cell centers of a global grid, north row first """
+    lon = -180.0 + (np.arange(ncols) + 0.5) * 360.0 / ncols
+    lat = 90.0 - (np.arange(nrows) + 0.5) * 180.0 / nrows
+    return lon, lat
+
+
+def tiles(ncols=GRIDSIZE[0], nrows=GRIDSIZE[1], tile_size=128):
+    """ (row, col, nrows, ncols) of the tiles of a grid """
+    return [(r, c, min(tile_size, nrows - r), min(tile_size, ncols - c))
+            for r in range(0, nrows, tile_size) for c in range(0, ncols, tile_size)]
+
+
+class SphericalKDE(object):
+    def __init__(self, lon, lat, bandwidth=300.0, truncate=TRUNCATE, ncols=GRIDSIZE[0], nrows=GRIDSIZE[1],
+                 radius=RADIUS, max_pairs=1 << 22):
+        """ bandwidth in km, the kernel is cut off at truncate * bandwidth """
+        self.points = unit_vectors(np.ravel(lon), np.ravel(lat))
+        self.n = len(self.points)
+        self.bandwidth, self.radius = bandwidth, radius
+        self.cutoff = min(truncate * bandwidth / radius, np.pi)  # in radians
+        self.ncols, self.nrows = ncols, nrows
+        self.lon, self.lat = cell_centers(ncols, nrows)
+        self.max_pairs = max_pairs
+
+    def evaluate_tile(self, tile):
+        """ (nrows, ncols) densities of one tile """
+        row, col, nrows, ncols = tile
+        cells = unit_vectors(*np.meshgrid(self.lon[col:col+ncols], self.lat[row:row+nrows])).reshape(-1, 3)
+        result = np.zeros(len(cells))
+        ## points within the kernel cutoff of the cap around the tile
+        center = cells.mean(axis=0)
+        center /= np.linalg.norm(center)
+        tile_radius = np.arccos(np.clip(cells.dot(center).min(), -1, 1))
+        near = self.points[self.points.dot(center) >= np.cos(min(tile_radius + self.cutoff, np.pi))]
+        if len(near):
+            cos_cutoff = np.cos(self.cutoff)
+            scale = -0.5 * (self.radius / self.bandwidth) ** 2
+            step = max(1, self.max_pairs // len(near))
+            for start in range(0, len(cells), step):
+                dots = cells[start:start+step].dot(near.T)
+                inside = dots >= cos_cutoff
+                ## great circle distance from the chord: 2 * asin(|p - q| / 2), |p - q|^2 = 2 - 2 p.q
+                d = np.sqrt(np.maximum(2 - 2 * dots, 0, out=dots), out=dots)
+                d *= 0.5
+                d = np.arcsin(np.minimum(d, 1, out=d), out=d)
+                d *= d
+                d *= 4 * scale
+                k = np.exp(d, out=d)
+                k *= inside
+                result[start:start+step] = k.sum(axis=1)
+        result /= 2 * np.pi * self.bandwidth ** 2 * max(self.n, 1)
+        return result.reshape(nrows, ncols)
+
+    def evaluate(self, tile_size=128, processes=None, threshold=None):
+        """ densities of the whole grid (north row first), tiles are evaluated in a process pool
+            (processes=1 evaluates them in this process) """
+        grid = np.zeros((self.nrows, self.ncols))
+        jobs = tiles(self.ncols, self.nrows, tile_size)
+        if processes == 1:
+            results = map(self.evaluate_tile, jobs)
+            pool = None
+        else:
+            pool = Pool(processes, _init_worker, (self,))
+            results = pool.imap(_evaluate_tile, jobs, chunksize=4)
+        try:
+            for (row, col, nrows, ncols), values in zip(jobs, results):
+                grid[row:row+nrows, col:col+ncols] = values
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if threshold is not None:
+            grid[grid < threshold] = 0
+        return grid
+
+
+_worker_kde = None
+
+
+def _init_worker(kde):
+    global _worker_kde
+    _worker_kde = kde
+
+
+def _evaluate_tile(tile):
+    return _worker_kde.evaluate_tile(tile)
+
+
+def spherical_kernel_density(input_csv, output=None, bandwidth=300.0, ncols=GRIDSIZE[0], nrows=GRIDSIZE[1],
+                             threshold=None, processes=None):
+    """ spherical density raster for one occurrence csv, written as .asc or .sbg depending on the output extension """
+    if output is None:
+        output = os.path.splitext(input_csv)[0] + '_spherical.asc'
+    lon, lat = read_coordinates(input_csv)
+    grid = SphericalKDE(lon, lat, bandwidth, ncols=ncols, nrows=nrows).evaluate(processes=processes,
+                                                                                threshold=threshold)
+    if output.endswith('.sbg'):
+        write_sbg(output, grid, SBG_SCALE)
+    else:
+        write_ascii(output, grid)
+    return output
+
+
+import unittest
+class Test_spherical_kernel_density(unittest.TestCase):
+    def test_brute_force(self):
+        rng = np.random.RandomState(4)
+        lon, lat = np.r_[rng.uniform(-20, 40, 30), 179.5, 0.0], np.r_[rng.uniform(50, 90, 30), 0.0, 89.9]
+        kde = SphericalKDE(lon, lat, bandwidth=500.0, ncols=72, nrows=36)
+        grid = kde.evaluate(tile_size=10, processes=1)
+        ## every cell against every point with the haversine distance
+        clon, clat = np.meshgrid(*cell_centers(72, 36))
+        lon1, lat1, lon2, lat2 = (np.radians(a) for a in (clon[..., None], clat[..., None], lon, lat))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        d = 2 * np.arcsin(np.sqrt(a)) * RADIUS
+        k = np.where(d <= TRUNCATE * 500.0, np.exp(-0.5 * (d / 500.0) ** 2), 0)
+        expected = k.sum(axis=-1) / (2 * np.pi * 500.0 ** 2 * len(lon))
+        self.assertTrue(np.allclose(expected, grid, rtol=1e-6, atol=1e-15))
+        ## across the date line and around the pole
+        self.assertTrue(grid[17, 0] > 0 and grid[0, 36] > 0 and grid[0, 0] > 0)
+        self.assertTrue(np.allclose(grid, kde.evaluate(tile_size=16, processes=2)))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        print(spherical_kernel_density(*sys.argv[1:3]))
+    else:
+        unittest.main()
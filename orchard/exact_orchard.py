@@ -0,0 +1,173 @@
+""" exact win probabilities of the orchard game instead of the Monte Carlo estimates
+
+A game state is the number of fruits left per colour (0-10) and the number of raven pieces laid (0-8),
+indexed as fruits[0] * 11^3 + fruits[1] * 11^2 + fruits[2] * 11 + fruits[3] in a table per raven count.
+The win probability of a state only depends on states with fewer fruits (a colour or the basket) and
+on the state with one more raven piece, so the tables are filled bottom-up, for one raven count after
+another and within a raven count by increasing number of fruits, all states with the same number of
+fruits at once. Throwing the colour of an empty tree leaves the state unchanged, that probability is
+solved for: P = (sum of the other outcomes) / (6 - empty trees).
+"""
+import numpy as np
+
+from numpy_orchard import COLOURS, FRUITS, RAVEN, pick_max, pick_min
+
+STRATEGIES = ('max', 'min', 'random', 'optimal')
+
+_solutions = {}  # (strategy, fruits, raven) -> win probability table of shape (raven + 1, (fruits + 1) ** 4)
+
+
+def _states(fruits):
+    """ fruit counts (n, 4) of all state indices and the index stride of every colour """
+    base = fruits + 1
+    strides = base ** np.arange(COLOURS - 1, -1, -1)
+    counts = (np.arange(base ** COLOURS)[:, np.newaxis] // strides) % base
+    return counts, strides
+
+
+def state_index(fruits, max_fruits=FRUITS):
+    """ index of fruit counts in a table row """
+    strides = (max_fruits + 1) ** np.arange(COLOURS - 1, -1, -1)
+    return int(np.dot(fruits, strides))
+
+
+def _basket(strategy, counts, strides):
+    """ outcomes of a basket throw for every state: (targets, probabilities) of shape (n, k),
+        for the optimal strategy all candidate targets with probability 1 where the pair of picks is possible """
+    n = len(counts)
+    index = np.arange(n)
+    if strategy in ('max', 'min'):
+        pick = pick_max if strategy == 'max' else pick_min
+        targets, left = index.copy(), counts.copy()
+        for _ in range(2):
+            colour = pick(left, None)
+            picked = colour >= 0
+            targets[picked] -= strides[colour[picked]]
+            left[picked, colour[picked]] -= 1
+        return targets[:, np.newaxis], np.ones((n, 1))
+    ## all ordered pairs of picks, a pick from an empty tree is only allowed when all trees are empty (no-op)
+    targets, weights = [], []
+    first_counts = (counts > 0).sum(axis=1)
+    for c1 in range(COLOURS):
+        valid1 = counts[:, c1] > 0
+        left = counts.copy()
+        left[valid1, c1] -= 1
+        second_counts = (left > 0).sum(axis=1)
+        for c2 in range(COLOURS):
+            valid2 = left[:, c2] > 0
+            target = index - np.where(valid1, strides[c1], 0) - np.where(valid2, strides[c2], 0)
+            ## after the first pick all trees are empty: the second pick has nothing left, count it once
+            only = valid1 & (second_counts == 0) & (c2 == 0)
+            if strategy == 'random':
+                w = np.where(valid1 & valid2, 1.0 / np.maximum(first_counts * second_counts, 1), 0)
+                w = np.where(only, 1.0 / np.maximum(first_counts, 1), w)
+            else:
+                w = ((valid1 & valid2) | only).astype(np.float64)
+            targets.append(target)
+            weights.append(w)
+    return np.stack(targets, axis=1), np.stack(weights, axis=1)
+
+
+def solve(strategy='max', fruits=FRUITS, raven=RAVEN):
+    """ (raven + 1, (fruits + 1) ** 4) table of win probabilities, the last row (raven complete) is 0 """
+    key = (strategy, fruits, raven)
+    if key in _solutions:
+        return _solutions[key]
+    if strategy not in STRATEGIES:
+        raise ValueError('unknown strategy %r, expected one of %s' % (strategy, ', '.join(STRATEGIES)))
+    counts, strides = _states(fruits)
+    targets, weights = _basket(strategy, counts, strides)
+    total = counts.sum(axis=1)
+    nonempty = counts > 0
+    empty_trees = COLOURS - nonempty.sum(axis=1)
+    groups = [np.flatnonzero(total == s) for s in range(total.max() + 1)]
+    table = np.zeros((raven + 1, len(counts)))
+    for r in range(raven - 1, -1, -1):
+        p, p_raven = table[r], table[r + 1]
+        p[0] = 1.0  # all fruit picked
+        for states in groups[1:]:
+            colours = (nonempty[states] * p[states[:, np.newaxis] - strides]).sum(axis=1)
+            basket = p[targets[states]] * weights[states]
+            if strategy == 'optimal':
+                basket = np.where(weights[states] > 0, basket, -1).max(axis=1)
+            else:
+                basket = basket.sum(axis=1)
+            p[states] = (colours + p_raven[states] + basket) / (6 - empty_trees[states])
+    _solutions[key] = table
+    return table
+
+
+def win_probability(strategy='max', fruits=(FRUITS,) * COLOURS, raven=0, max_fruits=FRUITS, max_raven=RAVEN):
+    """ exact probability to win from a state (by default the start of the game) """
+    return float(solve(strategy, max_fruits, max_raven)[raven, state_index(fruits, max_fruits)])
+
+
+def optimal_picks(fruits, raven=0, max_fruits=FRUITS, max_raven=RAVEN):
+    """ the two colours to pick from the basket that maximize the win probability """
+    table = solve('optimal', max_fruits, max_raven)[raven]
+    fruits = list(fruits)
+    best, best_p = None, -1.0
+    for c1 in range(COLOURS):
+        for c2 in range(c1, COLOURS):
+            left = list(fruits)
+            for c in (c1, c2):
+                if left[c] > 0:
+                    left[c] -= 1
+            if sum(fruits) - sum(left) != min(2, sum(fruits)):
+                continue
+            p = table[state_index(left, max_fruits)]
+            if p > best_p:
+                best, best_p = (c1, c2), p
+    return best
+
+
+import unittest
+from functools import lru_cache
+def _reference(strategy, fruits, raven, max_raven):
+    """ plain recursive version of the game rules of monte_carlo_simulation.py """
+    @lru_cache(maxsize=None)
+    def p(fruits, r):
+        if sum(fruits) == 0:
+            return 1.0
+        if r == max_raven:
+            return 0.0
+        empty = sum(1 for f in fruits if f == 0)
+        others = sum(p(fruits[:c] + (f - 1,) + fruits[c+1:], r) for c, f in enumerate(fruits) if f > 0)
+        return (others + p(fruits, r + 1) + basket(fruits, r, 2)) / (6 - empty)
+
+    def pick(fruits, c):
+        return fruits[:c] + (fruits[c] - 1,) + fruits[c+1:]
+
+    def basket(fruits, r, picks):
+        if picks == 0 or sum(fruits) == 0:
+            return p(fruits, r)
+        options = [c for c, f in enumerate(fruits) if f > 0]
+        if strategy == 'max':
+            return basket(pick(fruits, max(options, key=lambda c: (fruits[c], -c))), r, picks - 1)
+        if strategy == 'min':
+            return basket(pick(fruits, min(options, key=lambda c: (fruits[c], c))), r, picks - 1)
+        outcomes = [basket(pick(fruits, c), r, picks - 1) for c in options]
+        return max(outcomes) if strategy == 'optimal' else sum(outcomes) / len(outcomes)
+
+    return p(tuple(fruits), raven)
+
+class Test_exact_orchard(unittest.TestCase):
+    def test_small_game(self):
+        for strategy in STRATEGIES:
+            table = solve(strategy, fruits=3, raven=3)
+            for fruits, raven in (((3, 3, 3, 3), 0), ((0, 1, 0, 2), 2), ((2, 0, 3, 1), 1), ((0, 0, 0, 1), 0)):
+                expected = _reference(strategy, fruits, raven, 3)
+                self.assertAlmostEqual(expected, table[raven, state_index(fruits, 3)], places=12)
+
+    def test_full_game(self):
+        p = dict((s, win_probability(s)) for s in STRATEGIES)
+        self.assertTrue(p['min'] < p['random'] < p['max'] <= p['optimal'] + 1e-12)
+        ## the sampling engine agrees within 4 standard errors
+        from numpy_orchard import win_rate
+        for strategy in ('max', 'min', 'random'):
+            se = np.sqrt(p[strategy] * (1 - p[strategy]) / 200000)
+            self.assertAlmostEqual(p[strategy], win_rate(strategy, 200000, seed=11) / 100, delta=4 * se)
+        self.assertEqual((0, 0), optimal_picks((5, 1, 1, 1), 0))
+
+if __name__ == '__main__':
+    unittest.main()
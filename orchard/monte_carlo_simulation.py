@@ -55,20 +55,21 @@ def simulate_orchard_random(count):
     return monte_carlo_simulation(lambda:orchard(decrease_random), count)
 
 
-print('Winning rates of 10 runs of the best strategy with 50 games: \n%s' %
-      ([str(simulate_orchard_best(50)) + '%' for _ in range(10)]))
+if __name__ == '__main__':
+    print('Winning rates of 10 runs of the best strategy with 50 games: \n%s' %
+          ([str(simulate_orchard_best(50)) + '%' for _ in range(10)]))
 
-print('Winning rates of 10 runs of the best strategy with 1000 games: \n%s' %
-      ([str(simulate_orchard_best(1000)) + '%' for _ in range(10)]))
+    print('Winning rates of 10 runs of the best strategy with 1000 games: \n%s' %
+          ([str(simulate_orchard_best(1000)) + '%' for _ in range(10)]))
 
-print('Winning rates of 10 runs of the worst strategy with 50 games: \n%s' %
-      ([str(simulate_orchard_worst(50)) + '%' for _ in range(10)]))
+    print('Winning rates of 10 runs of the worst strategy with 50 games: \n%s' %
+          ([str(simulate_orchard_worst(50)) + '%' for _ in range(10)]))
 
-print('Winning rates of 10 runs of the worst strategy with 1000 games: \n%s' %
-      [str(simulate_orchard_worst(1000)) + '%' for _ in range(10)])
+    print('Winning rates of 10 runs of the worst strategy with 1000 games: \n%s' %
+          [str(simulate_orchard_worst(1000)) + '%' for _ in range(10)])
 
-print('Winning rates of 10 runs of the random strategy with 50 games: \n%s' % 
-      ([str(simulate_orchard_random(50)) + '%' for _ in range(10)]))
+    print('Winning rates of 10 runs of the random strategy with 50 games: \n%s' % 
+          ([str(simulate_orchard_random(50)) + '%' for _ in range(10)]))
 
-print('Winning rates of 10 runs of the random strategy with 1000 games: \n%s' %
-      [str(simulate_orchard_random(1000)) + '%' for _ in range(10)]) 
+    print('Winning rates of 10 runs of the random strategy with 1000 games: \n%s' %
+          [str(simulate_orchard_random(1000)) + '%' for _ in range(10)]) 
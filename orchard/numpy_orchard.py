@@ -0,0 +1,109 @@
+""" vectorized version of monte_carlo_simulation.py: many orchard games are played at once
+
+The state of all running games is kept in numpy arrays (fruits per colour and the raven counter) and
+every step throws one die for every running game. Finished games are dropped from the arrays.
+A fruit basket strategy is a function that gets the (n, 4) fruits of the games that threw the basket
+and returns the colour to pick for every game (-1 when there is nothing left to pick).
+"""
+import numpy as np
+
+COLOURS = 4
+FRUITS = 10  # fruits per colour at the start
+RAVEN = 9  # pieces of the raven puzzle, the game is lost when all of them are laid
+BASKET = 4  # die side of the fruit basket, side 5 is the raven
+
+
+def pick_max(fruits, rng):
+    """ colour with the most fruits left (the first one on ties), same as decrease_max """
+    colour = np.argmax(fruits, axis=1)
+    return np.where(fruits[np.arange(len(fruits)), colour] > 0, colour, -1)
+
+
+def pick_min(fruits, rng):
+    """ colour with the fewest fruits left that isn't empty yet, same as decrease_min """
+    colour = np.argmin(np.where(fruits > 0, fruits, np.iinfo(fruits.dtype).max), axis=1)
+    return np.where(fruits[np.arange(len(fruits)), colour] > 0, colour, -1)
+
+
+def pick_random(fruits, rng):
+    """ a random colour that isn't empty yet, same as decrease_random """
+    nonempty = fruits > 0
+    counts = nonempty.sum(axis=1)
+    choice = (rng.random(len(fruits)) * counts).astype(np.int64)
+    ## the choice-th non empty colour
+    colour = np.argmax(np.cumsum(nonempty, axis=1) > choice[:, np.newaxis], axis=1)
+    return np.where(counts > 0, colour, -1)
+
+
+STRATEGIES = {'max': pick_max, 'min': pick_min, 'random': pick_random}
+
+
+def play(strategy, games, rng=None, batch_size=1 << 20, fruits=FRUITS, raven=RAVEN):
+    """ number of games won out of games, strategy is a name from STRATEGIES or a pick function,
+        fruits (per colour) and raven (pieces) allow variants of the board """
+    strategy = STRATEGIES.get(strategy, strategy)
+    if rng is None:
+        rng = np.random.default_rng()
+    wins = 0
+    for start in range(0, games, batch_size):
+        wins += _play_batch(strategy, min(batch_size, games - start), rng, fruits, raven)
+    return wins
+
+
+def _play_batch(strategy, games, rng, start_fruits=FRUITS, raven_pieces=RAVEN):
+    fruits = np.full((games, COLOURS), start_fruits, dtype=np.int8)
+    raven = np.zeros(games, dtype=np.int8)
+    wins = 0
+    while len(fruits):
+        die = rng.integers(0, 6, size=len(fruits), dtype=np.int8)
+        raven += die == 5
+        ## a colour: pick a fruit of that colour if there is one left
+        flat = fruits.reshape(-1)
+        cells = np.flatnonzero(die < BASKET)
+        cells *= COLOURS
+        cells += die[cells // COLOURS]
+        flat[cells] -= flat[cells] > 0
+        ## the basket: pick two fruits chosen by the strategy
+        games_ = np.flatnonzero(die == BASKET)
+        for _ in range(2):
+            colour = strategy(fruits[games_], rng)
+            picked = colour >= 0
+            fruits[games_[picked], colour[picked]] -= 1
+        ## the 4 int8 fruit counts of a game viewed as one int32 are 0 when all fruits are picked
+        won = fruits.view(np.int32).reshape(-1) == 0
+        running = ~won & (raven < raven_pieces)
+        wins += int(np.count_nonzero(won))
+        if not running.all():
+            fruits, raven = fruits[running], raven[running]
+    return wins
+
+
+def win_rate(strategy, count, seed=None):
+    """ percentage of count games won, like monte_carlo_simulation """
+    return play(strategy, count, np.random.default_rng(seed)) * 100.0 / count
+
+
+import unittest
+class Test_numpy_orchard(unittest.TestCase):
+    def test_picks(self):
+        fruits = np.array([[3, 5, 5, 1], [0, 0, 0, 0], [0, 2, 0, 2]], dtype=np.int8)
+        rng = np.random.default_rng(1)
+        self.assertEqual([1, -1, 1], pick_max(fruits, rng).tolist())
+        self.assertEqual([3, -1, 1], pick_min(fruits, rng).tolist())
+        picks = np.array([pick_random(fruits, rng) for _ in range(2000)])
+        self.assertEqual([-1], np.unique(picks[:, 1]).tolist())
+        self.assertEqual([1, 3], np.unique(picks[:, 2]).tolist())
+        self.assertEqual([0, 1, 2, 3], np.unique(picks[:, 0]).tolist())
+
+    def test_reproducible(self):
+        self.assertEqual(win_rate('random', 10000, seed=3), win_rate('random', 10000, seed=3))
+        self.assertEqual(play('max', 1000, np.random.default_rng(5), batch_size=1000),
+                         play('max', 1000, np.random.default_rng(5), batch_size=1000))
+
+    def test_against_python_version(self):
+        ## the win rates of the python version with 20000 games: max 68.8%, min 53.8%, random 63.8%
+        for strategy, expected in (('max', 68.8), ('min', 53.8), ('random', 63.8)):
+            self.assertAlmostEqual(expected, win_rate(strategy, 200000, seed=7), delta=1.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+""" parallel and reproducible version of monte_carlo_simulation
+
+The games are split in shards of shard_size games that run in a process pool. Every shard gets its own
+seed stream spawned from one numpy SeedSequence, so a shard gives the same result in whatever process it runs.
+Shards are run in rounds of one shard per process, after every round the counts are merged and the simulation
+stops as soon as the Wilson score interval of the win rate is narrower than the target width, results are
+reproducible for the same seed, shard size and number of processes.
+"""
+import os
+import time
+import random
+from math import sqrt
+from multiprocessing import Pool
+
+import numpy as np
+
+import numpy_orchard
+
+Z_95 = 1.959963984540054
+
+
+def wilson_interval(wins, games, z=Z_95):
+    """ (low, high) Wilson score interval of the win rate """
+    if games == 0:
+        return 0.0, 1.0
+    p = wins / float(games)
+    denominator = 1 + z * z / games
+    center = (p + z * z / (2 * games)) / denominator
+    half = z * sqrt(p * (1 - p) / games + z * z / (4 * games * games)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def _run_shard(args):
+    """ (wins, games, seconds, pid) of one shard, game is a numpy_orchard strategy (name or pick function)
+        or any other callable without arguments that returns True when the game is won and uses the random module """
+    game, games, seed, game_kwargs = args
+    start = time.time()
+    if isinstance(game, str) or game in numpy_orchard.STRATEGIES.values():
+        wins = numpy_orchard.play(game, games, np.random.default_rng(seed), **game_kwargs)
+    else:
+        ## the game uses the global random module, in the parent process (processes=1) its state is restored
+        state = random.getstate()
+        try:
+            random.seed(int(seed.generate_state(1, np.uint64)[0]))
+            wins = sum(1 for _ in range(games) if game(**game_kwargs))
+        finally:
+            random.setstate(state)
+    return wins, games, time.time() - start, os.getpid()
+
+
+def run(game, target_width=0.002, seed=None, processes=None, shard_size=1 << 18, max_games=1 << 30,
+        z=Z_95, **game_kwargs):
+    """ play shards of game until the Wilson interval is narrower than target_width (or max_games are played)
+        returns a dict with the wins, games, rate, interval, seconds and games per second per worker process,
+        e.g. run('max', 0.002, seed=42) or run(functools.partial(orchard, decrease_max), 0.02, shard_size=5000) """
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    processes = processes or os.cpu_count() or 1
+    pool = Pool(processes) if processes > 1 else None
+    wins = games = 0
+    worker_games, worker_seconds = {}, {}
+    start = time.time()
+    try:
+        while games < max_games:
+            shards = min(processes, -(-(max_games - games) // shard_size))
+            jobs = [(game, min(shard_size, max_games - games - i * shard_size), child, game_kwargs)
+                    for i, child in enumerate(seed_sequence.spawn(shards))]
+            results = pool.map(_run_shard, jobs, chunksize=1) if pool else map(_run_shard, jobs)
+            for shard_wins, shard_games, seconds, pid in results:
+                wins += shard_wins
+                games += shard_games
+                worker_games[pid] = worker_games.get(pid, 0) + shard_games
+                worker_seconds[pid] = worker_seconds.get(pid, 0.0) + seconds
+            low, high = wilson_interval(wins, games, z)
+            if high - low < target_width:
+                break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return {'wins': wins, 'games': games, 'rate': wins / float(games) if games else 0.0,
+            'interval': wilson_interval(wins, games, z), 'seconds': time.time() - start,
+            'games_per_second': dict((pid, worker_games[pid] / max(worker_seconds[pid], 1e-9))
+                                     for pid in worker_games)}
+
+
+def compare(strategies=('max', 'min', 'random'), target_width=0.002, seed=None, **kwargs):
+    """ results of run for several strategies, every strategy gets its own seed stream """
+    children = np.random.SeedSequence(seed).spawn(len(strategies))
+    return dict((s, run(s, target_width, child, **kwargs)) for s, child in zip(strategies, children))
+
+
+import unittest
+import functools
+class Test_parallel_monte_carlo(unittest.TestCase):
+    def test_wilson_interval(self):
+        low, high = wilson_interval(50, 100)
+        self.assertAlmostEqual(0.4038, low, places=4)
+        self.assertAlmostEqual(0.5962, high, places=4)
+        self.assertEqual((0.0, 1.0), wilson_interval(0, 0))
+        self.assertEqual(0.0, wilson_interval(0, 10)[0])
+
+    def test_reproducible(self):
+        serial = run('random', 0.01, seed=3, processes=1, shard_size=20000)
+        parallel = run('random', 0.01, seed=3, processes=2, shard_size=20000)
+        ## the number of shards per round differs, the shards themselves don't
+        self.assertEqual(serial['wins'], run('random', 0.01, seed=3, processes=1, shard_size=20000)['wins'])
+        low, high = serial['interval']
+        self.assertTrue(high - low < 0.01 and low < serial['rate'] < high)
+        self.assertTrue(abs(serial['rate'] - parallel['rate']) < 0.02)
+        self.assertTrue(1 <= len(parallel['games_per_second']) <= 2)
+
+    def test_python_game(self):
+        from monte_carlo_simulation import orchard, decrease_max
+        game = functools.partial(orchard, decrease_max)
+        first = run(game, 0.1, seed=5, processes=2, shard_size=500, max_games=2000)
+        second = run(game, 0.1, seed=5, processes=2, shard_size=500, max_games=2000)
+        self.assertEqual(first['wins'], second['wins'])
+        self.assertTrue(first['games'] <= 2000)
+        ## running in this process leaves the caller's random state alone
+        random.seed(7)
+        expected = random.random()
+        random.seed(7)
+        run(game, 0.1, seed=5, processes=1, shard_size=500, max_games=1000)
+        self.assertEqual(expected, random.random())
+
+    def test_board_variant(self):
+        from exact_orchard import win_probability
+        result = run('max', 0.01, seed=1, processes=1, fruits=4, raven=5)
+        low, high = result['interval']
+        expected = win_probability('max', (4, 4, 4, 4), 0, max_fruits=4, max_raven=5)
+        self.assertTrue(low - 0.005 < expected < high + 0.005)
+
+if __name__ == '__main__':
+    unittest.main()